@@ -0,0 +1,206 @@
+# admission.py
+import os
+import math
+import time
+import asyncio
+import functools
+import threading
+from collections import OrderedDict, deque
+
+from flask import Response, make_response, request, session
+
+import metrics
+
+# LLM を呼ぶルートを同時に処理する数と、空きを待てる数（uWSGI の threads=4 のうち1本は他のページ用に残す）
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "1"))
+
+# asgi.py では待っている間スレッドを使わないので、多めに受け付ける
+LLM_ASYNC_MAX_CONCURRENT = int(os.getenv("LLM_ASYNC_MAX_CONCURRENT", "64"))
+LLM_ASYNC_MAX_QUEUE = int(os.getenv("LLM_ASYNC_MAX_QUEUE", "256"))
+
+# 1ユーザーが同時に待てる数
+LLM_MAX_QUEUE_PER_USER = int(os.getenv("LLM_MAX_QUEUE_PER_USER", "2"))
+
+# 待ち時間の上限（秒）。見込みがこれを超えるなら待たせずに 503 を返す
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "3"))
+
+BUSY_MESSAGE = "現在混み合っています。しばらくしてから再度お試しください。"
+
+
+class Overloaded(Exception):
+    """受け付けられないことを表す。retry_after は再試行までの目安（秒）。"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"overloaded, retry after {retry_after:.1f}s")
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class _Waiter:
+    def __init__(self, user: str, notify):
+        self.user = user
+        self.notify = notify
+        self.granted = False
+
+
+class AdmissionController:
+    """LLM を呼ぶリクエストの同時実行数を制限する。
+
+    空きがなければユーザーごとの待ち行列に入れ、空いたらユーザーを順番に回って1件ずつ通す
+    （1人が大量に送っても他のユーザーが待たされ続けない）。待ち時間の見込みが
+    LLM_QUEUE_TIMEOUT を超える場合や、待っても空かなかった場合は Overloaded を送出する。
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int,
+                 max_queue_per_user: int = LLM_MAX_QUEUE_PER_USER, timeout: float = LLM_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self._queues = OrderedDict()  # user -> deque[_Waiter]（先頭のユーザーから順に通す）
+        self._service_time = 1.0  # 1件の処理時間の移動平均（秒）
+        self._lock = threading.Lock()
+
+    def estimated_wait(self) -> float:
+        """今から並んだ場合の待ち時間の見込み（秒）。"""
+        return (self.queued + 1) * self._service_time / max(1, self.max_concurrent)
+
+    def _try_enter(self, user: str, notify) -> _Waiter | None:
+        """空きがあれば None を返して実行中に数える。なければ待ち行列に入れた _Waiter を返す。"""
+        with self._lock:
+            if self.active < self.max_concurrent and not self.queued:
+                self.active += 1
+                metrics.registry.inc("admission_requests_total", result="admitted")
+                return None
+            queue = self._queues.get(user)
+            wait = self.estimated_wait()
+            if (self.queued >= self.max_queue or wait > self.timeout
+                    or (queue is not None and len(queue) >= self.max_queue_per_user)):
+                metrics.registry.inc("admission_requests_total", result="shed")
+                raise Overloaded(wait)
+            waiter = _Waiter(user, notify)
+            self._queues.setdefault(user, deque()).append(waiter)
+            self.queued += 1
+            metrics.registry.inc("admission_requests_total", result="queued")
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """待つのをやめる。その間に通されていたら False を返す（呼び出し元は実行してよい）。"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            queue = self._queues.get(waiter.user)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.user]
+                self.queued -= 1
+            metrics.registry.inc("admission_requests_total", result="timeout")
+            return True
+
+    def release(self, elapsed: float | None = None):
+        """実行を終えた1件分の枠を、次に順番が来たユーザーの待ち行列の先頭に渡す。"""
+        with self._lock:
+            if elapsed is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * elapsed
+            if not self._queues:
+                self.active -= 1
+                return
+            user, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            # 通したユーザーは最後尾に回す
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue
+            self.queued -= 1
+            waiter.granted = True
+        waiter.notify()
+
+    # 同期版（Flask のスレッドから使う）
+    def acquire(self, user: str) -> float:
+        """実行してよくなるまで待ち、待った秒数を返す。受け付けられなければ Overloaded。"""
+        started = time.monotonic()
+        event = threading.Event()
+        waiter = self._try_enter(user, event.set)
+        if waiter is not None and not event.wait(self.timeout) and self._abandon(waiter):
+            raise Overloaded(self.estimated_wait())
+        return time.monotonic() - started
+
+    # 非同期版（asgi.py から使う）
+    async def acquire_async(self, user: str) -> float:
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        waiter = self._try_enter(user, lambda: loop.call_soon_threadsafe(_resolve, fut))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(waiter):
+                    raise Overloaded(self.estimated_wait())
+            except asyncio.CancelledError:
+                # 通された後に切断されたなら枠を返す
+                if not self._abandon(waiter):
+                    self.release()
+                raise
+        return time.monotonic() - started
+
+    async def run_async(self, user: str, coro):
+        """空きを待ってから coro を実行する。"""
+        try:
+            waited = await self.acquire_async(user)
+        except BaseException:
+            coro.close()
+            raise
+        metrics.registry.observe("admission_wait_seconds", waited)
+        started = time.monotonic()
+        try:
+            return await coro
+        finally:
+            self.release(time.monotonic() - started)
+
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+def busy_response(e: Overloaded) -> Response:
+    """503 と Retry-After を返す。"""
+    return Response(BUSY_MESSAGE, status=503, headers={"Retry-After": str(e.retry_after)})
+
+
+# Flask のルートに同時実行数の制限を付ける
+def limit_concurrency(controller: AdmissionController, when=None):
+    """ビューをデコレートし、when() が真のリクエストだけ controller の枠を取ってから実行する。
+
+    枠はレスポンスを送り終えるまで（ストリーミングなら最後まで）保持する。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if when is not None and not when():
+                return view(*args, **kwargs)
+            user = session.get('user_id') or request.remote_addr or "anonymous"
+            try:
+                waited = controller.acquire(user)
+            except Overloaded as e:
+                return busy_response(e)
+            metrics.registry.observe("admission_wait_seconds", waited)
+            started = time.monotonic()
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                controller.release(time.monotonic() - started)
+                raise
+            response.call_on_close(lambda: controller.release(time.monotonic() - started))
+            return response
+        return wrapper
+    return decorator
+
+
+# LLM を呼ぶルート用の制限（プロセスごと）
+llm_admission = AdmissionController(LLM_MAX_CONCURRENT, LLM_MAX_QUEUE)
+llm_admission_async = AdmissionController(LLM_ASYNC_MAX_CONCURRENT, LLM_ASYNC_MAX_QUEUE)
@@ -1,50 +1,77 @@
 # app.py
 import os
+import hmac
 import uuid
 import logging
-import sys
-import re
 from ipaddress import ip_address, ip_network
-from flask import Flask, request, redirect, render_template, session, url_for
+from flask import Flask, Response, jsonify, request, redirect, render_template, stream_template, session, url_for
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # ルーティング以外の処理は helpers.py に分離
 from helpers import (
-    query_db, execute_db, render_markdown,
-    rag, answer_with_context,
+    query_db, execute_db, render_markdown, memo_html,
+    rag, answer_with_context, answer_with_context_stream, LLMUnavailable,
+    direct_answer, unavailable_answer, answer_preface_html,
+    redact_flags, StreamingMarkdown,
     get_related_memos, _get_tags_for_memo,
-    search_memos_by_tag,
+    load_memo_detail, load_user_page, count_user_memos,
+    search_memos_by_tag, popular_tags, TAG_CLOUD_SIZE,
     generate_tags, attach_tags,
-    save_memo
+    parse_memo_form, create_memo, InvalidMemo,
+    delete_memo, warm_up
 )
+from redis_client import REDIS_URL
+from tag_queue import queue_from_env, enqueue_tag_job
+from commands import register_commands
+from admission import llm_admission, limit_concurrency
+import metrics
+from log_config import setup_logging
+from prefork import PRELOAD_MODULES
+
+# ログ出力の設定（JSON に整形してバックグラウンドのスレッドで書き出す）
+setup_logging()
+logger = logging.getLogger("app")
 
 # Flask アプリ初期化
 app = Flask(__name__)
 app.secret_key = os.getenv("SESSION_SECRET")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
-# レートリミットの設定
+# 計測（/metrics と Server-Timing ヘッダ）
+metrics.init_app(app)
+
+# レートリミットの設定（ベンチマークなどでは RATELIMIT_ENABLED=0 で無効化できる）
+app.config["RATELIMIT_ENABLED"] = os.getenv("RATELIMIT_ENABLED", "1") == "1"
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=[],
-    storage_uri="redis://redis:6379",
+    storage_uri=REDIS_URL,
 )
+# タグ生成ジョブのキュー（None なら同期でタグ付けする）
+tag_queue = queue_from_env()
+
 TRUSTED_NETWORKS = [
     ip_network("172.16.0.0/12")  # docker-compose
 ]
 @limiter.request_filter
 def ip_whitelist():
     # docker-compose のネットワーク内からのアクセスはレートリミットを適用しない
-    ip = get_remote_address()
+    return is_trusted_address(get_remote_address())
+
+def is_trusted_address(ip):
+    """レートリミットを適用しないアドレスかどうかを返す（asgi.py と共有する）。"""
     try:
         ip_obj = ip_address(ip)
     except ValueError:
         return False # 無効なIPアドレスはホワイトリストにしない
     return any(ip_obj in net for net in TRUSTED_NETWORKS)
 
+# RAG 検索のレートリミット（asgi.py と共有する）
+SEARCH_RATE_LIMIT = "5 per minute"
+
 # ログイン or ユーザーページへリダイレクト
 @app.route('/')
 def index():
@@ -105,37 +132,29 @@ def user_page(uid):
     """対象ユーザーのメモ一覧を表示する。本人は非公開メモの情報も見られる。"""
     current = session.get('user_id')
 
-    user = query_db("SELECT username FROM users WHERE id=%s", (uid,), fetchone=True)
-    if not user:
+    page = load_user_page(uid, current, cursor=request.args.get('after'))
+    if not page:
         return "User not found. <a href='/register'>Register</a> or <a href='/login'>Login</a>", 404
 
-    if current == uid:
-        sql = """
-            SELECT id, body, visibility FROM memos WHERE user_id=%s AND visibility IN ('public','private')
-            UNION 
-            SELECT id, '🔒秘密メモ' AS body, 'secret' AS visibility FROM memos WHERE user_id=%s AND visibility='secret'
-        """
-        memos = query_db(sql, (uid, uid))
-    else:
-        memos = query_db("SELECT id, body, visibility FROM memos WHERE user_id=%s AND visibility='public'", (uid,))
-    
-    return render_template('index.html', memos=memos, username=user["username"], user_id=uid)
+    return render_template(
+        'index.html', memos=page["memos"], username=page["username"], user_id=uid,
+        next_cursor=page["next_cursor"]
+    )
 
 # メモ詳細
 @app.route('/memo/<mid>', methods=['GET', 'POST'])
 def memo_detail(mid):
     """メモの詳細を表示する。秘密メモはパスワードを確認する。"""
     uid = session.get('user_id')
-    memo = query_db(
-        'SELECT id, user_id, body, visibility, password, created_at '
-        'FROM memos WHERE id=%s',
-        (mid,), fetchone=True
-    )
+    memo = load_memo_detail(mid)
     if not memo:
         return 'Not found', 404
     if memo['user_id'] != uid:
         return 'Forbidden', 403
 
+    tags = memo['tags']
+    tags_pending = not tags and tag_queue is not None and tag_queue.is_pending(mid)
+
     # 秘密メモのアクセス処理
     if memo['visibility'] == 'secret':
         if request.method == 'POST' and request.form.get('password') == memo.get('password'):
@@ -143,14 +162,14 @@ def memo_detail(mid):
             return render_template(
                 'detail.html',
                 memo=memo, authorized=True,
-                related=related, tags=_get_tags_for_memo(mid),
-                memo_html=render_markdown(memo['body'])
+                related=related, tags=tags, tags_pending=tags_pending,
+                memo_html=memo_html(memo)
             )
         if request.method == 'GET':
             return render_template(
                 'detail.html',
                 memo=memo, authorized=False,
-                related=[], tags=_get_tags_for_memo(mid)
+                related=[], tags=tags
             )
         return ('Wrong password', 403)
 
@@ -159,12 +178,14 @@ def memo_detail(mid):
     return render_template(
         'detail.html',
         memo=memo, authorized=True,
-        related=related, tags=_get_tags_for_memo(mid),
-        memo_html=render_markdown(memo['body'])
+        related=related, tags=tags, tags_pending=tags_pending,
+        memo_html=memo_html(memo)
     )
 
-# メモ作成
+# メモ作成（同期でタグを生成するときだけ LLM の同時実行数の制限を受ける）
 @app.route('/memo/create', methods=['GET', 'POST'])
+@limit_concurrency(llm_admission, when=lambda: (
+    request.method == 'POST' and request.form.get('enable_tags') == 'on' and tag_queue is None))
 def memo_create():
     """メモの作成フォーム表示と作成処理を行う。"""
     uid = session.get('user_id')
@@ -172,31 +193,22 @@ def memo_create():
         return redirect('/')
 
     if request.method == 'POST':
-        # ユーザーの既存メモ数を確認
-        memo_count = query_db("SELECT COUNT(*) AS count FROM memos WHERE user_id=%s",
-                              (uid,), fetchone=True)['count']
-        if memo_count >= 5:
-            return "メモは5つまでしか作成できません。", 403
-
-        # 入力値の取得と検証
-        body = request.form.get('body', '')
-        if len(body) > 300:
-            return "メモは300字以下で入力してください。", 400
-
-        visibility = request.form.get('visibility', 'public')
-        password = request.form.get('password', '') if visibility == 'secret' else None
-        generate_tags_flag = request.form.get('enable_tags') == 'on'
-
-        # メモの登録
-        mid = str(uuid.uuid4())
+        # 既存メモ数と入力値の検証（asgi.memo_create と共有する）
+        try:
+            memo = parse_memo_form(request.form, count_user_memos(uid))
+        except InvalidMemo as e:
+            return str(e), e.status
 
         # メモの保存
-        save_memo(mid, uid, body, visibility, password)
+        mid = create_memo(uid, memo)
 
-        # タグ生成と紐付け
-        if generate_tags_flag:
-            tags = generate_tags(body)
-            attach_tags(mid, tags)
+        # タグ生成と紐付け（キューがあればワーカーに任せてすぐに返す）
+        if memo["enable_tags"]:
+            if tag_queue is not None:
+                enqueue_tag_job(tag_queue, mid, uid, memo["body"])
+            else:
+                tags = generate_tags(memo["body"])
+                attach_tags(mid, tags)
 
         return redirect(f'/memo/{mid}')
 
@@ -215,7 +227,7 @@ def memo_delete(mid):
     if memo['user_id'] != uid:
         return 'Forbidden', 403
 
-    execute_db('DELETE FROM memos WHERE id=%s', (mid,))
+    delete_memo(mid)
     return redirect(f"/users/{uid}")
 
 # タグ検索
@@ -228,17 +240,27 @@ def search_by_tag():
 
     tag_name = request.args.get('name', '').strip()
     if not tag_name:
-        return render_template('tag_search.html', tag_name='', memos=[])
+        return render_template('tag_search.html', tag_name='', memos=[], popular=popular_tags())
+
+    page = search_memos_by_tag(tag_name, cursor=request.args.get('after'))
+    return render_template('tag_search.html', tag_name=tag_name, memos=page["memos"],
+                           next_cursor=page["next_cursor"])
 
-    memos = search_memos_by_tag(tag_name)
-    return render_template('tag_search.html', tag_name=tag_name, memos=memos)
+# タグクラウド
+@app.route('/tags')
+def tag_cloud():
+    """よく使われているタグと（秘密メモを除く）メモ数を JSON で返す。"""
+    if not session.get('user_id'):
+        return redirect(url_for('login'))
+    limit = min(max(request.args.get('limit', TAG_CLOUD_SIZE, type=int), 1), 100)
+    return jsonify(tags=popular_tags(limit))
 
 # RAG 検索フォーム
 @app.route('/memo/search', methods=['GET'])
 def search_form():
     """RAG 検索フォームを表示する。"""
-    logging.info(f"RAG search form accessed from {request.remote_addr}")
-    logging.info(f"{get_remote_address()}")
+    logger.info("RAG search form accessed",
+                extra={"remote_addr": request.remote_addr, "rate_limit_key": get_remote_address()})
     uid = session.get('user_id')
     if not uid:
         return redirect('/')
@@ -246,9 +268,13 @@ def search_form():
     other_uid = request.args.get('user_id', '')
     return render_template('search.html', answer=None, query=q, other_user_id=other_uid)
 
+# 検索結果をストリーミングで返すか（フォームの stream=1 でも個別に有効化できる）
+SEARCH_STREAMING = os.getenv("SEARCH_STREAMING", "0") == "1"
+
 # RAG 検索実行
 @app.route('/memo/search', methods=['POST'])
-@limiter.limit("5 per minute")
+@limiter.limit(SEARCH_RATE_LIMIT)
+@limit_concurrency(llm_admission)
 def search():
     """RAG でメモを検索し、回答を生成して表示する。"""
     uid = session.get('user_id')
@@ -258,32 +284,78 @@ def search():
     query = request.form.get('query') or request.args.get('q', '')
     other_user_id = request.form.get('user_id') or request.args.get('user_id', '') or None
 
+    if SEARCH_STREAMING or (request.form.get('stream') or request.args.get('stream')) == '1':
+        # ページの先頭をすぐに返し、回答は生成されたブロックから順に送る
+        chunks = _stream_search_answer(query, uid, other_user_id)
+        return Response(
+            stream_template('search.html', answer_stream=chunks, query=query, other_user_id=other_user_id or ''),
+            headers={'X-Accel-Buffering': 'no'}
+        )
+
     memos = rag(query, uid, other_user_id=other_user_id)
-    logging.info(f"RAG memos: {memos}")
-
-    if not (memos and isinstance(memos, list)):
-        answer = "関連するメモが見つかりませんでした。"
-    else:
-        if 'user_id' in memos[0]:
-            # 投稿者情報を返すケース
-            answer = f"User ID: {memos[0]['user_id']}"
-        else:
-            # コンテキストを元に回答を作成
+    logger.info("RAG memos", extra={"memos": memos})
+
+    answer = direct_answer(memos)
+    if answer is None:
+        # コンテキストを元に回答を作成（LLM が使えなければ回答なしで返す）
+        try:
             answer = answer_with_context(query, memos)
-            logging.info(f"RAG answer: {answer}")
+        except LLMUnavailable as e:
+            answer = unavailable_answer(memos, e)
+        logger.info("RAG answer", extra={"answer": answer})
 
-            # flag の形式にマッチする場合は伏字にする
-            answer = re.sub(r'flag\{[^\}]+\}', 'flag{****}', answer, flags=re.IGNORECASE)
+        # flag の形式にマッチする場合は伏字にする
+        answer = redact_flags(answer)
 
     # Markdown 表示用に HTML へ変換
     answer_html = render_markdown(answer)
     return render_template('search.html', answer_html=answer_html, query=query, other_user_id=other_user_id or '')
 
-# ログ出力の設定
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+def _stream_search_answer(query, uid, other_user_id):
+    """search() のストリーミング版。検索結果の件数を先に送り、回答の HTML をブロックごとに返す。"""
+    memos = rag(query, uid, other_user_id=other_user_id)
+    logger.info("RAG memos", extra={"memos": memos})
+
+    answer = direct_answer(memos)
+    if answer is not None:
+        yield render_markdown(answer)
+        return
+
+    yield answer_preface_html(memos)
+    # 伏字化と Markdown 変換はチャンク境界をまたいでも安全なブロック単位で行う
+    renderer = StreamingMarkdown()
+    try:
+        for delta in answer_with_context_stream(query, memos):
+            html = renderer.feed(delta)
+            if html:
+                yield html
+    except LLMUnavailable as e:
+        renderer.feed("\n\n" + unavailable_answer(memos, e))
+    yield renderer.finish()
+
+# /metrics を読めるトークン（空なら TRUSTED_NETWORKS からのアクセスだけ許す）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+def _metrics_allowed() -> bool:
+    """docker-compose のネットワーク内か、Authorization: Bearer <METRICS_TOKEN> 付きなら True。"""
+    if is_trusted_address(request.remote_addr):
+        return True
+    auth = request.headers.get("Authorization", "")
+    return bool(METRICS_TOKEN) and hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode())
+
+# Prometheus 形式のメトリクス（全ワーカーの合算）
+@app.route('/metrics')
+def metrics_endpoint():
+    """計測結果を Prometheus のテキスト形式で返す。内部のネットワークかトークン付きのときだけ返す。"""
+    if not _metrics_allowed():
+        return 'Forbidden', 403
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+# 管理用コマンド（flask --app app <command>）
+register_commands(app)
+
+# uWSGI のマスターで重いモジュールを読み込んでおき、fork したワーカーで共有する
+if PRELOAD_MODULES:
+    warm_up()
 
 __all__ = ["app"]
\ No newline at end of file
@@ -0,0 +1,314 @@
+# asgi.py
+"""uvicorn で動かす ASGI のエントリポイント。
+
+LLM の応答を待つルート（POST /memo/search と POST /memo/create）は asyncio で処理し、
+1ワーカーで多数の LLM 呼び出しを同時に待てるようにする。それ以外のルートは
+既存の Flask アプリ（WSGI）をスレッドプールでそのまま動かす。
+
+    uvicorn asgi:app --host 0.0.0.0 --port 33456 --workers 4
+"""
+import os
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from flask import render_template
+from flask.sessions import SecureCookieSession
+from itsdangerous import BadSignature
+from flask_limiter.util import get_qualified_name
+from werkzeug.http import parse_cookie, dump_cookie
+
+import metrics
+from admission import llm_admission_async, Overloaded, BUSY_MESSAGE
+from app import (
+    app as flask_app, limiter, tag_queue, is_trusted_address,
+    SEARCH_STREAMING, SEARCH_RATE_LIMIT,
+)
+from helpers import (
+    render_markdown, redact_flags, StreamingMarkdown, attach_tags,
+    parse_memo_form, create_memo, InvalidMemo, direct_answer, unavailable_answer, answer_preface_html,
+    LLMUnavailable, read_your_writes_deadline, read_from_primary_until,
+)
+from async_helpers import (
+    count_user_memos_async, close_pool, rag_async,
+    answer_with_context_async, answer_with_context_stream_async, generate_tags_async,
+)
+from tag_queue import enqueue_tag_job
+
+logger = logging.getLogger(__name__)
+
+# Flask のルートを動かすスレッド数（uWSGI の threads に相当する）
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+
+# フォームの本文の上限（バイト）
+MAX_FORM_BYTES = 64 * 1024
+
+# ストリーミング時にテンプレートを前後に分ける目印
+_STREAM_MARKER = "<!--answer-stream-->"
+
+# Flask-Limiter が app.search に付けた制限（WSGI 版と同じバケットを数えるのに使う）
+_search_limits = limiter.limit_manager.decorated_limits(get_qualified_name(flask_app.view_functions["search"]))
+_wsgi_app = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+
+class Request:
+    """ASGI の scope と本文から、ルートが使う値を取り出したもの。"""
+
+    def __init__(self, scope, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        self.args = _parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.form = _parse_qs(body.decode("utf-8", "replace"))
+        self.session = _load_session(self.headers.get("cookie", ""))
+        # ProxyFix(x_for=1) と同じく、X-Forwarded-For の末尾をクライアントのアドレスとする
+        forwarded = self.headers.get("x-forwarded-for")
+        client = scope.get("client") or ("",)
+        self.remote_addr = forwarded.split(",")[-1].strip() if forwarded else client[0]
+
+
+def _parse_qs(qs: str) -> dict:
+    return {k: v[0] for k, v in parse_qs(qs, keep_blank_values=True).items()}
+
+
+def _load_session(cookie_header: str) -> dict:
+    """Flask のセッション Cookie を検証して中身を返す。不正または無ければ空の dict。"""
+    value = parse_cookie(cookie_header).get(flask_app.config["SESSION_COOKIE_NAME"])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if not value or serializer is None:
+        return {}
+    try:
+        max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        return serializer.loads(value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def _session_cookie(data: dict) -> str:
+    """data を Flask と同じ署名・属性のセッション Cookie にした Set-Cookie の値を返す。"""
+    interface = flask_app.session_interface
+    session = SecureCookieSession(data)
+    return dump_cookie(
+        flask_app.config["SESSION_COOKIE_NAME"],
+        interface.get_signing_serializer(flask_app).dumps(dict(session)),
+        expires=interface.get_expiration_time(flask_app, session),
+        path=interface.get_cookie_path(flask_app),
+        domain=interface.get_cookie_domain(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=interface.get_cookie_samesite(flask_app),
+    )
+
+
+def _render(name: str, **context) -> str:
+    with flask_app.app_context():
+        return render_template(name, **context)
+
+
+async def _read_body(receive) -> bytes | None:
+    """リクエスト本文を読み切る。MAX_FORM_BYTES を超えたら None を返す。"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_FORM_BYTES:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def _start(send, status: int, headers=()):
+    await send({
+        "type": "http.response.start", "status": status,
+        "headers": [(b"content-type", b"text/html; charset=utf-8"),
+                    *((k.encode("latin-1"), v.encode("latin-1")) for k, v in headers)],
+    })
+
+
+async def _respond(send, status: int, text: str = "", headers=()) -> int:
+    await _start(send, status, headers)
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+    return status
+
+
+async def _redirect(send, location: str, headers=()) -> int:
+    return await _respond(send, 302, "", [("location", location), *headers])
+
+
+async def _rate_limited(req: Request) -> bool:
+    """/memo/search の WSGI 版と同じバケットでレートリミットを数え、超えていれば True。"""
+    if not flask_app.config["RATELIMIT_ENABLED"] or is_trusted_address(req.remote_addr):
+        return False
+    # Flask-Limiter と同じく ([キーの接頭辞,] クライアントのアドレス, Limit.scope_for(エンドポイント名)) をキーにする
+    prefix = flask_app.config.get("RATELIMIT_KEY_PREFIX", "")
+    for lim in _search_limits:
+        if lim.is_exempt or (lim.methods is not None and req.method.lower() not in lim.methods):
+            continue
+        args = [*([prefix] if prefix else []), req.remote_addr, lim.scope_for("search", req.method)]
+        if not await asyncio.to_thread(limiter.limiter.hit, lim.limit, *args, cost=lim.cost):
+            return True
+    return False
+
+
+# RAG 検索実行（非同期版）
+async def search(req: Request, send):
+    """app.search と同じ処理を、LLM と DB の待ち時間にスレッドを使わずに行う。"""
+    if await _rate_limited(req):
+        return await _respond(send, 429, f"Too Many Requests: {SEARCH_RATE_LIMIT}")
+    uid = req.session.get("user_id")
+    if not uid:
+        return await _redirect(send, "/")
+    return await _admit(uid, send, _search(req, send, uid))
+
+
+async def _search(req: Request, send, uid: str):
+    query = req.form.get("query") or req.args.get("q", "")
+    other_user_id = req.form.get("user_id") or req.args.get("user_id", "") or None
+
+    if SEARCH_STREAMING or (req.form.get("stream") or req.args.get("stream")) == "1":
+        # ページの先頭をすぐに返し、回答は生成されたブロックから順に送る
+        page = _render("search.html", answer_stream=[_STREAM_MARKER], query=query,
+                       other_user_id=other_user_id or "")
+        head, tail = page.split(_STREAM_MARKER, 1)
+        await _start(send, 200, [("x-accel-buffering", "no")])
+        await send({"type": "http.response.body", "body": head.encode("utf-8"), "more_body": True})
+        async for chunk in _stream_search_answer(query, uid, other_user_id):
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": tail.encode("utf-8")})
+        return 200
+
+    memos = await rag_async(query, uid, current_uid=uid, other_user_id=other_user_id)
+    logger.info("RAG memos", extra={"memos": memos})
+
+    answer = direct_answer(memos)
+    if answer is None:
+        # コンテキストを元に回答を作成し、flag の形式にマッチする場合は伏字にする
+        try:
+            answer = await answer_with_context_async(query, memos)
+        except LLMUnavailable as e:
+            answer = unavailable_answer(memos, e)
+        logger.info("RAG answer", extra={"answer": answer})
+        answer = redact_flags(answer)
+
+    page = _render("search.html", answer_html=render_markdown(answer), query=query,
+                   other_user_id=other_user_id or "")
+    return await _respond(send, 200, page)
+
+
+async def _stream_search_answer(query, uid, other_user_id):
+    """app._stream_search_answer の非同期版。"""
+    memos = await rag_async(query, uid, current_uid=uid, other_user_id=other_user_id)
+    logger.info("RAG memos", extra={"memos": memos})
+
+    answer = direct_answer(memos)
+    if answer is not None:
+        yield render_markdown(answer)
+        return
+
+    yield answer_preface_html(memos)
+    renderer = StreamingMarkdown()
+    try:
+        async for delta in answer_with_context_stream_async(query, memos):
+            html = renderer.feed(delta)
+            if html:
+                yield html
+    except LLMUnavailable as e:
+        renderer.feed("\n\n" + unavailable_answer(memos, e))
+    yield renderer.finish()
+
+
+# メモ作成（非同期版）
+async def memo_create(req: Request, send):
+    """app.memo_create の POST と同じ処理。同期でタグ付けする場合も LLM をスレッドなしで待つ。"""
+    uid = req.session.get("user_id")
+    if not uid:
+        return await _redirect(send, "/")
+
+    # 入力値の検証と保存は app.memo_create と共有する
+    try:
+        memo = parse_memo_form(req.form, await count_user_memos_async(uid))
+    except InvalidMemo as e:
+        return await _respond(send, e.status, str(e))
+
+    # 保存は類似メモの更新を含むトランザクションなので、同期版をスレッドで実行する
+    mid = await asyncio.to_thread(create_memo, uid, memo)
+
+    if memo["enable_tags"]:
+        if tag_queue is not None:
+            await asyncio.to_thread(enqueue_tag_job, tag_queue, mid, uid, memo["body"])
+        else:
+            tags = await _admit_or_none(uid, generate_tags_async(memo["body"]))
+            await asyncio.to_thread(attach_tags, mid, tags or [])
+
+    # 書き込みはスレッド側で記録されるので、リダイレクト先を primary から読ませる期限をセッションに入れる
+    headers = []
+    until = read_your_writes_deadline()
+    if until is not None:
+        headers.append(("set-cookie", _session_cookie({**req.session, "primary_until": until})))
+    return await _redirect(send, f"/memo/{mid}", headers)
+
+
+async def _admit(uid: str, send, coro):
+    """LLM を呼ぶ処理を同時実行数の制限の枠内で実行する。混んでいれば 503 を返す。"""
+    try:
+        return await llm_admission_async.run_async(uid, coro)
+    except Overloaded as e:
+        return await _respond(send, 503, BUSY_MESSAGE, [("retry-after", str(e.retry_after))])
+
+
+async def _admit_or_none(uid: str, coro):
+    """_admit と同じだが、混んでいれば実行せずに None を返す（タグなしで保存を続ける）。"""
+    try:
+        return await llm_admission_async.run_async(uid, coro)
+    except Overloaded:
+        return None
+
+
+ROUTES = {
+    ("POST", "/memo/search"): ("search", search),
+    ("POST", "/memo/create"): ("memo_create", memo_create),
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# ASGI アプリ本体
+async def app(scope, receive, send):
+    """非同期版のルートを処理し、それ以外は Flask アプリに渡す。"""
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    route = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if route is None:
+        return await _wsgi_app(scope, receive, send)
+
+    endpoint, handler = route
+    started = time.perf_counter()
+    status = 500
+    try:
+        body = await _read_body(receive)
+        if body is None:
+            status = await _respond(send, 413, "Request Entity Too Large")
+            return
+        req = Request(scope, body)
+        # 書き込み直後のセッションなら、このリクエストの読み取りも primary に送る（app の query_db と同じ）
+        read_from_primary_until(req.session.get("primary_until", 0.0))
+        status = await handler(req, send)
+    except Exception:
+        logger.exception(f"Exception on {scope['path']} [{scope['method']}]")
+        raise
+    finally:
+        metrics.registry.observe("http_request_seconds", time.perf_counter() - started,
+                                 endpoint=endpoint, method=scope["method"], status=str(status))
+        metrics.registry.start_flusher()
+        metrics.registry.flush()
@@ -0,0 +1,270 @@
+# async_helpers.py
+import os
+import time
+import asyncio
+import logging
+
+import aiomysql
+import pymysql
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+
+import metrics
+from prefork import post_fork
+from llm_guard import llm_guard, LLMUnavailable, LLM_DEADLINE
+from helpers import (
+    llm_cache, llm_flight, memo_snapshots, SEARCH_MEMOS_LIMIT, RAG_MODE, RAG_TOOL_TIMEOUT,
+    search_memos_local, _search_memos_query, _AUTHOR_BY_BODY_SQL, _author_result,
+    _MEMO_COUNT_SQL, _MEMO_VERSION_SQL, _replicas, _reads_from_primary, MYSQL_REPLICA_CONNECT_TIMEOUT,
+    _rag_tool_params, _plan_tool_calls, _merge_tool_results,
+    _answer_params, _assembled_completion, _tag_params, _parse_tags,
+)
+
+logger = logging.getLogger(__name__)
+
+# 非同期版の OpenAI クライアント（1プロセスで数百件の呼び出しを同時に待てる。使うときに作る）
+_openai_client = None
+
+# aiomysql のコネクションプールの上限（イベントループごと）
+ASYNC_MYSQL_POOL_SIZE = int(os.getenv("ASYNC_MYSQL_POOL_SIZE", "10"))
+
+# プール内の接続を作り直すまでの秒数（MySQL の wait_timeout より短くする）
+ASYNC_MYSQL_POOL_RECYCLE = int(os.getenv("ASYNC_MYSQL_POOL_RECYCLE", "300"))
+
+_pools = {}  # 接続先（primary は None、レプリカは MYSQL_REPLICA_HOSTS の要素）-> aiomysql.Pool
+_pool_loop = None
+_pool_lock = None
+
+# 非同期版の OpenAI クライアントを取得
+def get_async_openai_client() -> AsyncOpenAI:
+    """プロセスごとに1つの AsyncOpenAI クライアントを遅延生成して返す（fork 後は作り直す）。"""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI()
+    return _openai_client
+
+# fork 後に親プロセスのクライアントを手放す
+@post_fork
+def _reset_client():
+    """AsyncOpenAI クライアントを子プロセスで作り直させる。"""
+    global _openai_client
+    _openai_client = None
+
+# イベントループ用のコネクションプールを返す
+async def get_pool(replica: str | None = None) -> aiomysql.Pool:
+    """実行中のイベントループに紐づく aiomysql のプールを返す。replica を渡すとそのレプリカのプール。初回に作成する。"""
+    global _pools, _pool_loop, _pool_lock
+    loop = asyncio.get_running_loop()
+    if _pool_loop is loop and replica in _pools:
+        return _pools[replica]
+    if _pool_loop is not loop:
+        _pools, _pool_loop, _pool_lock = {}, loop, asyncio.Lock()
+    async with _pool_lock:
+        if replica not in _pools:
+            host, _, port = (replica or "").partition(":")
+            _pools[replica] = await aiomysql.create_pool(
+                host=host or os.getenv("MYSQL_HOST"),
+                port=int(port or os.getenv("MYSQL_PORT", "3306")),
+                connect_timeout=MYSQL_REPLICA_CONNECT_TIMEOUT if replica else None,
+                user=os.getenv("MYSQL_USER"),
+                password=os.getenv("MYSQL_PASSWORD"),
+                db=os.getenv("MYSQL_DATABASE"),
+                charset='utf8mb4',
+                autocommit=True,
+                minsize=0,
+                maxsize=ASYNC_MYSQL_POOL_SIZE,
+                pool_recycle=ASYNC_MYSQL_POOL_RECYCLE,
+            )
+    return _pools[replica]
+
+# プールを閉じる
+async def close_pool():
+    """ASGI アプリの終了時に呼ぶ。"""
+    global _pools
+    pools, _pools = _pools, {}
+    for pool in pools.values():
+        pool.close()
+        await pool.wait_closed()
+
+# SELECT 用の簡易クエリ実行（非同期版）
+async def query_db_async(sql, args=(), fetchone=False):
+    """query_db と同じく SELECT を実行し、1件または複数件の結果を返す。
+
+    レプリカの選び方・書き込み直後に primary から読む条件・エラー時のやり直しも query_db と同じ。
+    """
+    if not _reads_from_primary():
+        try:
+            with _replicas.lease() as name:
+                if name is not None:
+                    result = await _select_async(await get_pool(name), sql, args, fetchone)
+                    metrics.registry.inc("db_reads_total", target="replica")
+                    return result
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            logger.warning(f"replica read failed, retrying on primary: {e}")
+            metrics.registry.inc("db_reads_total", target="fallback")
+    metrics.registry.inc("db_reads_total", target="primary")
+    return await _select_async(await get_pool(), sql, args, fetchone)
+
+async def _select_async(pool, sql, args, fetchone):
+    async with pool.acquire() as con:
+        async with con.cursor(aiomysql.DictCursor) as cur:
+            with metrics.span("db_query_seconds", "db", fingerprint=metrics.fingerprint(sql)) as sp:
+                await cur.execute(sql, args)
+                result = await (cur.fetchone() if fetchone else cur.fetchall())
+                sp.rows = cur.rowcount
+            return result
+
+# LLM を呼び出す（非同期版）
+async def chat_completion_async(**params) -> ChatCompletion:
+    """_chat_completion と同じキャッシュを使って chat.completions.create を呼ぶ。"""
+    key = llm_cache.make_key(params)
+    cached = None
+    if llm_cache.enabled:
+        # Redis のキャッシュはブロッキングなのでスレッドで読む
+        cached = await asyncio.to_thread(llm_cache.get, key)
+        metrics.registry.inc("llm_cache_requests_total", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        return ChatCompletion.model_validate_json(cached)
+    # 同じリクエストが実行中ならその応答を待って共有する
+    raw = await llm_flight.do_async(key, lambda: _create_completion_async(key, params))
+    return ChatCompletion.model_validate_json(raw)
+
+async def _create_completion_async(key: str, params: dict) -> str:
+    """chat.completions.create を呼び、応答をキャッシュして JSON 文字列で返す。"""
+    started = time.perf_counter()
+    response = await llm_guard.create_async(get_async_openai_client(), **params)
+    metrics.record_llm(params.get("model", ""), time.perf_counter() - started, response.usage)
+    raw = response.model_dump_json()
+    if llm_cache.enabled:
+        await asyncio.to_thread(llm_cache.set, key, raw)
+    return raw
+
+# ユーザーのメモ数を数える（非同期版）
+async def count_user_memos_async(uid: str) -> int:
+    """count_user_memos と同じキャッシュを使ってメモ数を返す。ユーザーがいなければ 0。"""
+    if memo_snapshots.enabled:
+        row = await query_db_async(_MEMO_VERSION_SQL, (uid,), fetchone=True)
+        if row is None:
+            return 0
+        # Redis のキャッシュはブロッキングなのでスレッドで読む
+        count = await asyncio.to_thread(memo_snapshots.get, uid, row["memo_version"], "count")
+        metrics.registry.inc("memo_snapshot_requests_total", result="hit" if count is not None else "miss")
+        if count is not None:
+            return count
+    row = await query_db_async(_MEMO_COUNT_SQL, (uid,), fetchone=True)
+    if row is None:
+        return 0
+    await asyncio.to_thread(memo_snapshots.set, uid, row["memo_version"], "count", row["count"])
+    return row["count"]
+
+# 指定ユーザーのメモを検索（非同期版）
+async def search_memos_async(keyword: str, include_secret: bool, target_uid: str, current_uid: str | None,
+                             limit: int | None = SEARCH_MEMOS_LIMIT) -> list[dict]:
+    """search_memos と同じ条件で検索する。セッションを参照しないので current_uid は必須。"""
+    if not target_uid:
+        return []
+    sql, args = _search_memos_query(keyword, include_secret, target_uid, limit, current_uid)
+    return list(await query_db_async(sql, args))
+
+# 本文から投稿者を特定（非同期版）
+async def get_author_by_body_async(keyword: str) -> list:
+    """get_author_by_body の非同期版。"""
+    row = await query_db_async(_AUTHOR_BY_BODY_SQL, (f"%{keyword}%",), fetchone=True)
+    return _author_result(row)
+
+# RAG（非同期版）
+async def rag_async(query: str, user_id: str, current_uid: str | None,
+                    other_user_id: str | None = None, mode: str | None = None) -> list:
+    """rag() の非同期版。ツール呼び出しは asyncio.gather で並行に実行する。"""
+    if (mode or RAG_MODE) == 'local':
+        return await _rag_local_async(query, user_id, other_user_id, current_uid)
+
+    try:
+        response = await chat_completion_async(**_rag_tool_params(query, user_id))
+    except LLMUnavailable as e:
+        # ツールを選べないときはローカル索引の検索に切り替える
+        logger.warning(f"RAG falling back to local search: {e}")
+        metrics.registry.inc("llm_degraded_total", stage="rag")
+        return await _rag_local_async(query, user_id, other_user_id, current_uid)
+    choice = response.choices[0]
+    logger.info("RAG tool calls", extra={"tool_calls": choice.message.tool_calls})
+
+    calls = []
+    for name, args in _plan_tool_calls(choice.message.tool_calls, user_id, other_user_id):
+        if name == 'search_memos':
+            calls.append(search_memos_async(*args, current_uid=current_uid))
+        else:
+            calls.append(get_author_by_body_async(*args))
+    return _merge_tool_results(await _gather_tools(calls))
+
+async def _rag_local_async(query: str, user_id: str, other_user_id: str | None, current_uid: str | None) -> list:
+    """ローカル索引で検索する。索引の検索は CPU 処理なのでスレッドで行う。"""
+    calls = [asyncio.to_thread(search_memos_local, query, False, uid, current_uid=current_uid)
+             for uid in (user_id, other_user_id) if uid]
+    memos = _merge_tool_results(await _gather_tools(calls))
+    logger.info("RAG local memos", extra={"memos": memos})
+    return memos
+
+async def _gather_tools(calls: list) -> list[list]:
+    """ツールを並行に実行する。RAG_TOOL_TIMEOUT 秒を過ぎたものや失敗したものは空の結果にする。"""
+    results = await asyncio.gather(
+        *(asyncio.wait_for(c, RAG_TOOL_TIMEOUT) for c in calls), return_exceptions=True
+    )
+    for r in results:
+        if isinstance(r, BaseException):
+            logger.warning(f"RAG tool failed: {r!r}")
+    return [[] if isinstance(r, BaseException) else r for r in results]
+
+# メモを文脈にして回答を作成（非同期版）
+async def answer_with_context_async(query: str, memos: list) -> str:
+    """answer_with_context の非同期版。"""
+    response = await chat_completion_async(**_answer_params(query, memos))
+    return response.choices[0].message.content.strip()
+
+# メモを文脈にして回答をストリーミング生成（非同期版）
+async def answer_with_context_stream_async(query: str, memos: list):
+    """answer_with_context_stream の非同期版。差分テキストを順に返す非同期ジェネレータ。"""
+    params = _answer_params(query, memos)
+    key = llm_cache.make_key(params)
+    cached = await asyncio.to_thread(llm_cache.get, key) if llm_cache.enabled else None
+    if cached is not None:
+        yield ChatCompletion.model_validate_json(cached).choices[0].message.content.strip()
+        return
+    parts, last = [], None
+    started = time.perf_counter()
+    with llm_guard.guarded() as deadline:
+        stream = await asyncio.wait_for(
+            get_async_openai_client().with_options(timeout=LLM_DEADLINE).chat.completions.create(
+                **params, stream=True, stream_options={"include_usage": True}),
+            deadline.remaining())
+        chunks = stream.__aiter__()
+        try:
+            while True:
+                # 次のチャンクも全体の期限までしか待たない
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline.remaining())
+                except StopAsyncIteration:
+                    break
+                last = chunk
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            await stream.close()
+    if last is not None:
+        metrics.record_llm(params["model"], time.perf_counter() - started, getattr(last, "usage", None))
+        if llm_cache.enabled:
+            await asyncio.to_thread(llm_cache.set, key, _assembled_completion(last, parts))
+
+# LLM でタグを生成（非同期版）
+async def generate_tags_async(body: str) -> list[str]:
+    """generate_tags の非同期版。失敗時は空配列を返す。"""
+    try:
+        resp = await chat_completion_async(**_tag_params(body))
+        return _parse_tags(resp.choices[0].message.content.strip(), body)
+    except Exception as e:
+        logger.warning(f"tagging failed: {e}")
+        return []
@@ -0,0 +1,71 @@
+# commands.py
+import time
+
+import click
+
+from helpers import rerender_memos, rebuild_related_memos, rebuild_tag_counts, import_memos, export_memos
+
+
+# 管理用コマンドを登録する
+def register_commands(app):
+    """flask --app app <command> で実行する管理用コマンドをアプリに登録する。"""
+
+    @app.cli.command("rerender-memos")
+    @click.option("--batch-size", default=500, show_default=True, help="1トランザクションで処理するメモ数")
+    @click.option("--force", is_flag=True, help="最新の HTML も含めてすべて描画し直す")
+    def rerender_memos_command(batch_size, force):
+        """保存済みのメモ HTML を現在のサニタイズ設定で描画し直す。"""
+        started = time.monotonic()
+        scanned = updated = 0
+        for n_scanned, n_updated in rerender_memos(batch_size=batch_size, force=force):
+            scanned += n_scanned
+            updated += n_updated
+            click.echo(f"scanned={scanned} updated={updated}", err=True)
+        click.echo(f"done: scanned={scanned} updated={updated} in {time.monotonic() - started:.1f}s")
+
+    @app.cli.command("rebuild-related")
+    @click.option("--batch-size", default=500, show_default=True, help="進捗を表示する間隔（メモ数）")
+    def rebuild_related_command(batch_size):
+        """全メモの類似メモ一覧（memo_related）を計算し直す。"""
+        started = time.monotonic()
+        done = 0
+        for n in rebuild_related_memos(batch_size=batch_size):
+            done += n
+            click.echo(f"rebuilt={done}", err=True)
+        click.echo(f"done: rebuilt={done} in {time.monotonic() - started:.1f}s")
+
+    @app.cli.command("rebuild-tag-counts")
+    def rebuild_tag_counts_command():
+        """タグごとのメモ数（tag_counts）を memo_tags から数え直す。"""
+        started = time.monotonic()
+        n = rebuild_tag_counts()
+        click.echo(f"done: tags={n} in {time.monotonic() - started:.1f}s")
+
+    @app.cli.command("export-memos")
+    @click.argument("output", type=click.File("w", encoding="utf-8"))
+    @click.option("--user", "user_id", help="このユーザーのメモだけを書き出す")
+    def export_memos_command(output, user_id):
+        """メモをタグ付きの JSONL として OUTPUT（- なら標準出力）に書き出す。"""
+        started = time.monotonic()
+        exported = 0
+        for exported in export_memos(output, user_id=user_id):
+            elapsed = time.monotonic() - started
+            click.echo(f"exported={exported} ({exported / max(elapsed, 1e-9):.0f} memos/s)", err=True)
+        click.echo(f"done: exported={exported} in {time.monotonic() - started:.1f}s", err=True)
+
+    @app.cli.command("import-memos")
+    @click.argument("input_file", metavar="INPUT", type=click.File("r", encoding="utf-8"))
+    @click.option("--chunk-size", default=500, show_default=True, help="1トランザクションで登録するメモ数")
+    @click.option("--generate-tags", is_flag=True, help="tags のないメモを LLM でまとめてタグ付けする")
+    def import_memos_command(input_file, chunk_size, generate_tags):
+        """export-memos の形式の JSONL（- なら標準入力）からメモを登録する。"""
+        started = time.monotonic()
+        read = imported = skipped = 0
+        for read, n_imported, n_skipped in import_memos(input_file, chunk_size=chunk_size,
+                                                        generate_missing_tags=generate_tags):
+            imported += n_imported
+            skipped += n_skipped
+            elapsed = time.monotonic() - started
+            click.echo(f"read={read} imported={imported} skipped={skipped} "
+                       f"({read / max(elapsed, 1e-9):.0f} lines/s)", err=True)
+        click.echo(f"done: read={read} imported={imported} skipped={skipped} in {time.monotonic() - started:.1f}s")
@@ -0,0 +1,146 @@
+# context_builder.py
+import os
+import re
+import math
+import logging
+import functools
+from collections import Counter
+
+from retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+# 回答生成のプロンプトに入れるメモ本文のトークン数の上限
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+# 本文の n-gram の Jaccard 係数がこれ以上のメモは重複として除く
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+# 残りの予算がこれより少なければ、入りきらないメモを切り詰めずに落とす
+CONTEXT_MIN_TRUNCATE_TOKENS = int(os.getenv("CONTEXT_MIN_TRUNCATE_TOKENS", "32"))
+
+# トークン数を数えるエンコーディング（gpt-4o 系）
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "o200k_base")
+
+SEPARATOR = "\n---\n"
+
+_SENTENCE_RE = re.compile(r".*?(?:[。．！？!?]+|\.(?=\s)|\n+|$)", re.S)
+_ASCII_RUN_RE = re.compile(r"[\x00-\x7f]+")
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    """tiktoken のエンコーディングを返す。使えなければ None（初回に1度だけ警告する）。"""
+    try:
+        import tiktoken
+    except ImportError:  # 無ければ文字数から見積もる
+        return None
+    try:
+        return tiktoken.get_encoding(CONTEXT_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, estimating token counts: {e}")
+        return None
+
+
+# トークン数を数える
+def count_tokens(text: str) -> int:
+    """text のトークン数を返す。tiktoken が使えないときは ASCII 4文字、それ以外は1文字を1トークンと見積もる。"""
+    enc = _encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    ascii_chars = sum(len(m) for m in _ASCII_RUN_RE.findall(text))
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+# 質問との関連度でメモを並べる
+def rank_memos(query: str, memos: list[dict]) -> list[dict]:
+    """質問の n-gram と本文の重なりを BM25 風に採点し、関連度の高い順に返す（同点なら元の順）。"""
+    q_terms = set(tokenize(query))
+    docs = [Counter(tokenize(m["body"])) for m in memos]
+    if not q_terms or not docs:
+        return list(memos)
+    avg_len = sum(sum(d.values()) for d in docs) / len(docs) or 1.0
+    df = Counter(t for d in docs for t in q_terms if t in d)
+
+    def score(d):
+        length = sum(d.values())
+        s = 0.0
+        for t in q_terms:
+            tf = d.get(t, 0)
+            if tf:
+                idf = math.log(1 + (len(docs) - df[t] + 0.5) / (df[t] + 0.5))
+                s += idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * length / avg_len))
+        return s
+
+    order = sorted(range(len(memos)), key=lambda i: (-score(docs[i]), i))
+    return [memos[i] for i in order]
+
+
+# ほぼ同じ内容のメモを除く
+def dedupe_memos(memos: list[dict], threshold: float = CONTEXT_DEDUP_THRESHOLD) -> tuple[list[dict], int]:
+    """先頭から順に見て、残したメモと n-gram がほぼ同じメモを除く。(残したメモ, 除いた件数) を返す。"""
+    kept, kept_terms = [], []
+    for m in memos:
+        terms = set(tokenize(m["body"]))
+        if any(_jaccard(terms, other) >= threshold for other in kept_terms):
+            continue
+        kept.append(m)
+        kept_terms.append(terms)
+    return kept, len(memos) - len(kept)
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+# 文の区切りで切り詰める
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """max_tokens に収まるところまで文単位で残す。最初の1文も入らなければ空文字を返す。"""
+    out = ""
+    for sentence in _SENTENCE_RE.findall(text):
+        if not sentence:
+            continue
+        if count_tokens(out + sentence) > max_tokens:
+            break
+        out += sentence
+    return out.rstrip()
+
+
+# 回答生成用の文脈を組み立てる
+def build_context(query: str, memos: list[dict], budget: int | None = None) -> dict:
+    """メモを関連度順に並べて重複を除き、トークン予算に収まるように詰めた文脈を返す。
+
+    戻り値は text（結合した本文）・memos（採用したメモ）・tokens・truncated（切り詰めた件数）・
+    duplicates（重複として除いた件数）・dropped（予算に入らず落とした件数）を持つ dict。
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    candidates = [m for m in memos if m.get("body")]
+    ranked, duplicates = dedupe_memos(rank_memos(query, candidates))
+
+    sep_tokens = count_tokens(SEPARATOR)
+    parts, packed, used, truncated, dropped = [], [], 0, 0, 0
+    for m in ranked:
+        remaining = budget - used - (sep_tokens if parts else 0)
+        body = m["body"]
+        tokens = count_tokens(body)
+        if tokens > remaining:
+            body = truncate_to_tokens(body, remaining) if remaining >= CONTEXT_MIN_TRUNCATE_TOKENS else ""
+            if not body:
+                dropped += 1
+                continue
+            tokens = count_tokens(body)
+            truncated += 1
+        used += tokens + (sep_tokens if parts else 0)
+        parts.append(body)
+        packed.append(m)
+
+    return {
+        "text": SEPARATOR.join(parts),
+        "memos": packed,
+        "tokens": used,
+        "truncated": truncated,
+        "duplicates": duplicates,
+        "dropped": dropped,
+    }
@@ -0,0 +1,23 @@
+# db_connect.py
+import os
+
+import pymysql
+
+
+# DB 接続を確立する
+def get_db(host=None, port=None, connect_timeout=10):
+    """環境変数から接続情報を読み込み、MySQL の接続を返す。host を渡すとそのサーバー（レプリカ）に接続する。
+
+    migrate.py のように、アプリ全体（helpers）を読み込まずに接続だけ欲しい処理からも使う。
+    """
+    return pymysql.connect(
+        host=host or os.getenv("MYSQL_HOST"),
+        port=port or int(os.getenv("MYSQL_PORT", "3306")),
+        connect_timeout=connect_timeout,
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        database=os.getenv("MYSQL_DATABASE"),
+        charset='utf8mb4',
+        autocommit=True,
+        cursorclass=pymysql.cursors.DictCursor,
+    )
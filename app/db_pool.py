@@ -0,0 +1,274 @@
+# db_pool.py
+import os
+import time
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+import pymysql
+
+logger = logging.getLogger(__name__)
+
+# 接続が壊れているとみなす例外
+_BROKEN_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+class PoolTimeout(Exception):
+    """プールから接続を借りられないまま待ち時間を超えたときの例外。"""
+
+
+class ConnectionPool:
+    """プロセス単位で DB 接続を使い回す、上限付き・スレッドセーフなコネクションプール。
+
+    - 同時に開く接続数は max_size まで。超えた場合は acquire_timeout 秒まで空きを待つ。
+    - idle_timeout 秒以上使われていない接続は閉じる。
+    - ping_interval 秒以上使われていない接続は、貸し出し前に ping で生存確認する。
+    - fork 後の子プロセスでは親の接続を共有せず、新しく接続し直す。
+    """
+
+    def __init__(self, connect, max_size=4, idle_timeout=300.0, ping_interval=30.0, acquire_timeout=10.0):
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.idle_timeout = float(idle_timeout)
+        self.ping_interval = float(ping_interval)
+        self.acquire_timeout = float(acquire_timeout)
+        self._reset()
+
+    def _reset(self):
+        """プールの状態を初期化する（fork 直後にも呼ばれる）。"""
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()  # (接続, 最終利用時刻)
+        self._size = 0
+        self._local = threading.local()
+
+    def _check_fork(self):
+        """fork を検知したら親プロセスの接続を手放して作り直す。"""
+        if self._pid != os.getpid():
+            # 親の接続はソケットを共有しているため close せずに捨てる
+            self._reset()
+
+    def _evict_idle(self, now: float) -> list:
+        """idle_timeout を超えた接続をプールから外して返す（ロック保持中に呼ぶ）。"""
+        expired = []
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+        return expired
+
+    def acquire(self):
+        """接続を1つ借りる。空きがなければ上限まで新規接続し、それも無理なら待つ。"""
+        self._check_fork()
+        deadline = time.monotonic() + self.acquire_timeout
+        con, last_used, expired = None, None, []
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                expired += self._evict_idle(now)
+                if self._idle:
+                    con, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolTimeout(f"no free connection within {self.acquire_timeout}s")
+                self._cond.wait(remaining)
+        for old in expired:
+            _close_quietly(old)
+
+        if con is not None and time.monotonic() - last_used > self.ping_interval:
+            try:
+                con.ping(reconnect=False)
+            except Exception:
+                logger.info("pooled connection failed health check; reconnecting")
+                _close_quietly(con)
+                con = None
+        if con is None:
+            try:
+                con = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return con
+
+    def release(self, con, discard: bool = False):
+        """借りた接続を返す。discard=True または切断済みなら閉じて枠を空ける。"""
+        if self._pid != os.getpid():
+            return
+        if not discard and not con.open:
+            discard = True
+        with self._cond:
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((con, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            _close_quietly(con)
+
+    @contextmanager
+    def connection(self):
+        """同じスレッド内のネストした呼び出しで1つの接続を共有するコンテキストマネージャ。"""
+        self._check_fork()
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            yield con
+            return
+        con = self.acquire()
+        self._local.con = con
+        broken = False
+        try:
+            yield con
+        except _BROKEN_ERRORS:
+            broken = True
+            raise
+        finally:
+            self._local.con = None
+            self.release(con, discard=broken)
+
+    @contextmanager
+    def transaction(self):
+        """ブロック内のクエリを1トランザクションで実行する。ネストした場合は外側に合流する。"""
+        with self.connection() as con:
+            if getattr(self._local, "in_tx", False):
+                yield con
+                return
+            self._local.in_tx = True
+            try:
+                con.begin()
+                yield con
+                con.commit()
+            except BaseException:
+                try:
+                    con.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                self._local.in_tx = False
+
+    def in_use(self) -> bool:
+        """このスレッドが connection()/transaction() のブロック内で接続を借りていれば True。"""
+        self._check_fork()
+        return getattr(self._local, "con", None) is not None
+
+    def close_all(self):
+        """待機中の接続をすべて閉じる。"""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for con, _ in idle:
+            _close_quietly(con)
+
+
+class ReplicaSet:
+    """読み取り用のレプリカごとのプールをまとめ、使うレプリカを選ぶ。
+
+    - このプロセスで実行中のクエリ数が最も少ない正常なレプリカを選ぶ（同数なら順番に回す）。
+    - 接続や実行でエラーになったレプリカは retry_interval 秒間外し、過ぎたら次の1件で試す。
+    """
+
+    def __init__(self, pools: dict, retry_interval: float = 10.0):
+        self.pools = pools  # 名前 -> ConnectionPool
+        self.retry_interval = float(retry_interval)
+        self._outstanding = {name: 0 for name in pools}
+        self._down_until = {name: 0.0 for name in pools}
+        self._turn = 0
+        self._lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return bool(self.pools)
+
+    def healthy(self) -> list[str]:
+        """いま選ばれうるレプリカの名前を返す。"""
+        now = time.monotonic()
+        return [name for name in self.pools if self._down_until[name] <= now]
+
+    def _pick(self) -> str | None:
+        with self._lock:
+            candidates = self.healthy()
+            if not candidates:
+                return None
+            self._turn += 1
+            start = self._turn % len(candidates)
+            rotated = candidates[start:] + candidates[:start]
+            name = min(rotated, key=lambda n: self._outstanding[n])
+            self._outstanding[name] += 1
+            return name
+
+    def acquire(self) -> tuple[str | None, object]:
+        """選んだレプリカから接続を1つ借り、(名前, 接続) を返す。使えるレプリカがなければ (None, None)。"""
+        name = self._pick()
+        if name is None:
+            return None, None
+        try:
+            return name, self.pools[name].acquire()
+        except BaseException as e:
+            self._done(name, failed=isinstance(e, _BROKEN_ERRORS))
+            raise
+
+    def release(self, name: str, con, failed: bool = False):
+        """acquire() で借りた接続を返す。failed ならその接続を捨て、レプリカをしばらく外す。"""
+        self.pools[name].release(con, discard=failed)
+        self._done(name, failed)
+
+    def _done(self, name: str, failed: bool):
+        with self._lock:
+            self._outstanding[name] -= 1
+            if failed:
+                if self._down_until[name] <= time.monotonic():
+                    logger.warning(f"replica {name} failed; skipping it for {self.retry_interval:.0f}s")
+                self._down_until[name] = time.monotonic() + self.retry_interval
+
+    @contextmanager
+    def connection(self):
+        """acquire() の with 版。ブロック内で接続エラーが起きたらレプリカをしばらく外す。"""
+        name, con = self.acquire()
+        if name is None:
+            yield None, None
+            return
+        failed = False
+        try:
+            yield name, con
+        except _BROKEN_ERRORS:
+            failed = True
+            raise
+        finally:
+            self.release(name, con, failed)
+
+    @contextmanager
+    def lease(self):
+        """接続は借りずにレプリカを1つ選び、その名前（なければ None）を渡す。
+
+        aiomysql など別のプールで読む側が、選び方と外し方をこのクラスと共有するために使う。
+        ブロック内で接続エラーが起きたらレプリカをしばらく外す。
+        """
+        name = self._pick()
+        if name is None:
+            yield None
+            return
+        failed = False
+        try:
+            yield name
+        except _BROKEN_ERRORS:
+            failed = True
+            raise
+        finally:
+            self._done(name, failed)
+
+    def close_all(self):
+        for pool in self.pools.values():
+            pool.close_all()
+
+
+def _close_quietly(con):
+    """例外を握りつぶして接続を閉じる。"""
+    try:
+        con.close()
+    except Exception:
+        pass
@@ -1,70 +1,438 @@
 # helpers.py
 import os
+import re
 import json
+import hashlib
+import functools
+from datetime import datetime
 import logging
-import sys
+import time
+import uuid
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 import pymysql
 import math
-import bleach
-from openai import OpenAI
-from markdown import markdown
-from flask import session
+from typing import TYPE_CHECKING
+from flask import session, has_request_context
+import metrics
+from db_pool import ConnectionPool, ReplicaSet
+from db_connect import get_db
+from retrieval import MemoIndex
+from llm_cache import cache_from_env
+from singleflight import flight_from_env
+from llm_guard import llm_guard, LLMUnavailable, LLM_DEADLINE
+from context_builder import build_context, count_tokens
+from memo_snapshot import snapshot_cache_from_env
+from prefork import post_fork
 
-# OpenAI クライアントの初期化
-openai_client = OpenAI()
+# openai・bleach・markdown は読み込みに時間がかかるので、使うときに読み込む（warm_up を参照）
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from openai.types.chat import ChatCompletion
+
+logger = logging.getLogger(__name__)
+
+# OpenAI クライアント（初回に作成する）
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+# LLM 応答のキャッシュ（LLM_CACHE=memory/redis/off）
+llm_cache = cache_from_env()
+
+# 同じ LLM リクエストの同時実行をまとめる（SINGLEFLIGHT=local/redis/off）
+llm_flight = flight_from_env()
+
+# ユーザーページとメモ数のキャッシュ（MEMO_SNAPSHOT_CACHE=memory/redis/off）
+memo_snapshots = snapshot_cache_from_env()
 
 # タグ数の上限
 MAX_TAGS_PER_MEMO = 3
 
+# ユーザーごとのメモの件数と、メモの文字数の上限
+MAX_MEMOS_PER_USER = 5
+MAX_MEMO_LENGTH = 300
+
+# search_memos が返す件数の上限
+SEARCH_MEMOS_LIMIT = int(os.getenv("SEARCH_MEMOS_LIMIT", "20"))
+
+# ft_memos_body の ngram_token_size（これより短いキーワードは LIKE で検索する）
+NGRAM_TOKEN_SIZE = int(os.getenv("MYSQL_NGRAM_TOKEN_SIZE", "2"))
+
+# rag() の検索方式（llm: LLM にツールを選ばせる / local: ローカル索引で直接検索する）
+RAG_MODE = os.getenv("RAG_MODE", "llm")
+
+# ローカル索引の検索件数と、他ワーカーで追加されたメモを取り込む間隔（秒）
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+RETRIEVAL_REFRESH_SECONDS = float(os.getenv("RETRIEVAL_REFRESH_SECONDS", "60"))
+
+# attach_tags_bulk が1トランザクションで処理するメモ数
+TAG_BULK_CHUNK_SIZE = int(os.getenv("TAG_BULK_CHUNK_SIZE", "500"))
+
+# memo_related に保存する類似メモの件数
+RELATED_TOP_N = int(os.getenv("RELATED_TOP_N", "5"))
+
+# メモ作成時に類似メモ一覧を破棄する、本文が似ているメモの件数の上限
+RELATED_INVALIDATE_LIMIT = int(os.getenv("RELATED_INVALIDATE_LIMIT", "200"))
+
+# ユーザーページ1ページあたりのメモ数
+USER_PAGE_SIZE = int(os.getenv("USER_PAGE_SIZE", "20"))
+
+# タグ検索1ページあたりのメモ数と、タグクラウドに出すタグ数
+TAG_PAGE_SIZE = int(os.getenv("TAG_PAGE_SIZE", "20"))
+TAG_CLOUD_SIZE = int(os.getenv("TAG_CLOUD_SIZE", "30"))
+
+# プロセス内で同時に開く DB 接続数の上限（uWSGI のスレッド数に合わせる）
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "4"))
+
+# rag() がツールを並行実行するスレッド数と、1回の実行を待つ時間（秒）。
+# ツールはそれぞれ DB 接続を1本使うので、MYSQL_POOL_SIZE より多く並べても接続待ちになるだけ。上限を揃える
+RAG_TOOL_WORKERS = min(int(os.getenv("RAG_TOOL_WORKERS", str(MYSQL_POOL_SIZE))), MYSQL_POOL_SIZE)
+RAG_TOOL_TIMEOUT = float(os.getenv("RAG_TOOL_TIMEOUT", "5"))
+
 SUPER_ADMIN_USER_ID = os.getenv("SUPER_ADMIN_USER_ID", "dummy_super_admin_id")
 
-# DB 接続を確立する
-def get_db():
-    """環境変数から接続情報を読み込み、MySQL の接続を返す。"""
-    return pymysql.connect(
-        host=os.getenv("MYSQL_HOST"),
-        user=os.getenv("MYSQL_USER"),
-        password=os.getenv("MYSQL_PASSWORD"),
-        database=os.getenv("MYSQL_DATABASE"),
-        charset='utf8mb4',
-        autocommit=True,
-        cursorclass=pymysql.cursors.DictCursor,
-    )
+# 読み取り専用のレプリカ（"host[:port]" のカンマ区切り）。空なら読み書きとも primary を使う
+MYSQL_REPLICA_HOSTS = os.getenv("MYSQL_REPLICA_HOSTS", "")
+
+# 書き込んだ後、同じセッション（リクエストをまたぐ）で primary から読み続ける秒数（レプリカの遅延より長くする）
+MYSQL_READ_YOUR_WRITES_SECONDS = float(os.getenv("MYSQL_READ_YOUR_WRITES_SECONDS", "5"))
+
+# エラーになったレプリカを外しておく秒数と、レプリカへの接続タイムアウト（秒）
+MYSQL_REPLICA_RETRY_SECONDS = float(os.getenv("MYSQL_REPLICA_RETRY_SECONDS", "10"))
+MYSQL_REPLICA_CONNECT_TIMEOUT = int(os.getenv("MYSQL_REPLICA_CONNECT_TIMEOUT", "2"))
+
+# プロセス内で共有するコネクションプール
+_pool = ConnectionPool(
+    get_db,
+    max_size=MYSQL_POOL_SIZE,
+    idle_timeout=float(os.getenv("MYSQL_POOL_IDLE_TIMEOUT", "300")),
+)
+
+def _replica_pools(spec: str) -> dict:
+    pools = {}
+    for item in spec.split(","):
+        host, _, port = item.strip().partition(":")
+        if host:
+            pools[item.strip()] = ConnectionPool(
+                functools.partial(get_db, host=host, port=int(port) if port else None,
+                                  connect_timeout=MYSQL_REPLICA_CONNECT_TIMEOUT),
+                max_size=MYSQL_POOL_SIZE,
+                idle_timeout=float(os.getenv("MYSQL_POOL_IDLE_TIMEOUT", "300")),
+            )
+    return pools
+
+# 読み取り用のレプリカ（MYSQL_REPLICA_HOSTS が空なら何も持たない）
+_replicas = ReplicaSet(_replica_pools(MYSQL_REPLICA_HOSTS), retry_interval=MYSQL_REPLICA_RETRY_SECONDS)
+
+# このスレッド（asyncio ならタスク）で primary から読み続ける期限（time.time()）
+_primary_until = contextvars.ContextVar("primary_until", default=0.0)
+
+# 書き込みを記録する
+def _note_write():
+    """以降の読み取りを MYSQL_READ_YOUR_WRITES_SECONDS 秒間 primary に送る。
+
+    リクエスト中ならセッションにも期限を入れ、書き込み直後のリダイレクト先でも書いた内容が見えるようにする。
+    """
+    until = time.time() + MYSQL_READ_YOUR_WRITES_SECONDS
+    _primary_until.set(until)
+    if has_request_context():
+        session['primary_until'] = until
+
+# 読み取りを primary に送るか
+def _reads_from_primary() -> bool:
+    """レプリカがない・接続を借りている（トランザクション中など）・書き込み直後なら True。"""
+    if not _replicas or _pool.in_use():
+        return True
+    now = time.time()
+    if _primary_until.get() > now:
+        return True
+    return has_request_context() and session.get('primary_until', 0) > now
+
+# Flask の外（ASGI）で、セッションの primary_until を読み取りの振り分けに使う
+def read_from_primary_until(until: float):
+    """このタスクの読み取りを until（time.time()）まで primary に送る。"""
+    _primary_until.set(until)
+
+# 書き込み直後のリダイレクト用
+def read_your_writes_deadline() -> float | None:
+    """Flask の外で書き込んだとき、セッションに入れる primary_until の値を返す。レプリカがなければ None。"""
+    return time.time() + MYSQL_READ_YOUR_WRITES_SECONDS if _replicas else None
+
+# 1つの接続で複数のクエリを実行する
+def db_connection():
+    """プールから接続を借り、ブロック内の query_db/execute_db で共有させる。"""
+    return _pool.connection()
+
+# 1つのトランザクションで複数のクエリを実行する
+def db_transaction():
+    """ブロック内の query_db/execute_db を1トランザクションにまとめる。例外時はロールバックする。"""
+    return _pool.transaction()
 
 # SELECT 用の簡易クエリ実行
 def query_db(sql, args=(), fetchone=False):
-    """SELECT を実行し、1件または複数件の結果を返す。"""
-    con = get_db()
-    try:
-        with con.cursor() as cur:
-            cur.execute(sql, args)
-            return cur.fetchone() if fetchone else cur.fetchall()
-    finally:
-        con.close()
+    """SELECT を実行し、1件または複数件の結果を返す。
+
+    レプリカがあれば、書き込み直後やトランザクション中でない限りレプリカで実行する。
+    レプリカでエラーになったら primary でやり直す。
+    """
+    if not _reads_from_primary():
+        try:
+            with _replicas.connection() as (name, con):
+                if con is not None:
+                    result = _select(con, sql, args, fetchone)
+                    metrics.registry.inc("db_reads_total", target="replica")
+                    return result
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            logger.warning(f"replica read failed, retrying on primary: {e}")
+            metrics.registry.inc("db_reads_total", target="fallback")
+    with _pool.connection() as con:
+        metrics.registry.inc("db_reads_total", target="primary")
+        return _select(con, sql, args, fetchone)
+
+def _select(con, sql, args, fetchone):
+    with con.cursor() as cur, metrics.span("db_query_seconds", "db", fingerprint=metrics.fingerprint(sql)) as sp:
+        cur.execute(sql, args)
+        result = cur.fetchone() if fetchone else cur.fetchall()
+        sp.rows = cur.rowcount
+        return result
 
 # INSERT/UPDATE/DELETE 用の簡易クエリ実行
 def execute_db(sql, args=()):
-    """変更系クエリを実行する。"""
-    con = get_db()
-    try:
-        with con.cursor() as cur:
+    """変更系クエリを実行する（常に primary）。"""
+    if _replicas:
+        _note_write()
+    with _pool.connection() as con:
+        with con.cursor() as cur, metrics.span("db_query_seconds", "db", fingerprint=metrics.fingerprint(sql)) as sp:
             cur.execute(sql, args)
+            sp.rows = cur.rowcount
+
+# SELECT 結果をストリーミングで取得
+def iter_query_db(sql, args=()):
+    """SELECT をサーバーサイドカーソルで実行し、行を1件ずつ返すジェネレータ。
+
+    結果全体をメモリに載せないため、読み切るか close() するまでプールの接続を1つ専有する。
+    query_db と同じ条件でレプリカから読む（読み始めた後のエラーはやり直さない）。
+    """
+    name, con = (None, None) if _reads_from_primary() else _replicas.acquire()
+    if con is None:
+        con = _pool.acquire()
+    metrics.registry.inc("db_reads_total", target="replica" if name else "primary")
+    broken = False
+    fp = metrics.fingerprint(sql)
+    rows = 0
+    try:
+        with con.cursor(pymysql.cursors.SSDictCursor) as cur:
+            with metrics.span("db_query_seconds", "db", fingerprint=fp):
+                cur.execute(sql, args)
+            for row in cur:
+                rows += 1
+                yield row
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+        broken = True
+        raise
     finally:
-        con.close()
+        metrics.registry.inc("db_rows_total", rows, fingerprint=fp)
+        if name is not None:
+            _replicas.release(name, con, failed=broken)
+        else:
+            _pool.release(con, discard=broken)
+
+# OpenAI クライアントを取得する
+def get_openai_client() -> "OpenAI":
+    """プロセスごとに1つの OpenAI クライアントを遅延生成して返す（fork 後は作り直す）。"""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                _openai_client = OpenAI()
+    return _openai_client
+
+# fork 後に親プロセスの接続を手放す
+@post_fork
+def _reset_clients():
+    """OpenAI クライアントと DB（primary・レプリカ）の接続を子プロセスで作り直させる。"""
+    global _openai_client
+    _openai_client = None
+    _pool._check_fork()
+    for pool in _replicas.pools.values():
+        pool._check_fork()
+
+# LLM を呼び出す
+def _chat_completion(**params) -> "ChatCompletion":
+    """chat.completions.create を呼ぶ。同じリクエストにはキャッシュ済みの応答を返す。"""
+    from openai.types.chat import ChatCompletion
+    key = llm_cache.make_key(params)
+    cached = llm_cache.get(key)
+    if llm_cache.enabled:
+        metrics.registry.inc("llm_cache_requests_total", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        return ChatCompletion.model_validate_json(cached)
+    # 同じリクエストが実行中ならその応答を待って共有する
+    return ChatCompletion.model_validate_json(llm_flight.do(key, lambda: _create_completion(key, params)))
+
+def _create_completion(key: str, params: dict) -> str:
+    """chat.completions.create を呼び、応答をキャッシュして JSON 文字列で返す。"""
+    started = time.perf_counter()
+    # 期限・ヘッジ・再試行・サーキットブレーカー付きで呼ぶ（失敗時は LLMUnavailable）
+    response = llm_guard.create(**params)
+    metrics.record_llm(params.get("model", ""), time.perf_counter() - started, response.usage)
+    raw = response.model_dump_json()
+    llm_cache.set(key, raw)
+    return raw
+
+class InvalidMemo(Exception):
+    """メモを作成できない入力を表す。status は返す HTTP ステータス。"""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+# メモ作成フォームを検証する
+def parse_memo_form(form, memo_count: int) -> dict:
+    """app.memo_create と asgi.memo_create の入力を検証し、{body, visibility, password, enable_tags} を返す。
+
+    件数か文字数の上限を超えていれば InvalidMemo を送出する。
+    """
+    if memo_count >= MAX_MEMOS_PER_USER:
+        raise InvalidMemo(f"メモは{MAX_MEMOS_PER_USER}つまでしか作成できません。", 403)
+    body = form.get('body', '')
+    if len(body) > MAX_MEMO_LENGTH:
+        raise InvalidMemo(f"メモは{MAX_MEMO_LENGTH}字以下で入力してください。", 400)
+    visibility = form.get('visibility', 'public')
+    return {
+        "body": body,
+        "visibility": visibility,
+        "password": form.get('password', '') if visibility == 'secret' else None,
+        "enable_tags": form.get('enable_tags') == 'on',
+    }
+
+# 検証済みのメモを作成
+def create_memo(uid: str, memo: dict) -> str:
+    """parse_memo_form の結果に id を振って保存し、その id を返す。タグ付けは呼び出し側で行う。"""
+    mid = str(uuid.uuid4())
+    save_memo(mid, uid, memo["body"], memo["visibility"], memo["password"])
+    return mid
 
 # メモを保存
 def save_memo(mid: str, uid: str, body: str, visibility: str, password: str | None):
     """メモをDBに保存する。"""
+    with db_transaction():
+        execute_db(
+            f"""
+            INSERT INTO memos (id, user_id, body, visibility, password, body_html, body_hash, render_version)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            (mid, uid, body, visibility, password, _render_markdown(body), _body_hash(body), _renderer_version())
+        )
+        _bump_memo_version([mid])
+    if _memo_index is not None:
+        _memo_index.add(mid, uid, visibility, body)
+    _invalidate_related_for_new_memo(mid, body, visibility)
+    refresh_related_memos(mid)
+
+# メモを削除
+def delete_memo(mid: str):
+    """メモをDBから削除する（タグの紐付けや類似メモの行は ON DELETE CASCADE で消える）。"""
+    with db_transaction():
+        # attach_tags_bulk と同じく、メモの行を先にロックしてから関連する表を更新する
+        if not query_db("SELECT id FROM memos WHERE id=%s FOR UPDATE", (mid,)):
+            return
+        # このメモを類似メモに含む一覧は上位が繰り上がるので破棄する
+        _invalidate_related([mid], via_related=True)
+        _bump_memo_version([mid])
+        # CASCADE で消えるタグの紐付けの分だけタグごとのメモ数を減らす
+        rows = query_db(
+            "SELECT tag_id FROM memo_tags WHERE memo_id=%s AND memo_visibility <> 'secret' ORDER BY tag_id",
+            (mid,)
+        )
+        _add_tag_counts({r["tag_id"]: -1 for r in rows})
+        execute_db('DELETE FROM memos WHERE id=%s', (mid,))
+    if _memo_index is not None:
+        _memo_index.remove(mid)
+
+# ユーザーページとメモ数のキャッシュを無効にする
+def _bump_memo_version(memo_ids: list[str]):
+    """指定メモの投稿者の memo_version を上げる。メモを書き換えるトランザクションの中で呼ぶ。"""
+    placeholders = ','.join(['%s'] * len(memo_ids))
     execute_db(
-        f"""
-        INSERT INTO memos (id, user_id, body, visibility, password)
-        VALUES (%s, %s, %s, %s, %s)
-        """,
-        (mid, uid, body, visibility, password)
+        "UPDATE users SET memo_version = memo_version + 1"
+        f" WHERE id IN (SELECT user_id FROM memos WHERE id IN ({placeholders}))",
+        memo_ids
     )
 
-# 類似メモを取得
-def get_related_memos(base_memo_id: str, limit: int = 1) -> list[dict]:
+# ローカル検索用のインデックス（プロセスごとに遅延構築）と、取り込み済みの seq・同期スレッドを動かしているプロセス
+_memo_index = None
+_memo_index_seq = 0
+_memo_index_sync_pid = None
+_memo_index_lock = threading.Lock()
+
+# 同期のたびに読み直す直前の seq の数（seq の採番順とコミット順が前後しても取りこぼさないため）
+RETRIEVAL_SYNC_OVERLAP = 100
+
+# ローカル検索用のインデックスを取得
+def get_memo_index() -> MemoIndex:
+    """全メモの索引を返す。DB から作るのはプロセスで最初の1回だけ。
+
+    save_memo/delete_memo はこのプロセスの索引を即時に更新する。他ワーカーで追加されたメモは
+    背景スレッドが RETRIEVAL_REFRESH_SECONDS ごとに seq の続きから取り込み、他ワーカーで削除された
+    メモは search_memos_local が DB で見つからなかったときに取り除く。
+    """
+    global _memo_index, _memo_index_seq
+    index = _memo_index
+    if index is None:
+        with _memo_index_lock:
+            if _memo_index is None:
+                fresh, seq = MemoIndex(), 0
+                for r in iter_query_db("SELECT id, user_id, body, visibility, seq FROM memos"):
+                    fresh.add(r["id"], r["user_id"], r["visibility"], r["body"] or "")
+                    seq = max(seq, r["seq"])
+                _memo_index, _memo_index_seq = fresh, seq
+            index = _memo_index
+    _start_memo_index_sync()
+    return index
+
+# 索引の同期スレッドをこのプロセスで起動する
+def _start_memo_index_sync():
+    """fork 後の子プロセスでも動くよう、プロセスごとに1本だけ起動する。"""
+    global _memo_index_sync_pid
+    pid = os.getpid()
+    if _memo_index_sync_pid == pid:
+        return
+    with _memo_index_lock:
+        if _memo_index_sync_pid == pid:
+            return
+        _memo_index_sync_pid = pid
+        threading.Thread(target=_memo_index_sync_loop, args=(pid,), name="memo-index-sync", daemon=True).start()
+
+def _memo_index_sync_loop(pid: int):
+    while _memo_index_sync_pid == pid:
+        time.sleep(RETRIEVAL_REFRESH_SECONDS)
+        try:
+            _sync_memo_index()
+        except Exception:
+            logger.warning("failed to sync the memo index", exc_info=True)
+
+# 他ワーカーで追加されたメモを索引に取り込む
+def _sync_memo_index():
+    """前回までに読んだ seq より後のメモを読み、まだ索引にないものを追加する。"""
+    global _memo_index_seq
+    index = _memo_index
+    if index is None:
+        return
+    rows = query_db(
+        "SELECT id, user_id, body, visibility, seq FROM memos WHERE seq > %s ORDER BY seq",
+        (max(0, _memo_index_seq - RETRIEVAL_SYNC_OVERLAP),)
+    )
+    for r in rows:
+        if r["id"] not in index:
+            index.add(r["id"], r["user_id"], r["visibility"], r["body"] or "")
+    if rows:
+        _memo_index_seq = max(_memo_index_seq, rows[-1]["seq"])
+
+# 類似メモをその場で計算する
+def _compute_related_memos(base_memo_id: str, limit: int = 1) -> list[dict]:
     """
     簡易：FULLTEXT で本文類似を取得（検索対象は対象メモの公開範囲と同一、secretは除く）。
     """
@@ -78,7 +446,7 @@ def get_related_memos(base_memo_id: str, limit: int = 1) -> list[dict]:
     if visibility == 'secret':
         return []
     
-    # NATURAL LANGUAGE MODEで全文検索
+    # NATURAL LANGUAGE MODEで全文検索（条件を WHERE に書き、FULLTEXT 索引で候補を引く）
     rows = query_db(
         """
         SELECT m.id, m.body, m.created_at,
@@ -88,11 +456,11 @@ def get_related_memos(base_memo_id: str, limit: int = 1) -> list[dict]:
         WHERE m.id <> %s
           AND m.visibility = %s
           AND mt.memo_id IS NULL
-        HAVING score > 0
+          AND MATCH(m.body) AGAINST(%s IN NATURAL LANGUAGE MODE) > 0
         ORDER BY score DESC, m.created_at ASC
         LIMIT %s
         """,
-        (q, base_memo_id, visibility, max(1, int(limit or 1)))
+        (q, base_memo_id, visibility, q, max(1, int(limit or 1)))
     ) or []
 
     return [
@@ -105,39 +473,196 @@ def get_related_memos(base_memo_id: str, limit: int = 1) -> list[dict]:
         for r in rows
     ]
 
+# 類似メモを計算して memo_related に保存する
+def refresh_related_memos(base_memo_id: str) -> list[dict]:
+    """対象メモの類似メモ上位 RELATED_TOP_N 件を計算し直して保存し、その一覧を返す。"""
+    related = _compute_related_memos(base_memo_id, RELATED_TOP_N)
+    with db_transaction():
+        execute_db("DELETE FROM memo_related WHERE memo_id=%s", (base_memo_id,))
+        if related:
+            execute_db(
+                "INSERT IGNORE INTO memo_related (memo_id, related_id, score) VALUES "
+                + ','.join(['(%s,%s,%s)'] * len(related)),
+                [v for r in related for v in (base_memo_id, r["id"], r["score"])]
+            )
+        # 削除済みのメモなら外部キー制約で失敗するので無視する
+        execute_db(
+            "INSERT IGNORE INTO memo_related_state (memo_id) VALUES (%s)"
+            " ON DUPLICATE KEY UPDATE computed_at=CURRENT_TIMESTAMP",
+            (base_memo_id,)
+        )
+    return related
+
+# memo_related を古いものとして扱わせる
+def _invalidate_related(memo_ids: list[str], via_related: bool = False):
+    """指定メモの類似メモ一覧を破棄する。via_related=True なら、指定メモを類似メモに含む一覧を破棄する。"""
+    if not memo_ids:
+        return
+    placeholders = ','.join(['%s'] * len(memo_ids))
+    if via_related:
+        execute_db(
+            "DELETE s FROM memo_related_state s"
+            " JOIN memo_related r ON r.memo_id = s.memo_id"
+            f" WHERE r.related_id IN ({placeholders})",
+            memo_ids
+        )
+    else:
+        execute_db(f"DELETE FROM memo_related_state WHERE memo_id IN ({placeholders})", memo_ids)
+
+# 新しいメモの影響を受ける類似メモ一覧を破棄する
+def _invalidate_related_for_new_memo(mid: str, body: str, visibility: str):
+    """新しいメモと本文が似ている同じ公開範囲のメモは、類似メモの上位が変わりうるので破棄する。"""
+    if visibility == 'secret' or not (body or "").strip():
+        return
+    rows = query_db(
+        """
+        SELECT id FROM memos
+        WHERE id <> %s AND visibility = %s
+          AND MATCH(body) AGAINST(%s IN NATURAL LANGUAGE MODE) > 0
+        LIMIT %s
+        """,
+        (mid, visibility, body.strip(), RELATED_INVALIDATE_LIMIT)
+    )
+    _invalidate_related([r["id"] for r in rows])
+
+# 類似メモを取得
+def get_related_memos(base_memo_id: str, limit: int = 1) -> list[dict]:
+    """
+    memo_related に保存済みの類似メモを返す。未計算（または破棄済み）ならその場で計算して保存する。
+    """
+    limit = max(1, int(limit or 1))
+    if limit > RELATED_TOP_N:
+        return _compute_related_memos(base_memo_id, limit)
+    rows = query_db(
+        """
+        SELECT s.memo_id AS base_id, m.id, m.body, m.created_at, r.score
+        FROM memo_related_state AS s
+        LEFT JOIN memo_related AS r ON r.memo_id = s.memo_id
+        LEFT JOIN memos AS m ON m.id = r.related_id
+        WHERE s.memo_id = %s
+        ORDER BY r.score DESC, m.created_at ASC
+        LIMIT %s
+        """,
+        (base_memo_id, limit)
+    )
+    if rows:
+        return [
+            {"id": r["id"], "body": r["body"], "created_at": r["created_at"], "score": float(r["score"])}
+            for r in rows if r["id"] is not None
+        ]
+    return refresh_related_memos(base_memo_id)[:limit]
+
+# memo_related を作り直す
+def rebuild_related_memos(batch_size: int = 500):
+    """全メモの類似メモ一覧を ID 順に計算し直し、処理件数を batch_size 件ごとに yield する。"""
+    last_id = ""
+    while True:
+        rows = query_db("SELECT id FROM memos WHERE id > %s ORDER BY id LIMIT %s", (last_id, batch_size))
+        if not rows:
+            return
+        for r in rows:
+            refresh_related_memos(r["id"])
+        last_id = rows[-1]["id"]
+        yield len(rows)
+
 # タグ文字列を正規化する
 def _normalize_tag(s: str) -> str:
     """タグ名を小文字化・長さ制限・許可文字のみで整形する。"""
     s = (s or "").strip().lower()
     return "".join(ch for ch in s if ch.isalnum() or ch in "-_")[:20]
 
-# 既存タグを取得または作成する
-def _get_or_create_tag(name: str) -> int:
-    """タグ名からタグIDを取得し、なければ作成してIDを返す。"""
-    name = _normalize_tag(name)
-    if not name:
-        return None
-    row = query_db("SELECT id FROM tags WHERE name=%s", (name,), fetchone=True)
-    if row:
-        return row["id"]
-    execute_db("INSERT INTO tags (name) VALUES (%s)", (name,))
-    row = query_db("SELECT id FROM tags WHERE name=%s", (name,), fetchone=True)
-    return row["id"] if row else None
-
 # メモとタグを紐付ける
 def attach_tags(memo_id: str, tags: list[str]):
     """メモに対してタグを一意に紐付ける。"""
     if not tags:
         return
-    seen = set()
-    for t in tags[:MAX_TAGS_PER_MEMO]:
-        t = _normalize_tag(t)
-        if not t or t in seen:
+    attach_tags_bulk({memo_id: tags})
+
+# 複数メモにまとめてタグを紐付ける
+def attach_tags_bulk(memo_tags: dict[str, list[str]], chunk_size: int | None = None):
+    """{メモID: タグ配列} を chunk_size 件ずつ、1トランザクションで紐付ける。
+
+    タグ名を正規化して tags に一括で登録し、ID を1回の SELECT で引いてから
+    memo_tags に複数行 INSERT する。存在しないメモへの紐付けは無視される。
+    新しく紐付いた分だけ tag_counts を増やす（対象メモの行をロックして数え漏れや重複を防ぐ）。
+    """
+    chunk_size = chunk_size or TAG_BULK_CHUNK_SIZE
+    items = list(memo_tags.items())
+    for start in range(0, len(items), chunk_size):
+        pairs = []
+        for memo_id, tags in items[start:start + chunk_size]:
+            seen = set()
+            for t in (tags or [])[:MAX_TAGS_PER_MEMO]:
+                t = _normalize_tag(t)
+                if not t or t in seen:
+                    continue
+                pairs.append((memo_id, t))
+                seen.add(t)
+        if not pairs:
             continue
-        tag_id = _get_or_create_tag(t)
-        if tag_id:
-            execute_db("INSERT IGNORE INTO memo_tags (memo_id, tag_id) VALUES (%s,%s)", (memo_id, tag_id))
-        seen.add(t)
+        # 同時実行時のデッドロックを避けるため、常に同じ順序でロックを取る
+        names = sorted({name for _, name in pairs})
+        name_placeholders = ','.join(['%s'] * len(names))
+        with db_transaction():
+            execute_db(
+                f"INSERT IGNORE INTO tags (name) VALUES {','.join(['(%s)'] * len(names))}",
+                names
+            )
+            rows = query_db(f"SELECT id, name FROM tags WHERE name IN ({name_placeholders})", names)
+            tag_ids = {r["name"]: r["id"] for r in rows}
+            memo_ids = sorted({memo_id for memo_id, _ in pairs})
+            memo_placeholders = ','.join(['%s'] * len(memo_ids))
+            memos = {r["id"]: r for r in query_db(
+                f"SELECT id, created_at, visibility FROM memos WHERE id IN ({memo_placeholders}) ORDER BY id FOR UPDATE",
+                memo_ids
+            )}
+            existing = {(r["memo_id"], r["tag_id"]) for r in query_db(
+                f"SELECT memo_id, tag_id FROM memo_tags WHERE memo_id IN ({memo_placeholders})", memo_ids
+            )}
+            new_pairs = [
+                (memo_id, tag_ids[name]) for memo_id, name in pairs
+                if memo_id in memos and name in tag_ids and (memo_id, tag_ids[name]) not in existing
+            ]
+            if new_pairs:
+                execute_db(
+                    "INSERT IGNORE INTO memo_tags (memo_id, tag_id, memo_created_at, memo_visibility) VALUES "
+                    + ','.join(['(%s,%s,%s,%s)'] * len(new_pairs)),
+                    [v for memo_id, tag_id in new_pairs
+                     for v in (memo_id, tag_id, memos[memo_id]["created_at"], memos[memo_id]["visibility"])]
+                )
+                counts = {}
+                for memo_id, tag_id in new_pairs:
+                    if memos[memo_id]["visibility"] != 'secret':
+                        counts[tag_id] = counts.get(tag_id, 0) + 1
+                _add_tag_counts(counts)
+                tagged = sorted({memo_id for memo_id, _ in new_pairs})
+                # タグ付きのメモは類似メモの対象外になるので、それを含む一覧を破棄する
+                _invalidate_related(tagged, via_related=True)
+                _bump_memo_version(tagged)
+
+# タグごとのメモ数を増減する
+def _add_tag_counts(deltas: dict[int, int]):
+    """{タグID: 増減} を tag_counts に反映する。メモを書き換えるトランザクションの中で呼ぶ。"""
+    items = sorted((tag_id, n) for tag_id, n in deltas.items() if n)
+    if not items:
+        return
+    execute_db(
+        "INSERT INTO tag_counts (tag_id, memo_count) VALUES "
+        + ','.join(['(%s,%s)'] * len(items))
+        + " AS new ON DUPLICATE KEY UPDATE memo_count = GREATEST(0, tag_counts.memo_count + new.memo_count)",
+        [v for item in items for v in item]
+    )
+
+# tag_counts を memo_tags から数え直す
+def rebuild_tag_counts() -> int:
+    """全タグのメモ数を数え直し、更新したタグの数を返す。"""
+    with db_transaction():
+        execute_db("DELETE FROM tag_counts")
+        execute_db(
+            "INSERT INTO tag_counts (tag_id, memo_count)"
+            " SELECT tag_id, COUNT(*) FROM memo_tags WHERE memo_visibility <> 'secret' GROUP BY tag_id"
+        )
+        return query_db("SELECT COUNT(*) AS n FROM tag_counts", fetchone=True)["n"]
 
 # メモのタグ一覧を取得する
 def _get_tags_for_memo(memo_id: str) -> list[str]:
@@ -150,138 +675,495 @@ def _get_tags_for_memo(memo_id: str) -> list[str]:
     """, (memo_id,))
     return [r["name"] for r in rows] if rows else []
 
+# メモ詳細ページのデータを取得する
+def load_memo_detail(mid: str) -> dict | None:
+    """メモ本体・投稿者名・タグ一覧を1回のクエリで取得する。メモがなければ None を返す。"""
+    memo = query_db(
+        """
+        SELECT m.id, m.user_id, m.body, m.visibility, m.password, m.created_at,
+               m.body_html, m.body_hash, m.render_version,
+               u.username AS owner_name,
+               (SELECT GROUP_CONCAT(t.name ORDER BY t.name ASC SEPARATOR ',')
+                  FROM memo_tags mt JOIN tags t ON t.id = mt.tag_id
+                 WHERE mt.memo_id = m.id) AS tag_names
+        FROM memos AS m
+        LEFT JOIN users AS u ON u.id = m.user_id
+        WHERE m.id=%s
+        """,
+        (mid,), fetchone=True
+    )
+    if not memo:
+        return None
+    # タグ名は英数字と -_ だけなので , 区切りで分割できる
+    memo["tags"] = memo.pop("tag_names").split(",") if memo.get("tag_names") else []
+    return memo
+
+# ページ送り用のカーソルを作る
+def _encode_cursor(created_at, memo_id: str) -> str:
+    """(created_at, id) をURLに載せられる文字列にする。"""
+    return f"{created_at.isoformat()}_{memo_id}"
+
+# ページ送り用のカーソルを読む
+def _decode_cursor(cursor: str | None):
+    """_encode_cursor の逆変換。不正な値なら None（先頭ページ）を返す。"""
+    if not cursor:
+        return None
+    created_at, _, memo_id = cursor.partition("_")
+    try:
+        return datetime.fromisoformat(created_at), memo_id
+    except ValueError:
+        return None
+
+_MEMO_VERSION_SQL = "SELECT memo_version FROM users WHERE id=%s"
+
+# メモ数を数えるクエリ（memo_version も同じ文で読むので件数と食い違わない）
+_MEMO_COUNT_SQL = """
+    SELECT u.memo_version, COUNT(m.id) AS count
+    FROM users AS u
+    LEFT JOIN memos AS m ON m.user_id = u.id
+    WHERE u.id=%s
+    GROUP BY u.id, u.memo_version
+"""
+
+# memo_version をキーにしたキャッシュを引く
+def _cached_for_user(uid: str, part: str, load):
+    """ユーザーの part の結果をキャッシュから返す。なければ load() で (memo_version, 値) を読んでキャッシュする。
+
+    ユーザーがいなければ None を返す（load() も None を返すこと）。
+    """
+    if memo_snapshots.enabled:
+        row = query_db(_MEMO_VERSION_SQL, (uid,), fetchone=True)
+        if row is None:
+            return None
+        value = memo_snapshots.get(uid, row["memo_version"], part)
+        metrics.registry.inc("memo_snapshot_requests_total", result="hit" if value is not None else "miss")
+        if value is not None:
+            return value
+    loaded = load()
+    if loaded is None:
+        return None
+    version, value = loaded
+    memo_snapshots.set(uid, version, part, value)
+    return value
+
+# ユーザーのメモ数を数える
+def count_user_memos(uid: str) -> int:
+    """ユーザーのメモ数（秘密メモも含む）を返す。ユーザーがいなければ 0。"""
+    def load():
+        row = query_db(_MEMO_COUNT_SQL, (uid,), fetchone=True)
+        return (row["memo_version"], row["count"]) if row else None
+    return _cached_for_user(uid, "count", load) or 0
+
+# ユーザーページのデータを取得する
+def load_user_page(uid: str, viewer_uid: str | None, cursor: str | None = None,
+                   page_size: int = USER_PAGE_SIZE) -> dict | None:
+    """ユーザー名とメモ一覧の1ページ分を1回のクエリで取得する。ユーザーがいなければ None を返す。
+
+    メモは (created_at, id) の昇順で、cursor より後ろを page_size 件返す（キーセットページング）。
+    本人には秘密メモも伏せた本文で表示し、他人には公開メモだけを返す。
+    ページ単位で memo_version をキーにキャッシュする。
+    """
+    owner = viewer_uid == uid
+    visibilities = ('public', 'private', 'secret') if owner else ('public',)
+    after = _decode_cursor(cursor)
+
+    def load():
+        placeholders = ','.join(['%s'] * len(visibilities))
+        keyset, keyset_args = "", ()
+        if after:
+            keyset = " AND (m.created_at > %s OR (m.created_at = %s AND m.id > %s))"
+            keyset_args = (after[0], after[0], after[1])
+        rows = query_db(
+            f"""
+            SELECT u.username, u.memo_version, m.id, m.visibility, m.created_at,
+                   CASE WHEN m.visibility = 'secret' THEN '🔒秘密メモ' ELSE m.body END AS body
+            FROM users AS u
+            LEFT JOIN memos AS m
+              ON m.user_id = u.id AND m.visibility IN ({placeholders}){keyset}
+            WHERE u.id=%s
+            ORDER BY m.created_at ASC, m.id ASC
+            LIMIT %s
+            """,
+            (*visibilities, *keyset_args, uid, page_size + 1)
+        )
+        if not rows:
+            return None
+        memos = [
+            {"id": r["id"], "body": r["body"], "visibility": r["visibility"], "created_at": r["created_at"]}
+            for r in rows if r["id"] is not None
+        ]
+        next_cursor = None
+        if len(memos) > page_size:
+            memos = memos[:page_size]
+            next_cursor = _encode_cursor(memos[-1]["created_at"], memos[-1]["id"])
+        page = {"username": rows[0]["username"], "memos": memos, "next_cursor": next_cursor}
+        return rows[0]["memo_version"], page
+
+    part = f"page:{'owner' if owner else 'public'}:{page_size}:{_encode_cursor(*after) if after else ''}"
+    return _cached_for_user(uid, part, load)
+
 # タグでメモを検索する
-def search_memos_by_tag(tag_name: str) -> list[dict]:
-    """指定タグに一致するメモを取得し、作成日時順に返す。"""
+def search_memos_by_tag(tag_name: str, cursor: str | None = None, page_size: int = TAG_PAGE_SIZE) -> dict:
+    """指定タグに一致するメモのうち、cursor より後ろの page_size 件を作成日時順に返す。
+
+    並べ替えと絞り込みは memo_tags の idx_memo_tags_tag_created だけで行い、
+    ページに載る分だけ memos から本文を引く。{"memos": [...], "next_cursor": ...} を返す。
+    """
     tag_name = _normalize_tag(tag_name)
-    rows = query_db("""
+    keyset, keyset_args = "", ()
+    after = _decode_cursor(cursor)
+    if after:
+        keyset = " AND (mt.memo_created_at > %s OR (mt.memo_created_at = %s AND mt.memo_id > %s))"
+        keyset_args = (after[0], after[0], after[1])
+    rows = query_db(
+        f"""
         SELECT m.id, m.user_id, m.body, m.visibility, m.created_at
-        FROM tags t
-        JOIN memo_tags mt ON mt.tag_id = t.id
-        JOIN memos m ON m.id = mt.memo_id
-        WHERE t.name=%s AND m.visibility <> 'secret'
-        ORDER BY m.created_at ASC
-    """, (tag_name,))
-    return rows
+        FROM (
+            SELECT mt.memo_id, mt.memo_created_at
+            FROM tags t
+            JOIN memo_tags mt ON mt.tag_id = t.id
+            WHERE t.name=%s AND mt.memo_visibility <> 'secret'{keyset}
+            ORDER BY mt.memo_created_at ASC, mt.memo_id ASC
+            LIMIT %s
+        ) AS page
+        JOIN memos m ON m.id = page.memo_id
+        ORDER BY page.memo_created_at ASC, page.memo_id ASC
+        """,
+        (tag_name, *keyset_args, page_size + 1)
+    )
+    memos = list(rows)
+    next_cursor = None
+    if len(memos) > page_size:
+        memos = memos[:page_size]
+        next_cursor = _encode_cursor(memos[-1]["created_at"], memos[-1]["id"])
+    return {"memos": memos, "next_cursor": next_cursor}
 
-# 指定ユーザーのメモをキーワードで検索
-def search_memos(keyword: str, include_secret: bool, target_uid: str) -> list:
-    """対象ユーザーのメモから、表示範囲に応じて本文キーワード一致のメモを返す。"""
-    if not target_uid:
-        return []
-    current_uid = session.get('user_id')
+# よく使われているタグを取得する
+def popular_tags(limit: int = TAG_CLOUD_SIZE) -> list[dict]:
+    """tag_counts から（秘密メモを除く）メモ数の多い順に limit 件のタグ名と件数を返す。"""
+    return list(query_db(
+        """
+        SELECT t.name, c.memo_count AS count
+        FROM tag_counts c
+        JOIN tags t ON t.id = c.tag_id
+        WHERE c.memo_count > 0
+        ORDER BY c.memo_count DESC, c.tag_id ASC
+        LIMIT %s
+        """,
+        (limit,)
+    ))
+
+# LIKE のワイルドカードをエスケープする
+def _escape_like(s: str) -> str:
+    """LIKE パターン中の \\, %, _ をリテラルとして扱えるようにエスケープする。"""
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# キーワード検索の条件とスコア式を組み立てる
+def _keyword_clause(keyword: str) -> tuple[str, tuple, str, tuple]:
+    """本文の部分一致条件と関連度スコアの SQL 断片を (where, where_args, score, score_args) で返す。
+
+    ngram_token_size 以上のキーワードは FULLTEXT (ft_memos_body) のフレーズ検索で候補を絞り、
+    LIKE で大文字小文字を無視した部分一致を保証する。短いキーワードは LIKE のみで検索し、
+    出現回数をスコアにする。
+    """
+    if not keyword:
+        return "", (), "0", ()
+    pattern = f"%{_escape_like(keyword)}%"
+    if len(keyword.strip()) >= NGRAM_TOKEN_SIZE and '"' not in keyword:
+        phrase = f'"{keyword}"'
+        return (
+            " AND MATCH(body) AGAINST(%s IN BOOLEAN MODE) AND body LIKE %s",
+            (phrase, pattern),
+            "MATCH(body) AGAINST(%s IN BOOLEAN MODE)",
+            (phrase,),
+        )
+    return (
+        " AND body LIKE %s",
+        (pattern,),
+        "(CHAR_LENGTH(body) - CHAR_LENGTH(REPLACE(LOWER(body), LOWER(%s), ''))) / CHAR_LENGTH(%s)",
+        (keyword, keyword),
+    )
+
+# 検索対象にする公開範囲を決める
+def _searchable_visibilities(target_uid: str, include_secret: bool, current_uid: str | None = None):
+    """実行ユーザーと対象ユーザーの関係から、検索してよい公開範囲を返す。
+
+    current_uid を省略するとセッションのユーザーを使う（リクエスト外のスレッドからは明示する）。
+    """
+    if current_uid is None:
+        current_uid = session.get('user_id')
     visibilities = ()
     if current_uid == target_uid:
         visibilities = ("public", "private", "secret") if include_secret else ("public", "private")
     else:
         visibilities = ("public", "secret") if include_secret else ("public")
+    return visibilities
+
+# 指定ユーザーのメモをキーワードで検索
+def search_memos(keyword: str, include_secret: bool, target_uid: str,
+                 limit: int | None = SEARCH_MEMOS_LIMIT, stream: bool = False,
+                 current_uid: str | None = None):
+    """対象ユーザーのメモから、表示範囲に応じて本文キーワード一致のメモを関連度順に返す。
 
+    絞り込みは DB 側で行う。stream=True のときはサーバーサイドカーソルで1件ずつ返すジェネレータを返す。
+    """
+    if not target_uid:
+        return iter(()) if stream else []
+    sql, args = _search_memos_query(keyword, include_secret, target_uid, limit, current_uid)
+    if stream:
+        return iter_query_db(sql, args)
+    return list(query_db(sql, args))
+
+def _search_memos_query(keyword: str, include_secret: bool, target_uid: str,
+                        limit: int | None, current_uid: str | None) -> tuple[str, tuple]:
+    """search_memos の SQL と引数を組み立てる（search_memos_async も使う）。"""
+    visibilities = _searchable_visibilities(target_uid, include_secret, current_uid)
     placeholders = ','.join(['%s'] * len(visibilities))
-    sql = f"SELECT id, body FROM memos WHERE user_id=%s AND visibility IN ({placeholders})"
-    rows = query_db(sql, (target_uid, *visibilities))
-    return [r for r in rows if keyword.lower() in r['body'].lower()]
+    where, where_args, score, score_args = _keyword_clause(keyword or "")
+    sql = (
+        f"SELECT id, body, {score} AS score FROM memos"
+        f" WHERE user_id=%s AND visibility IN ({placeholders}){where}"
+        " ORDER BY score DESC, created_at ASC"
+    )
+    args = (*score_args, target_uid, *visibilities, *where_args)
+    if limit:
+        sql += " LIMIT %s"
+        args += (int(limit),)
+    return sql, args
+
+# ローカル索引で指定ユーザーのメモを検索
+def search_memos_local(query: str, include_secret: bool, target_uid: str,
+                       k: int = RETRIEVAL_TOP_K, current_uid: str | None = None) -> list[dict]:
+    """LLM を使わずにローカル索引で検索し、上位 k 件を score 付きで返す。公開範囲は search_memos と同じ。"""
+    if not target_uid:
+        return []
+    visibilities = _searchable_visibilities(target_uid, include_secret, current_uid)
+    index = get_memo_index()
+    hits = index.search(query, (target_uid,), visibilities, k=k)
+    if not hits:
+        return []
+    # 他ワーカーでの削除などに備え、DB で存在と公開範囲を確かめてから返す
+    id_placeholders = ','.join(['%s'] * len(hits))
+    vis_placeholders = ','.join(['%s'] * len(visibilities))
+    rows = query_db(
+        f"SELECT id, body FROM memos WHERE id IN ({id_placeholders})"
+        f" AND user_id=%s AND visibility IN ({vis_placeholders})",
+        (*[mid for mid, _ in hits], target_uid, *visibilities)
+    )
+    bodies = {r["id"]: r["body"] for r in rows}
+    # DB にないメモは他ワーカーで削除されたので、索引からも取り除く
+    for mid, _ in hits:
+        if mid not in bodies:
+            index.remove(mid)
+    return [{"id": mid, "body": bodies[mid], "score": score} for mid, score in hits if mid in bodies]
 
 # 指定キーワードを含むメモの投稿者を取得
 def get_author_by_body(keyword: str) -> list:
     """本文にキーワードを含む最初のメモの投稿者IDを返す。"""
-    row = query_db(
-        "SELECT user_id FROM memos WHERE body LIKE %s ORDER BY created_at ASC LIMIT 1",
-        (f"%{keyword}%",),
-        fetchone=True
-    )
+    row = query_db(_AUTHOR_BY_BODY_SQL, (f"%{keyword}%",), fetchone=True)
+    return _author_result(row)
+
+_AUTHOR_BY_BODY_SQL = "SELECT user_id FROM memos WHERE body LIKE %s ORDER BY created_at ASC LIMIT 1"
+
+def _author_result(row) -> list:
+    """get_author_by_body の検索結果を返り値の形にする。"""
     # super-admin の場合はIDを返さない
     if row and row.get('user_id') == SUPER_ADMIN_USER_ID:
         return []
     return [{'user_id': row['user_id']}] if row else []
 
-# RAG: 関数呼び出しを使って検索や投稿者取得を実行
-def rag(query: str, user_id: str, other_user_id: str | None = None) -> list:
-    """クエリと実行ユーザーIDを受け取り、必要に応じて他ユーザー1人の公開メモも検索対象に含める。"""
-    tools = [
-        {
-            'type': 'function',
-            'function': {
-                'name': 'search_memos',
-                'description': 'Search for memos by keyword and visibility settings.',
-                'parameters': {
-                    'type': 'object',
-                    'properties': {
-                        'keyword': {
-                            'type': 'string',
-                            'description': 'Keyword to search for in memo bodies.'
-                        },
-                        'include_secret': {
-                            'type': 'boolean',
-                            'description': 'Whether to include secret memos in the search.'
-                        }
+# rag() が LLM に選ばせるツール
+_RAG_TOOLS = [
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_memos',
+            'description': 'Search for memos by keyword and visibility settings.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'keyword': {
+                        'type': 'string',
+                        'description': 'Keyword to search for in memo bodies.'
                     },
-                    'required': ['keyword', 'include_secret'],
-                }
+                    'include_secret': {
+                        'type': 'boolean',
+                        'description': 'Whether to include secret memos in the search.'
+                    }
+                },
+                'required': ['keyword', 'include_secret'],
             }
-        },
-        {
-            'type': 'function',
-            'function': {
-                'name': 'get_author_by_body',
-                'description': 'Find the user who wrote a memo containing a given keyword.',
-                'parameters': {
-                    'type': 'object',
-                    'properties': {
-                        'keyword': {
-                            'type': 'string',
-                            'description': 'Keyword to search for in memo bodies.'
-                        }
-                    },
-                    'required': ['keyword']
-                }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_author_by_body',
+            'description': 'Find the user who wrote a memo containing a given keyword.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'keyword': {
+                        'type': 'string',
+                        'description': 'Keyword to search for in memo bodies.'
+                    }
+                },
+                'required': ['keyword']
             }
         }
-    ]
-    response = openai_client.chat.completions.create(
+    }
+]
+
+# ツール選択のリクエストを組み立てる
+def _rag_tool_params(query: str, user_id: str) -> dict:
+    """rag() がツールを選ばせる chat.completions のパラメータを返す。"""
+    return dict(
         model='gpt-4o-mini',
         messages=[
             {'role': 'system', 'content': 'You are an assistant that helps search user memos using the available tools.'},
             {'role': 'assistant', 'content': 'Target User ID: ' + user_id},
             {'role': 'user', 'content': query}
         ],
-        tools=tools,
+        tools=_RAG_TOOLS,
         tool_choice='required',
         max_tokens=100,
     )
-    choice = response.choices[0]
-    logging.info(f"RAG tool calls: {choice.message.tool_calls}")
-    if choice.message.tool_calls:
-        call = choice.message.tool_calls[0]
+
+# モデルが選んだツール呼び出しを実行内容に変換する
+def _plan_tool_calls(tool_calls, user_id: str, other_user_id: str | None) -> list[tuple[str, tuple]]:
+    """(ツール名, 位置引数) の並びを返す。search_memos は本人と他ユーザーの2件に分ける。"""
+    planned = []
+    for call in tool_calls or []:
+        try:
+            args = json.loads(call.function.arguments)
+        except (TypeError, ValueError):
+            logger.warning(f"RAG tool call has invalid arguments: {call.function.arguments!r}")
+            continue
         name = call.function.name
-        args = json.loads(call.function.arguments)
 
         if name == 'get_author_by_body':
-            return get_author_by_body(args['keyword'])
-        
+            planned.append((name, (args.get('keyword', ''),)))
+
         if name == 'search_memos':
             kw = args.get('keyword', '')
             inc_sec = args.get('include_secret', False)
+            for uid in (user_id, other_user_id):
+                if uid:
+                    planned.append((name, (kw, inc_sec, uid)))
+    return planned
 
-            base = search_memos(kw, inc_sec, user_id)
-            logging.info(f"RAG base memos: {base}")
-            other = search_memos(kw, inc_sec, other_user_id) if other_user_id else []
-            logging.info(f"RAG other memos: {other}")
+# RAG: 関数呼び出しを使って検索や投稿者取得を実行
+def rag(query: str, user_id: str, other_user_id: str | None = None, mode: str | None = None) -> list:
+    """クエリと実行ユーザーIDを受け取り、必要に応じて他ユーザー1人の公開メモも検索対象に含める。
 
-            return list(base or []) + list(other or [])
-        
-    return []
+    mode='local'（既定値は RAG_MODE）ではツール選択の LLM 呼び出しを省き、ローカル索引で検索する。
+    """
+    current_uid = session.get('user_id')
+    if (mode or RAG_MODE) == 'local':
+        return _rag_local(query, user_id, other_user_id, current_uid)
 
-# メモを文脈にして回答を作成
-def answer_with_context(query: str, memos: list) -> str:
-    """複数のメモ本文を文脈として結合し、質問に対する応答文を生成する。"""
-    context_text = "\n---\n".join([m['body'] for m in memos])
+    try:
+        response = _chat_completion(**_rag_tool_params(query, user_id))
+    except LLMUnavailable as e:
+        # ツールを選べないときはローカル索引の検索に切り替える
+        logger.warning(f"RAG falling back to local search: {e}")
+        metrics.registry.inc("llm_degraded_total", stage="rag")
+        return _rag_local(query, user_id, other_user_id, current_uid)
+    choice = response.choices[0]
+    logger.info("RAG tool calls", extra={"tool_calls": choice.message.tool_calls})
+
+    # すべてのツール呼び出しを、本人分と他ユーザー分も含めて並行に実行する
+    tools = {'search_memos': search_memos, 'get_author_by_body': get_author_by_body}
+    tasks = [(tools[name], args, {'current_uid': current_uid} if name == 'search_memos' else {})
+             for name, args in _plan_tool_calls(choice.message.tool_calls, user_id, other_user_id)]
+    return _merge_tool_results(_run_tools(tasks))
+
+def _rag_local(query: str, user_id: str, other_user_id: str | None, current_uid: str | None) -> list:
+    """ローカル索引で本人と他ユーザーのメモを並行に検索する。"""
+    tasks = [(search_memos_local, (query, False, uid), {'current_uid': current_uid})
+             for uid in (user_id, other_user_id) if uid]
+    memos = _merge_tool_results(_run_tools(tasks))
+    logger.info("RAG local memos", extra={"memos": memos})
+    return memos
+
+# ツール実行用のスレッドプール（プロセスごとに遅延生成）
+_tool_pool = None
+_tool_pool_pid = None
+_tool_pool_lock = threading.Lock()
+
+def _get_tool_pool() -> ThreadPoolExecutor:
+    """RAG_TOOL_WORKERS 本のスレッドプールを返す。fork 後は作り直す。"""
+    global _tool_pool, _tool_pool_pid
+    if _tool_pool is None or _tool_pool_pid != os.getpid():
+        with _tool_pool_lock:
+            if _tool_pool is None or _tool_pool_pid != os.getpid():
+                _tool_pool = ThreadPoolExecutor(max_workers=RAG_TOOL_WORKERS, thread_name_prefix="rag-tool")
+                _tool_pool_pid = os.getpid()
+    return _tool_pool
+
+# ツールを並行に実行する
+def _run_tools(tasks: list) -> list[list]:
+    """(関数, 位置引数, キーワード引数) の並びを並行に実行し、結果を同じ順序で返す。
+
+    RAG_TOOL_TIMEOUT 秒以内に終わらなかったものや失敗したものは空の結果として扱う。
+    """
+    if len(tasks) <= 1:
+        return [_call_tool(fn, args, kwargs) for fn, args, kwargs in tasks]
+    pool = _get_tool_pool()
+    futures = [pool.submit(_call_tool, fn, args, kwargs) for fn, args, kwargs in tasks]
+    deadline = time.monotonic() + RAG_TOOL_TIMEOUT
+    results = []
+    for (fn, args, _), future in zip(tasks, futures):
+        try:
+            results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FuturesTimeout:
+            future.cancel()
+            logger.warning(f"RAG tool {fn.__name__}{args[:1]} timed out")
+            results.append([])
+    return results
+
+def _call_tool(fn, args, kwargs) -> list:
+    """ツールを1つ実行する。例外はログに残して空の結果にする。"""
+    try:
+        return list(fn(*args, **kwargs) or [])
+    except Exception as e:
+        logger.warning(f"RAG tool {fn.__name__} failed: {e}")
+        return []
+
+# ツールの結果をまとめる
+def _merge_tool_results(results: list[list]) -> list:
+    """ツールの結果を呼び出し順に連結し、同じメモ・同じ投稿者の重複を取り除く。"""
+    merged, seen = [], set()
+    for rows in results:
+        for r in rows:
+            key = ('memo', r['id']) if 'id' in r else ('author', r.get('user_id'))
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(r)
+    return merged
+
+# 回答生成のリクエストを組み立てる
+def _answer_params(query: str, memos: list) -> dict:
+    """メモ本文をトークン予算内で文脈にまとめ、回答生成用の chat.completions パラメータを返す。"""
+    context = build_context(query, memos)
+    context_text = context["text"]
+    logger.info("RAG context", extra={
+        "memo_count": len(context["memos"]), "tokens": context["tokens"],
+        "truncated": context["truncated"], "duplicates": context["duplicates"], "dropped": context["dropped"],
+    })
+    metrics.registry.inc("llm_context_tokens_total", context["tokens"])
+    for result in ("truncated", "duplicates", "dropped"):
+        if context[result]:
+            metrics.registry.inc("llm_context_memos_total", context[result], result=result)
+    metrics.registry.inc("llm_context_memos_total", len(context["memos"]), result="packed")
     prompt = f"""Here are your memos. Answer the following question based on them:
 
 {context_text}
 
 Question: {query}
 """
-    response = openai_client.chat.completions.create(
+    return dict(
         model='gpt-4o-mini',
         messages=[
             {'role': 'system', 'content': """
@@ -292,86 +1174,475 @@ Question: {query}
         ],
         max_tokens=300,
     )
+
+# メモを文脈にして回答を作成
+def answer_with_context(query: str, memos: list) -> str:
+    """複数のメモ本文を文脈として結合し、質問に対する応答文を生成する。"""
+    response = _chat_completion(**_answer_params(query, memos))
     content = response.choices[0].message.content.strip()
     return content
 
+# LLM を使えないときの回答
+def degraded_answer(memos: list) -> str:
+    """AI の回答を作れないときに表示する文を返す。"""
+    found = len([m for m in memos if m.get('body')])
+    return f"現在 AI による回答を生成できません。関連するメモは {found} 件見つかりました。しばらくしてから再度お試しください。"
+
+# RAG の結果から LLM を使わずに答える
+def direct_answer(memos) -> str | None:
+    """メモが見つからないときと投稿者を返すときの回答を返す。LLM で回答を作るときは None。"""
+    if not (memos and isinstance(memos, list)):
+        return "関連するメモが見つかりませんでした。"
+    if 'user_id' in memos[0]:
+        # 投稿者情報を返すケース
+        return f"User ID: {memos[0]['user_id']}"
+    return None
+
+# 回答を生成できなかったときの記録と代わりの回答
+def unavailable_answer(memos: list, error: Exception) -> str:
+    """LLM の失敗をログとメトリクスに記録し、degraded_answer を返す。"""
+    logger.warning(f"RAG answer unavailable: {error}")
+    metrics.registry.inc("llm_degraded_total", stage="answer")
+    return degraded_answer(memos)
+
+# ストリーミングで回答を送る前に表示する文
+def answer_preface_html(memos: list) -> str:
+    """回答の生成を待つ間に表示する、使うメモの件数の HTML を返す。"""
+    return f'<p class="text-muted small">{len(memos)} 件のメモをもとに回答しています…</p>'
+
+# メモを文脈にして回答をストリーミング生成
+def answer_with_context_stream(query: str, memos: list):
+    """answer_with_context と同じ回答を、OpenAI のストリーミング API で差分テキストごとに返すジェネレータ。
+
+    キャッシュ済みなら全文を一度に返し、生成し終えた回答はキャッシュに保存する。
+    """
+    from openai.types.chat import ChatCompletion
+    params = _answer_params(query, memos)
+    key = llm_cache.make_key(params)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        yield ChatCompletion.model_validate_json(cached).choices[0].message.content.strip()
+        return
+    parts, last = [], None
+    started = time.perf_counter()
+    # ストリーミングはヘッジできないので、期限とサーキットブレーカーだけを適用する
+    with llm_guard.guarded() as deadline, get_openai_client().with_options(
+            timeout=LLM_DEADLINE).chat.completions.create(
+                **params, stream=True, stream_options={"include_usage": True}) as stream:
+        for chunk in stream:
+            # 少しずつ届き続けても LLM_DEADLINE で打ち切る
+            deadline.remaining()
+            last = chunk
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    if last is not None:
+        metrics.record_llm(params["model"], time.perf_counter() - started, getattr(last, "usage", None))
+        llm_cache.set(key, _assembled_completion(last, parts))
+
+def _assembled_completion(last, parts: list[str]) -> str:
+    """ストリーミングで受け取った回答を、キャッシュ用の ChatCompletion の JSON にまとめる。"""
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate({
+        "id": last.id, "object": "chat.completion", "created": last.created, "model": last.model,
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": "".join(parts)}}],
+    }).model_dump_json()
+
 # LLM でタグを生成
 def generate_tags(body: str) -> list[str]:
     """メモ本文からタグ候補を抽出し、配列で返す。"""
     try:
-        prompt = f"""You are a tagger. Read the memo content and return 1 to {MAX_TAGS_PER_MEMO} tags.
+        resp = _chat_completion(**_tag_params(body))
+        return _parse_tags(resp.choices[0].message.content.strip(), body)
+    except Exception as e:
+        logger.warning(f"tagging failed: {e}")
+        return []
+
+# タグ生成のリクエストを組み立てる
+def _tag_params(body: str) -> dict:
+    """generate_tags の chat.completions パラメータを返す。"""
+    prompt = f"""You are a tagger. Read the memo content and return 1 to {MAX_TAGS_PER_MEMO} tags.
 Return ONLY a JSON array of lowercase strings without '#'.
 Example: ["meeting","todo"]
 
 Content:
 {body}
 """
-        resp = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You generate concise tags for memos."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=64,
-        )
-        txt = resp.choices[0].message.content.strip()
-        tags = []
-        try:
-            arr = json.loads(txt)
-            if isinstance(arr, list):
-                tags = [str(x) for x in arr][:MAX_TAGS_PER_MEMO]
-        except Exception:
-            words = [w for w in body.lower().split() if w.isalpha()]
-            tags = list(dict.fromkeys(words))[:MAX_TAGS_PER_MEMO]
-        return tags
-    except Exception as e:
-        logging.warning(f"tagging failed: {e}")
-        return []
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "You generate concise tags for memos."},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=64,
+    )
+
+def _parse_tags(txt: str, body: str) -> list[str]:
+    """LLM の応答からタグ配列を取り出す。JSON でなければ本文から簡易に抽出する。"""
+    tags = []
+    try:
+        arr = json.loads(txt)
+        if isinstance(arr, list):
+            tags = [str(x) for x in arr][:MAX_TAGS_PER_MEMO]
+    except Exception:
+        tags = _fallback_tags(body)
+    return tags
+
+# LLM が JSON を返さなかったときのタグ
+def _fallback_tags(body: str) -> list[str]:
+    """本文の英単語を先頭から重複なしで取り出してタグにする。"""
+    words = [w for w in body.lower().split() if w.isalpha()]
+    return list(dict.fromkeys(words))[:MAX_TAGS_PER_MEMO]
+
+# LLM で複数メモのタグをまとめて生成
+def generate_tags_batch(bodies: dict[str, str]) -> dict[str, list[str]]:
+    """{メモID: 本文} を1回の LLM リクエストでタグ付けし、{メモID: タグ配列} を返す。
+
+    API 呼び出しの失敗はそのまま例外にする（呼び出し側で再試行する）。
+    応答に含まれなかったメモは本文の単語からタグを作る。
+    """
+    if not bodies:
+        return {}
+    ids = list(bodies)
+    sections = "\n\n".join(f"[{i}]\n{bodies[mid]}" for i, mid in enumerate(ids, 1))
+    prompt = f"""You are a tagger. Read each numbered memo and return 1 to {MAX_TAGS_PER_MEMO} tags for each.
+Return ONLY a JSON object that maps the memo number to an array of lowercase strings without '#'.
+Example: {{"1": ["meeting","todo"], "2": ["travel"]}}
+
+Memos:
+{sections}
+"""
+    resp = _chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "You generate concise tags for memos."},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=64 * len(ids),
+    )
+    txt = resp.choices[0].message.content.strip()
+    try:
+        obj = json.loads(txt)
+    except Exception:
+        obj = {}
+    result = {}
+    for i, mid in enumerate(ids, 1):
+        arr = obj.get(str(i)) if isinstance(obj, dict) else None
+        if isinstance(arr, list):
+            result[mid] = [str(x) for x in arr][:MAX_TAGS_PER_MEMO]
+        else:
+            result[mid] = _fallback_tags(bodies[mid])
+    return result
 
 # Markdown を HTML に変換
-_ALLOWED_TAGS = set(bleach.sanitizer.ALLOWED_TAGS) | {
-    "p","pre","code","hr","br",
-    "h1","h2","h3","h4","h5","h6",
-    "ul","ol","li",
-    "strong","em","blockquote","table","thead","tbody","tr","th","td",
-    "img","a"
-}
-
-_ALLOWED_ATTRS = {
-    **bleach.sanitizer.ALLOWED_ATTRIBUTES,
-    "*": ["class"],
-    "a": ["href", "title", "target", "rel"],
-    "img": ["src", "alt", "title", "width", "height"]
-}
+@functools.lru_cache(maxsize=1)
+def _sanitizer_settings() -> tuple[set, dict]:
+    """bleach の既定に追加した (許可タグ, 許可属性) を返す。bleach は初回の呼び出しで読み込む。"""
+    import bleach
+    tags = set(bleach.sanitizer.ALLOWED_TAGS) | {
+        "p","pre","code","hr","br",
+        "h1","h2","h3","h4","h5","h6",
+        "ul","ol","li",
+        "strong","em","blockquote","table","thead","tbody","tr","th","td",
+        "img","a"
+    }
+    attrs = {
+        **bleach.sanitizer.ALLOWED_ATTRIBUTES,
+        "*": ["class"],
+        "a": ["href", "title", "target", "rel"],
+        "img": ["src", "alt", "title", "width", "height"]
+    }
+    return tags, attrs
 
 # 必要なら許可プロトコル（javascript:, data: は除外）
 _ALLOWED_PROTOCOLS = ["http", "https"]
 
+# Markdown 変換の設定（変わると保存済み HTML を描画し直す）
+_MARKDOWN_EXTENSIONS = ["fenced_code", "tables"]
+
+# 描画設定のバージョン
+@functools.lru_cache(maxsize=1)
+def _renderer_version() -> str:
+    """許可タグなどを変えると値が変わり、保存済み HTML が古いとみなされる。"""
+    tags, attrs = _sanitizer_settings()
+    return hashlib.sha256(json.dumps([
+        sorted(tags),
+        {k: sorted(v) for k, v in sorted(attrs.items())},
+        _ALLOWED_PROTOCOLS,
+        _MARKDOWN_EXTENSIONS,
+    ]).encode("utf-8")).hexdigest()[:16]
+
+def _render_markdown(text: str) -> str:
+    """Markdown テキストを HTML に変換し、安全な要素だけを残して返す（キャッシュなし）。"""
+    import bleach
+    from markdown import markdown
+    tags, attrs = _sanitizer_settings()
+    with metrics.span("markdown_render_seconds", "markdown"):
+        html = markdown(text or "", extensions=_MARKDOWN_EXTENSIONS)
+        clean = bleach.clean(
+            html,
+            tags=tags,
+            attributes=attrs,
+            protocols=_ALLOWED_PROTOCOLS,
+            strip=True,          # 許可されないタグは削除（内容のみ残す）
+            strip_comments=True  # HTMLコメントも削除
+        )
+    return clean
+
+@functools.lru_cache(maxsize=int(os.getenv("RENDER_CACHE_SIZE", "512")))
 def render_markdown(text: str) -> str:
-    """Markdown テキストを HTML に変換し、安全な要素だけを残して返す。"""
-    html = markdown(text or "", extensions=["fenced_code", "tables"])
-    clean = bleach.clean(
-        html,
-        tags=_ALLOWED_TAGS,
-        attributes=_ALLOWED_ATTRS,
-        protocols=_ALLOWED_PROTOCOLS,
-        strip=True,          # 許可されないタグは削除（内容のみ残す）
-        strip_comments=True  # HTMLコメントも削除
+    """Markdown テキストを HTML に変換し、安全な要素だけを残して返す。同じテキストはプロセス内でキャッシュする。"""
+    return _render_markdown(text)
+
+# 本文のハッシュを計算する
+def _body_hash(body: str) -> str:
+    """保存済み HTML が本文と対応しているか確かめるためのハッシュを返す。"""
+    return hashlib.sha256((body or "").encode("utf-8")).hexdigest()
+
+# メモ本文の HTML を取得する
+def memo_html(memo: dict) -> str:
+    """保存済みの HTML が本文・描画設定と一致すればそのまま返し、古ければその場で描画して返す。
+
+    表示（GET）からは書き込まない（primary に読み取りが固定されるため）。古い HTML は
+    タグワーカーの起動時に rerender_memos で描画し直して保存する。
+    memo には body, body_html, body_hash, render_version が必要。
+    """
+    body = memo.get("body") or ""
+    if (memo.get("body_html") is not None and memo.get("body_hash") == _body_hash(body)
+            and memo.get("render_version") == _renderer_version()):
+        return memo["body_html"]
+    metrics.registry.inc("memo_html_stale_total")
+    return render_markdown(body)
+
+# 保存済み HTML をまとめて描画し直す
+def rerender_memos(batch_size: int = 500, force: bool = False):
+    """memos 全体を ID 順に batch_size 件ずつ走査し、古い HTML を描画し直す。
+
+    バッチごとに1トランザクションで更新し、(走査件数, 更新件数) を都度 yield する。
+    """
+    last_id = ""
+    while True:
+        rows = query_db(
+            "SELECT id, body, body_hash, render_version FROM memos WHERE id > %s ORDER BY id LIMIT %s",
+            (last_id, batch_size)
+        )
+        if not rows:
+            return
+        stale = [
+            r for r in rows
+            if force or r["render_version"] != _renderer_version() or r["body_hash"] != _body_hash(r["body"])
+        ]
+        if stale:
+            with db_transaction():
+                for r in stale:
+                    execute_db(
+                        "UPDATE memos SET body_html=%s, body_hash=%s, render_version=%s WHERE id=%s",
+                        (_render_markdown(r["body"]), _body_hash(r["body"]), _renderer_version(), r["id"])
+                    )
+        last_id = rows[-1]["id"]
+        yield len(rows), len(stale)
+
+# メモの公開範囲（memos.visibility の ENUM）
+_VISIBILITIES = ('public', 'private', 'secret')
+
+# メモを JSONL で書き出す
+def export_memos(out, user_id: str | None = None, progress_every: int = 1000):
+    """メモをタグ付きで1行1件の JSON として out に書き出し、progress_every 件ごとに件数を yield する。
+
+    サーバーサイドカーソルで読むので、件数によらずメモリ使用量は一定。user_id を指定すると
+    そのユーザーのメモだけを書き出す。import_memos でそのまま読み込める。
+    """
+    where, args = "", ()
+    if user_id:
+        where, args = " WHERE m.user_id=%s", (user_id,)
+    rows = iter_query_db(
+        f"""
+        SELECT m.id, m.user_id, m.body, m.visibility, m.password, m.created_at,
+               (SELECT GROUP_CONCAT(t.name ORDER BY t.name SEPARATOR ',')
+                  FROM memo_tags mt JOIN tags t ON t.id = mt.tag_id
+                 WHERE mt.memo_id = m.id) AS tag_names
+        FROM memos AS m{where}
+        """,
+        args
     )
-    return clean
+    n = 0
+    try:
+        for r in rows:
+            tag_names = r.pop("tag_names")
+            r["tags"] = tag_names.split(",") if tag_names else []
+            r["created_at"] = r["created_at"].isoformat() if r["created_at"] else None
+            out.write(json.dumps(r, ensure_ascii=False) + "\n")
+            n += 1
+            if n % progress_every == 0:
+                yield n
+    finally:
+        rows.close()
+    yield n
 
-# ログ設定
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# JSONL のメモを読み込む
+def import_memos(lines, chunk_size: int = 500, generate_missing_tags: bool = False):
+    """1行1件の JSON のメモを chunk_size 件ずつ、複数行 INSERT と1トランザクションで登録する。
+
+    各行は user_id と body が必須で、id・visibility・password・created_at・tags は省略できる。
+    既に存在する ID・存在しないユーザー・不正な行は飛ばす。ユーザーごとの件数上限は適用しない。
+    tags はメモと同じトランザクションで紐付け、generate_missing_tags=True なら tags のない
+    メモを generate_tags_batch でまとめてタグ付けする。チャンクごとに (読んだ行数, 登録数, 飛ばした数) を yield する。
+    類似メモ一覧は作らないので、必要なら後で rebuild_related_memos を実行する。
+    """
+    chunk, read = [], 0
+    for line in lines:
+        if not line.strip():
+            continue
+        read += 1
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield (read, *_import_chunk(chunk, generate_missing_tags))
+            chunk = []
+    if chunk:
+        yield (read, *_import_chunk(chunk, generate_missing_tags))
+
+def _parse_import_line(line: str) -> dict | None:
+    """import_memos の1行を検証して memos の1行分の dict にする。不正なら None。"""
+    try:
+        item = json.loads(line)
+        created_at = datetime.fromisoformat(item["created_at"]) if item.get("created_at") else None
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(item, dict) or not item.get("user_id") or not isinstance(item.get("body"), str):
+        return None
+    visibility = item.get("visibility") or 'public'
+    if visibility not in _VISIBILITIES:
+        return None
+    tags = item.get("tags")
+    mid = str(item.get("id") or uuid.uuid4())
+    # memos.id / user_id は VARCHAR(36)
+    if len(mid) > 36 or len(str(item["user_id"])) > 36:
+        return None
+    return {
+        "id": mid,
+        "user_id": str(item["user_id"]),
+        "body": item["body"],
+        "visibility": visibility,
+        "password": item.get("password") if visibility == 'secret' else None,
+        "created_at": created_at,
+        "tags": [str(t) for t in tags] if isinstance(tags, list) else None,
+    }
+
+def _import_chunk(lines: list[str], generate_missing_tags: bool) -> tuple[int, int]:
+    """import_memos の1チャンク分を登録し、(登録数, 飛ばした数) を返す。"""
+    memos = {}
+    for line in lines:
+        memo = _parse_import_line(line)
+        if memo is not None:
+            memos.setdefault(memo["id"], memo)
+    if memos:
+        id_placeholders = ','.join(['%s'] * len(memos))
+        existing = {r["id"] for r in query_db(f"SELECT id FROM memos WHERE id IN ({id_placeholders})", list(memos))}
+        user_ids = sorted({m["user_id"] for m in memos.values()})
+        users = {r["id"] for r in query_db(
+            f"SELECT id FROM users WHERE id IN ({','.join(['%s'] * len(user_ids))})", user_ids
+        )}
+        memos = {mid: m for mid, m in memos.items() if mid not in existing and m["user_id"] in users}
+    if not memos:
+        return 0, len(lines)
+
+    # LLM の呼び出しはロックを持たないようトランザクションの外で行う
+    if generate_missing_tags:
+        untagged = {mid: m["body"] for mid, m in memos.items() if m["tags"] is None}
+        try:
+            for mid, tags in generate_tags_batch(untagged).items():
+                memos[mid]["tags"] = tags
+        except Exception as e:
+            logger.warning(f"tagging imported memos failed: {e}")
+
+    with db_transaction():
+        execute_db(
+            "INSERT INTO memos (id, user_id, body, visibility, password, created_at,"
+            " body_html, body_hash, render_version) VALUES "
+            + ','.join(['(%s,%s,%s,%s,%s,COALESCE(%s,CURRENT_TIMESTAMP),%s,%s,%s)'] * len(memos)),
+            [v for m in memos.values() for v in (
+                m["id"], m["user_id"], m["body"], m["visibility"], m["password"], m["created_at"],
+                _render_markdown(m["body"]), _body_hash(m["body"]), _renderer_version(),
+            )]
+        )
+        _bump_memo_version(list(memos))
+        tagged = {mid: m["tags"] for mid, m in memos.items() if m["tags"]}
+        if tagged:
+            attach_tags_bulk(tagged, chunk_size=len(tagged))
+    if _memo_index is not None:
+        for m in memos.values():
+            _memo_index.add(m["id"], m["user_id"], m["visibility"], m["body"])
+    return len(memos), len(lines) - len(memos)
+
+# flag の形式
+_FLAG_RE = re.compile(r'flag\{[^\}]+\}', flags=re.IGNORECASE)
+# まだ閉じていない（末尾まで } がない）flag{
+_FLAG_OPEN_RE = re.compile(r'flag\{[^\}]*$', flags=re.IGNORECASE)
+
+# flag を伏字にする
+def redact_flags(text: str) -> str:
+    """flag の形式にマッチする部分を伏字にする。"""
+    return _FLAG_RE.sub('flag{****}', text)
+
+class StreamingMarkdown:
+    """ストリーミングで届く回答を、確定したブロックごとに伏字化・サニタイズして HTML にする。
+
+    空行で区切られたブロック単位で render_markdown に渡すため、Markdown の構造や
+    bleach によるサニタイズがチャンクの境界で崩れない。コードブロックの途中や、
+    閉じていない flag{ より後ろは確定させずに次のチャンクを待つ。
+    """
+
+    def __init__(self):
+        self._buf = ""
+
+    def feed(self, delta: str) -> str:
+        """差分テキストを追加し、確定したブロックの HTML（なければ空文字）を返す。"""
+        self._buf = redact_flags(self._buf + delta)
+        limit = len(self._buf)
+        opened = _FLAG_OPEN_RE.search(self._buf)
+        if opened:
+            limit = opened.start()
+        cut = self._buf.rfind("\n\n", 0, limit)
+        while cut > 0 and self._buf.count("```", 0, cut) % 2:
+            cut = self._buf.rfind("\n\n", 0, cut)
+        if cut <= 0:
+            return ""
+        block, self._buf = self._buf[:cut + 2], self._buf[cut + 2:]
+        return render_markdown(block)
+
+    def finish(self) -> str:
+        """残りのテキストをすべて確定させて HTML を返す。"""
+        block, self._buf = redact_flags(self._buf), ""
+        return render_markdown(block) if block.strip() else ""
+
+# fork 前に重いモジュールを読み込む
+def warm_up():
+    """PRELOAD_MODULES=1 のとき uWSGI のマスターで呼び、遅延読み込みしているモジュールと設定を用意する。
+
+    ワーカーは fork でこれらをメモリごと引き継ぐので、最初のリクエストで読み込まずに済む。
+    接続はここでは作らない。
+    """
+    import openai  # noqa: F401
+    import openai.types.chat  # noqa: F401
+    import markdown  # noqa: F401
+    _renderer_version()
+    count_tokens("")
 
 __all__ = [
-    "query_db", "execute_db", "render_markdown",
-    "rag", "answer_with_context",
-    "get_related_memos", "_get_tags_for_memo",
-    "search_memos_by_tag",
-    "generate_tags", "attach_tags",
-    "save_memo"
+    "query_db", "execute_db", "iter_query_db", "db_connection", "db_transaction",
+    "render_markdown", "memo_html", "rerender_memos",
+    "rag", "answer_with_context", "answer_with_context_stream", "degraded_answer", "LLMUnavailable",
+    "direct_answer", "unavailable_answer", "answer_preface_html",
+    "redact_flags", "StreamingMarkdown",
+    "get_related_memos", "refresh_related_memos", "rebuild_related_memos",
+    "_get_tags_for_memo", "load_memo_detail", "load_user_page", "count_user_memos",
+    "search_memos_by_tag", "popular_tags", "rebuild_tag_counts",
+    "generate_tags", "generate_tags_batch", "attach_tags", "attach_tags_bulk",
+    "parse_memo_form", "create_memo", "InvalidMemo", "MAX_MEMOS_PER_USER", "MAX_MEMO_LENGTH",
+    "save_memo", "delete_memo", "warm_up", "import_memos", "export_memos",
+    "search_memos", "search_memos_local", "get_memo_index"
 ]
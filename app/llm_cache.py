@@ -0,0 +1,164 @@
+# llm_cache.py
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_WS_RE = re.compile(r"\s+")
+
+
+class LRUCache:
+    """プロセス内の LRU キャッシュ。TTL と合計バイト数・件数の上限で古いものから捨てる。"""
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (有効期限, 値)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                self._pop(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                self._pop(next(iter(self._data)))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _pop(self, key: str):
+        _, value = self._data.pop(key)
+        self._bytes -= len(value)
+
+
+class RedisCache:
+    """全ワーカーで共有する Redis キャッシュ。Redis に繋がらないときはキャッシュなしとして振る舞う。"""
+
+    def __init__(self, ttl: float = 3600.0, prefix: str = "llmcache:"):
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> str | None:
+        try:
+            value = get_redis().get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"llm cache get failed: {e}")
+            return None
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str):
+        try:
+            get_redis().set(self.prefix + key, value, ex=max(1, int(self.ttl)))
+        except Exception as e:
+            logger.warning(f"llm cache set failed: {e}")
+
+    def clear(self):
+        try:
+            r = get_redis()
+            for k in r.scan_iter(match=self.prefix + "*", count=500):
+                r.delete(k)
+        except Exception as e:
+            logger.warning(f"llm cache clear failed: {e}")
+
+
+class LLMCache:
+    """LLM 応答のキャッシュ。モデル・正規化したメッセージ・ツール定義などからキーを作る。
+
+    キーにはプロンプトに埋め込んだメモ本文も含まれるため、メモが作成・削除されて検索結果が
+    変われば別のキーになり、古い応答は参照されなくなる。
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @staticmethod
+    def make_key(params: dict) -> str:
+        """リクエストパラメータからキャッシュキーを作る。メッセージ本文の空白の違いは無視する。"""
+        normalized = dict(params)
+        normalized["messages"] = [
+            {**m, "content": _WS_RE.sub(" ", m.get("content") or "").strip()}
+            for m in params.get("messages", [])
+        ]
+        payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str):
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数・ヒット率を返す（プロセス単位）。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 環境変数からキャッシュを作る
+def cache_from_env() -> LLMCache:
+    """LLM_CACHE（memory / redis / off）に応じたバックエンドで LLMCache を作る。"""
+    kind = os.getenv("LLM_CACHE", "memory")
+    ttl = float(os.getenv("LLM_CACHE_TTL", "3600"))
+    if kind == "redis":
+        return LLMCache(RedisCache(ttl=ttl))
+    if kind == "memory":
+        return LLMCache(LRUCache(
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+            ttl=ttl,
+        ))
+    return LLMCache(None)
@@ -0,0 +1,280 @@
+# llm_guard.py
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+import metrics
+
+# openai は読み込みに時間がかかるので、最初の呼び出しで読み込む
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# 1回の LLM 呼び出し（ヘッジ・再試行を含む）にかけてよい時間（秒）
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "20"))
+
+# 失敗時の再試行回数と待ち時間の基準（秒、指数的に伸ばしてばらつかせる）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.25"))
+
+# 応答が直近の何パーセンタイルより遅ければ2本目のリクエストを出すか（0 ならヘッジしない）
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+# 応答時間の記録が少ないうちに使う待ち時間（秒）
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "3"))
+
+# 連続して何回失敗したら遮断し、何秒後に1件だけ試すか
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# 待ち時間のパーセンタイルを出すのに使う直近の応答数と、使い始める件数
+_LATENCY_WINDOW = 200
+_LATENCY_MIN_SAMPLES = 20
+
+
+class LLMUnavailable(Exception):
+    """LLM が時間内に応答しない、または遮断中のため回答を作れないことを表す。"""
+
+
+def _retryable(e: BaseException) -> bool:
+    """一時的な障害（タイムアウト・接続失敗・429・5xx）なら True。"""
+    import openai
+    if isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError,
+                      openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+class CircuitBreaker:
+    """連続した失敗で遮断（open）し、LLM_BREAKER_RESET 秒後に1件だけ試して（half-open）戻す。"""
+
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, reset_timeout: float = LLM_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self._probing else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def release(self):
+        """試行中の1件が結果を出さずに終わった（キャンセルされた）ときに呼ぶ。"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    metrics.registry.inc("llm_circuit_open_total")
+                    logger.warning(f"LLM circuit opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class LatencyTracker:
+    """直近の応答時間を覚えておき、パーセンタイルを返す。"""
+
+    def __init__(self, window: int = _LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> float | None:
+        with self._lock:
+            if len(self._samples) < _LATENCY_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class StreamDeadline:
+    """guarded() のブロックに渡す、ストリーミング全体の期限。"""
+
+    def __init__(self, timeout: float):
+        self.at = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        """残りの秒数を返す。期限を過ぎていれば asyncio.TimeoutError（遮断の判定では失敗に数える）。"""
+        left = self.at - time.monotonic()
+        if left <= 0:
+            raise asyncio.TimeoutError()
+        return left
+
+
+class LLMGuard:
+    """chat.completions.create に全体の期限・ヘッジ・再試行・サーキットブレーカーを付ける。
+
+    非同期版（create_async）が本体で、同期版（create）はバックグラウンドのイベントループで
+    同じ処理を動かす。負けた方のリクエストはキャンセルされる。
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+        self._loop = None
+        self._loop_pid = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def hedge_delay(self) -> float | None:
+        """2本目を出すまでの秒数。ヘッジしないなら None。"""
+        if LLM_HEDGE_PERCENTILE <= 0:
+            return None
+        p = self.latency.percentile(LLM_HEDGE_PERCENTILE)
+        return max(LLM_HEDGE_MIN_DELAY, p if p is not None else LLM_HEDGE_DEFAULT_DELAY)
+
+    # LLM を呼び出す
+    def create(self, **params):
+        """create_async の同期版。呼び出し元のスレッドは結果が出るまで待つ。"""
+        loop = self._background_loop()
+        future = asyncio.run_coroutine_threadsafe(self._create_with_own_client(params), loop)
+        return future.result()
+
+    async def create_async(self, client: "AsyncOpenAI", **params):
+        """期限内に応答を返す。一時的な障害は再試行し、間に合わなければ LLMUnavailable を送出する。"""
+        if not self.breaker.allow():
+            metrics.registry.inc("llm_rejected_total")
+            raise LLMUnavailable("LLM circuit is open")
+        deadline = time.monotonic() + LLM_DEADLINE
+        attempt = 0
+        while True:
+            try:
+                response = await self._hedged(client, params, deadline)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if not _retryable(e):
+                    # 応答はあったので上流は生きている
+                    self.breaker.record_success()
+                    raise
+                attempt += 1
+                backoff = LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                if attempt > LLM_MAX_RETRIES or time.monotonic() + backoff >= deadline:
+                    self.breaker.record_failure()
+                    raise LLMUnavailable(f"LLM request failed: {e!r}") from e
+                logger.warning(f"LLM request failed, retrying in {backoff:.2f}s: {e!r}")
+                metrics.registry.inc("llm_retries_total")
+                await asyncio.sleep(backoff)
+                continue
+            self.breaker.record_success()
+            return response
+
+    # ストリーミングなどヘッジできない呼び出しを見守る
+    @contextmanager
+    def guarded(self, timeout: float = LLM_DEADLINE):
+        """ブロック内の LLM 呼び出しの成否をサーキットブレーカーに記録する。遮断中なら LLMUnavailable。
+
+        StreamDeadline を渡すので、チャンクごとに remaining() を呼んで全体の期限を守らせる
+        （過ぎたら LLMUnavailable になる）。
+        """
+        if not self.breaker.allow():
+            metrics.registry.inc("llm_rejected_total")
+            raise LLMUnavailable("LLM circuit is open")
+        outcome = None
+        try:
+            yield StreamDeadline(timeout)
+            outcome = "success"
+        except Exception as e:
+            if not _retryable(e):
+                outcome = "success"
+                raise
+            outcome = "failure"
+            raise LLMUnavailable(f"LLM request failed: {e!r}") from e
+        finally:
+            if outcome == "success":
+                self.breaker.record_success()
+            elif outcome == "failure":
+                self.breaker.record_failure()
+            else:
+                # 読み手が途中でやめた（GeneratorExit）かキャンセルされただけなので成否は記録しない。
+                # 試行中の1件なら枠を返す
+                self.breaker.release()
+
+    async def _attempt(self, client: "AsyncOpenAI", params: dict, deadline: float):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        started = time.monotonic()
+        response = await asyncio.wait_for(
+            client.with_options(timeout=remaining, max_retries=0).chat.completions.create(**params), remaining
+        )
+        self.latency.record(time.monotonic() - started)
+        return response
+
+    async def _hedged(self, client: "AsyncOpenAI", params: dict, deadline: float):
+        """1本目が hedge_delay 秒で返らなければ2本目を出し、先に成功した方を返す。"""
+        primary = asyncio.create_task(self._attempt(client, params, deadline))
+        tasks = {primary}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=min(delay, max(0.0, deadline - time.monotonic())))
+                if not done and time.monotonic() < deadline:
+                    metrics.registry.inc("llm_hedges_total", result="fired")
+                    tasks.add(asyncio.create_task(self._attempt(client, params, deadline)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            metrics.registry.inc("llm_hedges_total", result="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _create_with_own_client(self, params: dict):
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI()
+        return await self.create_async(self._client, **params)
+
+    def _background_loop(self) -> asyncio.AbstractEventLoop:
+        """同期版で使うイベントループのスレッドをプロセスごとに1つ起動する（fork 後は作り直す）。"""
+        if self._loop is None or self._loop_pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._loop_pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="llm-guard", daemon=True).start()
+                    self._client = None
+                    self._loop, self._loop_pid = loop, os.getpid()
+        return self._loop
+
+
+llm_guard = LLMGuard()
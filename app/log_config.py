@@ -0,0 +1,184 @@
+# log_config.py
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import metrics
+
+# ルートロガーのレベルと、ロガーごとのレベル（例: "helpers=WARNING,werkzeug=ERROR"）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+
+# 出力形式（json: 1行1レコードの JSON / text: 従来の1行テキスト）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+# 1つの値として出力する文字数と、リストの要素数の上限（超えた分は省略する）
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "500"))
+LOG_MAX_ITEMS = int(os.getenv("LOG_MAX_ITEMS", "5"))
+
+# 上限を超える値を含む INFO 以下のレコードを出力する割合（0〜1）
+LOG_LARGE_SAMPLE_RATE = float(os.getenv("LOG_LARGE_SAMPLE_RATE", "1"))
+
+# 書き出し待ちのレコード数の上限（溢れたら捨てて、リクエストを待たせない）
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# LogRecord が元から持っている属性（これ以外は extra で渡された項目として出力する）
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def _truncate(value, depth: int = 0):
+    """長い文字列・リストを上限まで切り詰め、JSON にできる形にする。"""
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_CHARS:
+            return f"{value[:LOG_MAX_FIELD_CHARS]}…(+{len(value) - LOG_MAX_FIELD_CHARS} chars)"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= 3:
+        return _truncate(str(value), depth)
+    if isinstance(value, dict):
+        return {str(k): _truncate(v, depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        items = [_truncate(v, depth + 1) for v in list(value)[:LOG_MAX_ITEMS]]
+        if len(value) > LOG_MAX_ITEMS:
+            items.append(f"…(+{len(value) - LOG_MAX_ITEMS} items)")
+        return items
+    return _truncate(str(value), depth)
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _RESERVED}
+
+
+def _is_large(value) -> bool:
+    if isinstance(value, (str, list, tuple, dict, set)):
+        limit = LOG_MAX_FIELD_CHARS if isinstance(value, str) else LOG_MAX_ITEMS
+        return len(value) > limit
+    return False
+
+
+class JsonFormatter(logging.Formatter):
+    """レコードを1行の JSON にする。extra で渡した項目はそのままキーになる。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": _truncate(record.getMessage()),
+        }
+        for key, value in _extra_fields(record).items():
+            doc[key] = _truncate(value)
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """従来の1行テキスト。extra の項目は末尾に key=value で付ける。"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + " ".join(f"{k}={_truncate(v)}" for k, v in fields.items())
+        return line
+
+
+class LargePayloadSampler(logging.Filter):
+    """上限を超える値を含む INFO 以下のレコードを LOG_LARGE_SAMPLE_RATE の割合だけ通す。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if LOG_LARGE_SAMPLE_RATE >= 1 or record.levelno > logging.INFO:
+            return True
+        if not any(_is_large(v) for v in _extra_fields(record).values()):
+            return True
+        return random.random() < LOG_LARGE_SAMPLE_RATE
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """レコードを整形せずにキューへ入れ、書き出しは QueueListener のスレッドに任せる。
+
+    リスナーのスレッドはプロセスごとに起動する（uWSGI の fork 後は作り直す）。キューが
+    溢れたらレコードを捨てる。ログに渡した値は後で書き換えないこと。
+    """
+
+    def __init__(self, target: logging.Handler, maxsize: int = LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # fork 前のスレッドは子プロセスにないので、キューごと作り直す
+                self.queue = queue.Queue(self.maxsize)
+                self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 整形はリスナーのスレッドで行う
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.registry.inc("log_records_dropped_total")
+
+    def stop(self):
+        """残りのレコードを書き出してリスナーを止める。"""
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self._pid = None
+
+
+def _parse_levels(spec: str) -> dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+_handler = None
+
+# ログ出力を設定する
+def setup_logging() -> logging.Handler:
+    """ルートロガーに BackgroundQueueHandler を付け、環境変数のレベルを設定する。2回目以降は何もしない。"""
+    global _handler
+    if _handler is not None:
+        return _handler
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    _handler = BackgroundQueueHandler(target)
+    _handler.addFilter(LargePayloadSampler())
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    atexit.register(_handler.stop)
+    return _handler
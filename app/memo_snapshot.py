@@ -0,0 +1,83 @@
+# memo_snapshot.py
+import os
+import json
+import threading
+from datetime import datetime
+
+from llm_cache import LRUCache, RedisCache
+
+
+class MemoSnapshotCache:
+    """ユーザーのメモから作った結果（ユーザーページの1ページ、メモ数）のキャッシュ。
+
+    キーは (ユーザーID, users.memo_version, 結果の種類と引数)。メモを書き換える処理は同じトランザクションで
+    memo_version を上げるので、書き込み後に古い結果が返ることはない（古いキーは LRU と TTL で消える）。
+    値は JSON 文字列で持つため、取り出した値を書き換えてもキャッシュには影響しない。
+    秘密メモの本文は入れないこと（Redis に置くと全ワーカーから読める）。
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @staticmethod
+    def make_key(uid: str, version: int, part: str) -> str:
+        return f"{uid}:{version}:{part}"
+
+    def get(self, uid: str, version: int, part: str):
+        if self.backend is None:
+            return None
+        raw = self.backend.get(self.make_key(uid, version, part))
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return _loads(raw) if raw is not None else None
+
+    def set(self, uid: str, version: int, part: str, value):
+        if self.backend is not None:
+            self.backend.set(self.make_key(uid, version, part), _dumps(value))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def _dumps(value) -> str:
+    if isinstance(value, dict) and "memos" in value:
+        value = {**value, "memos": [{**m, "created_at": m["created_at"].isoformat()} for m in value["memos"]]}
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _loads(raw: str):
+    value = json.loads(raw)
+    if isinstance(value, dict) and "memos" in value:
+        for m in value["memos"]:
+            m["created_at"] = datetime.fromisoformat(m["created_at"])
+    return value
+
+
+# 環境変数からキャッシュを作る
+def snapshot_cache_from_env() -> MemoSnapshotCache:
+    """MEMO_SNAPSHOT_CACHE（memory / redis / off）に応じたバックエンドで MemoSnapshotCache を作る。
+
+    redis にすると全ワーカーで共有する。memory はワーカーごとに持つ。
+    """
+    kind = os.getenv("MEMO_SNAPSHOT_CACHE", "memory")
+    ttl = float(os.getenv("MEMO_SNAPSHOT_TTL", "600"))
+    if kind == "redis":
+        return MemoSnapshotCache(RedisCache(ttl=ttl, prefix="memosnap:"))
+    if kind == "memory":
+        return MemoSnapshotCache(LRUCache(
+            max_entries=int(os.getenv("MEMO_SNAPSHOT_MAX_ENTRIES", "4096")),
+            max_bytes=int(os.getenv("MEMO_SNAPSHOT_MAX_BYTES", str(8 * 1024 * 1024))),
+            ttl=ttl,
+        ))
+    return MemoSnapshotCache(None)
@@ -0,0 +1,357 @@
+# metrics.py
+import os
+import re
+import json
+import time
+import glob
+import fcntl
+import atexit
+import bisect
+import hashlib
+import logging
+import tempfile
+import functools
+import threading
+from contextlib import contextmanager
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+
+logger = logging.getLogger(__name__)
+
+# 秒単位のヒストグラムのバケット
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# uWSGI の各ワーカーが集計結果を書き出すディレクトリ（/metrics はここを合算する）
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "memo-rag-metrics"))
+
+# 集計結果をファイルに書き出す間隔（秒）。リクエストがなくてもこの間隔でバックグラウンドで書き出す
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# レスポンスに Server-Timing ヘッダを付けるか
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+_HELP = {
+    "http_request_seconds": "HTTP request latency",
+    "db_query_seconds": "MySQL statement latency by fingerprint",
+    "db_rows_total": "Rows returned or affected by fingerprint",
+    "db_reads_total": "SELECTs by where they ran (primary, replica, or fallback after a replica error)",
+    "llm_request_seconds": "OpenAI chat completion latency",
+    "llm_prompt_tokens_total": "Prompt tokens sent to OpenAI",
+    "llm_completion_tokens_total": "Completion tokens received from OpenAI",
+    "llm_cache_requests_total": "LLM cache lookups by result",
+    "llm_retries_total": "OpenAI requests retried after a transient failure",
+    "llm_hedges_total": "Hedged OpenAI requests fired and won",
+    "llm_circuit_open_total": "Times the OpenAI circuit breaker opened",
+    "llm_rejected_total": "OpenAI calls rejected while the circuit breaker was open",
+    "llm_degraded_total": "Searches served without an AI step by stage",
+    "admission_requests_total": "LLM-bound requests by admission result (admitted, queued, shed, timeout)",
+    "admission_wait_seconds": "Time LLM-bound requests waited for a concurrency slot",
+    "singleflight_requests_total": "LLM requests by single-flight role (leader, coalesced, remote)",
+    "memo_snapshot_requests_total": "Per-user memo page and count cache lookups by result",
+    "log_records_dropped_total": "Log records dropped because the log queue was full",
+    "llm_context_tokens_total": "Tokens of memo context packed into answer prompts",
+    "llm_context_memos_total": "Candidate memos packed, truncated or left out of answer prompts",
+    "markdown_render_seconds": "Markdown rendering and sanitizing latency",
+    "memo_html_stale_total": "Memo views rendered on the fly because the stored HTML was stale",
+    "template_render_seconds": "Jinja template rendering latency",
+}
+
+
+class Registry:
+    """プロセス内のカウンタとヒストグラム。ラベルは (名前, 値) のタプルで持つ。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}  # (name, labels) -> 値
+        self._histograms = {}  # (name, labels) -> [バケットごとの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+        self._flushed_at = 0.0
+        self._changes = 0  # inc/observe の回数（前回の書き出しから変わったかを調べる）
+        self._flushed_changes = -1
+        self._flusher_pid = None
+
+    def inc(self, name: str, amount: float = 1.0, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+            self._changes += 1
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+            self._changes += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._flushed_changes = self._changes
+            return {
+                "counters": [[n, list(l), v] for (n, l), v in self._counters.items()],
+                "histograms": [[n, list(l), list(h)] for (n, l), h in self._histograms.items()],
+            }
+
+    def flush(self, force: bool = False):
+        """集計結果を METRICS_DIR/<pid>.json に書き出す（前回から METRICS_FLUSH_INTERVAL 秒以内なら省く）。"""
+        now = time.monotonic()
+        if not force and now - self._flushed_at < METRICS_FLUSH_INTERVAL:
+            return
+        self._flushed_at = now
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"metrics flush failed: {e}")
+
+    def start_flusher(self):
+        """METRICS_FLUSH_INTERVAL ごとに書き出すスレッドと、終了時の書き出しを登録する（プロセスごとに1回）。
+
+        fork したワーカーには親のスレッドが引き継がれないので、pid が変わっていたら起動し直す。
+        """
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+        with self._lock:
+            if self._flusher_pid == pid:
+                return
+            self._flusher_pid = pid
+        threading.Thread(target=self._flush_loop, args=(pid,), name="metrics-flush", daemon=True).start()
+        atexit.register(self._flush_at_exit, pid)
+
+    def _flush_loop(self, pid: int):
+        while self._flusher_pid == pid:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            if self._changes != self._flushed_changes:
+                self.flush(force=True)
+
+    def _flush_at_exit(self, pid: int):
+        # fork した子の終了時に、親の pid で登録したものは実行しない
+        if os.getpid() == pid:
+            self.flush(force=True)
+
+
+registry = Registry()
+
+
+# SQL 文の指紋を作る
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql: str) -> str:
+    """空白や IN/VALUES のプレースホルダ数の違いを無視した、短い SQL の識別子を返す。"""
+    s = re.sub(r"\s+", " ", sql).strip()
+    s = re.sub(r"\((?:%s\s*,\s*)+%s\)", "(%s,...)", s)
+    s = re.sub(r"(\(%s(?:,%s)*\))(?:\s*,\s*\(%s(?:,%s)*\))+", r"\1,...", s)
+    digest = hashlib.sha1(s.encode("utf-8")).hexdigest()[:8]
+    return f"{s[:60]}#{digest}"
+
+
+class Span:
+    """計測中の区間。rows などの付加情報を後から設定できる。"""
+
+    def __init__(self):
+        self.rows = None
+        self.elapsed = 0.0
+
+
+# 区間の所要時間を計測する
+@contextmanager
+def span(metric: str, timing_name: str, **labels):
+    """所要時間をヒストグラム metric に記録し、リクエスト中なら Server-Timing 用にも積算する。"""
+    sp = Span()
+    started = time.perf_counter()
+    try:
+        yield sp
+    finally:
+        sp.elapsed = time.perf_counter() - started
+        registry.observe(metric, sp.elapsed, **labels)
+        if sp.rows is not None and metric == "db_query_seconds":
+            registry.inc("db_rows_total", max(0, sp.rows), **labels)
+        _add_server_timing(timing_name, sp.elapsed)
+
+
+def _add_server_timing(name: str, elapsed: float):
+    if not (SERVER_TIMING and has_request_context()):
+        return
+    timings = g.setdefault("_server_timing", {})
+    total, count = timings.get(name, (0.0, 0))
+    timings[name] = (total + elapsed, count + 1)
+
+
+# LLM 呼び出しの結果を記録する
+def record_llm(model: str, elapsed: float, usage=None):
+    """OpenAI 呼び出しの所要時間とトークン数を記録する。"""
+    registry.observe("llm_request_seconds", elapsed, model=model)
+    if usage is not None:
+        registry.inc("llm_prompt_tokens_total", usage.prompt_tokens or 0, model=model)
+        registry.inc("llm_completion_tokens_total", usage.completion_tokens or 0, model=model)
+    _add_server_timing("llm", elapsed)
+
+
+# 終了したワーカーの集計結果をまとめるファイル
+_DEAD_FILE = "dead.json"
+
+
+def _merge(counters: dict, histograms: dict, snap: dict):
+    for name, labels, value in snap.get("counters", []):
+        key = (name, tuple(tuple(l) for l in labels))
+        counters[key] = counters.get(key, 0.0) + value
+    for name, labels, h in snap.get("histograms", []):
+        key = (name, tuple(tuple(l) for l in labels))
+        acc = histograms.setdefault(key, [0] * len(h))
+        for i, v in enumerate(h):
+            acc[i] += v
+
+
+def _read(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _collect_dead_workers():
+    """終了したワーカーの <pid>.json を dead.json に足し込んで消す。
+
+    ワーカーが入れ替わるたびにファイルが増え続けないようにする。合計は減らないので、
+    Prometheus のカウンタはリセットされたように見えない。
+    """
+    dead = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        stem = os.path.basename(path)[:-len(".json")]
+        if stem.isdigit() and int(stem) != os.getpid() and not _pid_alive(int(stem)):
+            dead.append(path)
+    if not dead:
+        return
+    dead_path = os.path.join(METRICS_DIR, _DEAD_FILE)
+    counters, histograms = {}, {}
+    for path in [dead_path] + dead:
+        snap = _read(path)
+        if snap is not None:
+            _merge(counters, histograms, snap)
+    tmp = dead_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({
+            "counters": [[n, list(l), v] for (n, l), v in counters.items()],
+            "histograms": [[n, list(l), h] for (n, l), h in histograms.items()],
+        }, f)
+    os.replace(tmp, dead_path)
+    for path in dead:
+        os.remove(path)
+
+
+@contextmanager
+def _dir_lock():
+    """METRICS_DIR の合算・片付けを、同時に /metrics を処理する他のワーカーと排他する。"""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# 全ワーカーの集計結果を Prometheus 形式で出力する
+def render_prometheus() -> str:
+    """METRICS_DIR にある全ワーカー（終了したものを含む）の集計結果を合算し、Prometheus のテキスト形式で返す。"""
+    registry.flush(force=True)
+    counters, histograms = {}, {}
+    with _dir_lock():
+        try:
+            _collect_dead_workers()
+        except OSError as e:
+            logger.warning(f"metrics cleanup failed: {e}")
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            snap = _read(path)
+            if snap is not None:
+                _merge(counters, histograms, snap)
+
+    lines = []
+    for name in sorted({n for n, _ in counters} | {n for n, _ in histograms}):
+        kind = "histogram" if any(n == name for n, _ in histograms) else "counter"
+        lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            continue
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(registry.buckets, h):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{name}_sum{_labels(labels)} {h[-2]}")
+            lines.append(f"{name}_count{_labels(labels)} {h[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+
+# Flask アプリに計測用のフックを登録する
+def init_app(app):
+    """リクエストとテンプレート描画の計測、Server-Timing ヘッダの付与を登録する。"""
+
+    @app.before_request
+    def _start_request_timer():
+        g._request_started = time.perf_counter()
+
+    @app.after_request
+    def _finish_request_timer(response):
+        started = g.pop("_request_started", None)
+        if started is not None:
+            registry.observe(
+                "http_request_seconds", time.perf_counter() - started,
+                endpoint=request.endpoint or "unknown", method=request.method, status=str(response.status_code)
+            )
+        timings = g.pop("_server_timing", None)
+        if timings:
+            response.headers["Server-Timing"] = ", ".join(
+                f'{name};dur={total * 1000:.1f};desc="{count}x"' for name, (total, count) in timings.items()
+            )
+        registry.start_flusher()
+        registry.flush()
+        return response
+
+    def _before_template(sender, template, context, **extra):
+        g.setdefault("_template_started", []).append(time.perf_counter())
+
+    def _after_template(sender, template, context, **extra):
+        stack = g.get("_template_started")
+        if not stack:
+            return
+        elapsed = time.perf_counter() - stack.pop()
+        registry.observe("template_render_seconds", elapsed, template=template.name or "unknown")
+        _add_server_timing("template", elapsed)
+
+    before_render_template.connect(_before_template, app, weak=False)
+    template_rendered.connect(_after_template, app, weak=False)
@@ -0,0 +1,280 @@
+# migrate.py
+"""migrations/ の SQL を番号順に適用してスキーマを更新する。
+
+    python migrate.py             # 未適用のマイグレーションをすべて適用する
+    python migrate.py status      # 適用済み・未適用の一覧を表示する
+    python migrate.py up --target 5
+    python migrate.py baseline 5  # 5 まで適用済みとして記録する（実行はしない）
+
+適用済みの番号と SQL 文のハッシュは schema_migrations に記録する。適用済みのファイルの SQL 文を
+書き換えるとエラーにするので、スキーマの変更は必ず新しい番号のファイルで行うこと（コメントは直してよい）。
+MySQL の DDL はトランザクションにできないため、ファイルの途中で失敗したら手で直してから再実行する。
+"""
+import os
+import re
+import sys
+import hashlib
+import logging
+import argparse
+from typing import NamedTuple
+
+from db_connect import get_db
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# 同時に起動した複数のコンテナが同じマイグレーションを実行しないよう、この名前でロックを取る（秒）
+MIGRATE_LOCK_NAME = "schema_migrations"
+MIGRATE_LOCK_TIMEOUT = int(os.getenv("MIGRATE_LOCK_TIMEOUT", "60"))
+
+_FILENAME = re.compile(r"^(\d+)_([\w-]+)\.sql$")
+
+_CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+  version INT PRIMARY KEY,
+  name VARCHAR(255) NOT NULL,
+  checksum CHAR(64) NOT NULL,
+  applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) CHARACTER SET utf8mb4
+  COLLATE utf8mb4_unicode_ci
+"""
+
+# schema_migrations がない（mysql/init.sql で作った）DB が、どの番号まで適用済みかを判定する。
+# 新しい番号から順に、その番号で追加したものがあるかを調べる
+_LEGACY_PROBES = [
+    (5, "SELECT 1 FROM information_schema.tables WHERE table_schema=DATABASE() AND table_name='tag_counts'"),
+    (4, "SELECT 1 FROM information_schema.columns"
+        " WHERE table_schema=DATABASE() AND table_name='users' AND column_name='memo_version'"),
+    (3, "SELECT 1 FROM information_schema.tables WHERE table_schema=DATABASE() AND table_name='memo_related'"),
+    (2, "SELECT 1 FROM information_schema.columns"
+        " WHERE table_schema=DATABASE() AND table_name='memos' AND column_name='body_html'"),
+    (1, "SELECT 1 FROM information_schema.tables WHERE table_schema=DATABASE() AND table_name='memos'"),
+]
+
+
+class MigrationError(Exception):
+    """マイグレーションを適用できないことを表す。"""
+
+
+# コメントを直す前に記録されたハッシュ（番号 -> ハッシュ）。SQL 文は同じなので適用済みとして扱う
+_PREVIOUS_CHECKSUMS = {
+    6: {"a5246b4ca0fb5234922ebdba7923c1ea580d4bc0e5c19f3e2c2dc6e45fc662ac"},
+}
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+    checksum: str  # コメントと空白を除いた SQL 文のハッシュ
+    file_checksum: str  # ファイル全体のハッシュ（以前はこれを記録していた）
+
+    def matches(self, recorded: str) -> bool:
+        """記録されたハッシュが、このファイルの SQL 文と同じものかを返す。"""
+        return recorded in (self.checksum, self.file_checksum) or recorded in _PREVIOUS_CHECKSUMS.get(self.version, ())
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# migrations/ のファイルを読み込む
+def load_migrations(directory: str = MIGRATIONS_DIR) -> list[Migration]:
+    """NNNN_name.sql のファイルを番号順に返す。番号が重複していれば MigrationError。"""
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = _FILENAME.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError(f"duplicate migration version {version}: {filename}")
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            sql = f.read()
+        migrations[version] = Migration(
+            version, match.group(2), sql, _sha256("\n".join(split_statements(sql))), _sha256(sql)
+        )
+    return [migrations[v] for v in sorted(migrations)]
+
+
+# SQL ファイルを文ごとに分ける
+def split_statements(sql: str) -> list[str]:
+    """; で文を区切る。文字列リテラル内の ; と、コメント（空白が続く --、#）は区切りとして扱わない。
+
+    MySQL と同じく、-- の後に空白が続かないもの（1--1 など）はコメントではない。
+    """
+    statements, current = [], []
+    quote = None
+    i = 0
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            current.append(ch)
+            if ch == "\\" and quote != "`" and i + 1 < len(sql):
+                current.append(sql[i + 1])
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in ("'", '"', "`"):
+            quote = ch
+            current.append(ch)
+        elif ch == "#" or (sql.startswith("--", i) and (i + 2 == len(sql) or sql[i + 2].isspace())):
+            end = sql.find("\n", i)
+            i = len(sql) if end < 0 else end
+            continue
+        elif ch == ";":
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    statements.append("".join(current).strip())
+    return [s for s in statements if s]
+
+
+def _applied(con) -> dict[int, str]:
+    with con.cursor() as cur:
+        cur.execute("SELECT version, checksum FROM schema_migrations")
+        return {r["version"]: r["checksum"] for r in cur.fetchall()}
+
+
+def _record(con, migration: Migration):
+    with con.cursor() as cur:
+        cur.execute(
+            "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+            (migration.version, migration.name, migration.checksum),
+        )
+
+
+def _legacy_version(con) -> int:
+    with con.cursor() as cur:
+        for version, probe in _LEGACY_PROBES:
+            cur.execute(probe)
+            if cur.fetchone():
+                return version
+    return 0
+
+
+def _ensure_table(con, migrations: list[Migration]):
+    """schema_migrations を作る。init.sql で作った既存の DB なら、判定した番号までを適用済みとして記録する。"""
+    with con.cursor() as cur:
+        cur.execute("SELECT 1 FROM information_schema.tables"
+                    " WHERE table_schema=DATABASE() AND table_name='schema_migrations'")
+        if cur.fetchone():
+            return
+        legacy = _legacy_version(con)
+        cur.execute(_CREATE_TABLE_SQL)
+    if legacy:
+        logger.info(f"existing schema detected; recording migrations up to {legacy} as applied")
+        for m in migrations:
+            if m.version <= legacy:
+                _record(con, m)
+
+
+class _Lock:
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        with self.con.cursor() as cur:
+            cur.execute("SELECT GET_LOCK(%s, %s) AS ok", (MIGRATE_LOCK_NAME, MIGRATE_LOCK_TIMEOUT))
+            if not cur.fetchone()["ok"]:
+                raise MigrationError(f"another migration is running (waited {MIGRATE_LOCK_TIMEOUT}s)")
+        return self
+
+    def __exit__(self, *exc):
+        with self.con.cursor() as cur:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (MIGRATE_LOCK_NAME,))
+
+
+# 未適用のマイグレーションを適用する
+def migrate(con, target: int | None = None, migrations: list[Migration] | None = None) -> list[Migration]:
+    """target（省略時は最新）までの未適用のマイグレーションを番号順に適用し、適用したものを返す。
+
+    適用済みのファイルが書き換えられていたら、何も適用せずに MigrationError を送出する。
+    """
+    migrations = load_migrations() if migrations is None else migrations
+    with _Lock(con):
+        _ensure_table(con, migrations)
+        applied = _applied(con)
+        for m in migrations:
+            if m.version in applied and not m.matches(applied[m.version]):
+                raise MigrationError(f"migration {m.version}_{m.name} was modified after it was applied")
+        done = []
+        for m in migrations:
+            if m.version in applied or (target is not None and m.version > target):
+                continue
+            logger.info(f"applying migration {m.version}_{m.name}")
+            for n, statement in enumerate(split_statements(m.sql), 1):
+                try:
+                    with con.cursor() as cur:
+                        cur.execute(statement)
+                except Exception as e:
+                    raise MigrationError(f"migration {m.version}_{m.name} failed at statement {n}: {e}") from e
+            _record(con, m)
+            done.append(m)
+        return done
+
+
+# 適用済みとして記録する
+def baseline(con, version: int, migrations: list[Migration] | None = None) -> list[Migration]:
+    """version までのマイグレーションを、実行せずに適用済みとして記録する（手で作った DB 用）。"""
+    migrations = load_migrations() if migrations is None else migrations
+    with _Lock(con):
+        _ensure_table(con, migrations)
+        applied = _applied(con)
+        recorded = [m for m in migrations if m.version <= version and m.version not in applied]
+        for m in recorded:
+            _record(con, m)
+        return recorded
+
+
+def status(con, migrations: list[Migration] | None = None) -> list[tuple[Migration, str]]:
+    """(マイグレーション, applied / pending / modified) の一覧を返す。"""
+    migrations = load_migrations() if migrations is None else migrations
+    with con.cursor() as cur:
+        cur.execute("SELECT 1 FROM information_schema.tables"
+                    " WHERE table_schema=DATABASE() AND table_name='schema_migrations'")
+        applied = _applied(con) if cur.fetchone() else {}
+    result = []
+    for m in migrations:
+        if m.version not in applied:
+            result.append((m, "pending"))
+        else:
+            result.append((m, "applied" if m.matches(applied[m.version]) else "modified"))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command")
+    up = sub.add_parser("up", help="未適用のマイグレーションを適用する（既定）")
+    up.add_argument("--target", type=int, help="この番号まで適用する")
+    sub.add_parser("status", help="適用状況を表示する")
+    base = sub.add_parser("baseline", help="指定した番号まで適用済みとして記録する")
+    base.add_argument("version", type=int)
+    args = parser.parse_args()
+
+    con = get_db()
+    try:
+        if args.command == "status":
+            for m, state in status(con):
+                print(f"{m.version:04d} {m.name:<32s} {state}")
+        elif args.command == "baseline":
+            recorded = baseline(con, args.version)
+            print(f"recorded {len(recorded)} migration(s) as applied")
+        else:
+            done = migrate(con, target=getattr(args, "target", None))
+            print(f"applied {len(done)} migration(s)")
+    except MigrationError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
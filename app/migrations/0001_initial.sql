@@ -1,10 +1,5 @@
-SET NAMES utf8mb4 COLLATE utf8mb4_unicode_ci;
-
-CREATE DATABASE IF NOT EXISTS memodb
-  DEFAULT CHARACTER SET utf8mb4
-  COLLATE utf8mb4_unicode_ci;
-
-USE memodb;
+-- 初期スキーマと初期データ（元の mysql/init.sql）
+ALTER DATABASE CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 
 CREATE TABLE IF NOT EXISTS users (
   id VARCHAR(36) PRIMARY KEY,
@@ -60,4 +55,4 @@ INSERT IGNORE INTO memos (id, user_id, body, visibility, password) VALUES
 ('dummy_admin_memo_id3', 'dummy_admin_id', '今年度の目標: flag{dummy_flag5}', 'secret', 'dummy_admin_memo_pass1');
 
 INSERT IGNORE INTO memos (id, user_id, body, visibility, password) VALUES
-('dummy_super_admin_memo_id1', 'dummy_super_admin_id', '合言葉: flag{dummy_flag6}', 'secret', 'dummy_super_admin_memo_pass1');
\ No newline at end of file
+('dummy_super_admin_memo_id1', 'dummy_super_admin_id', '合言葉: flag{dummy_flag6}', 'secret', 'dummy_super_admin_memo_pass1');
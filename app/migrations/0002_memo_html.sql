@@ -0,0 +1,5 @@
+-- 保存時に描画したメモの HTML（memo_html を参照）
+ALTER TABLE memos
+  ADD COLUMN body_html MEDIUMTEXT,
+  ADD COLUMN body_hash CHAR(64),
+  ADD COLUMN render_version VARCHAR(16);
@@ -0,0 +1,19 @@
+-- 計算済みの類似メモ（get_related_memos を参照）
+CREATE TABLE IF NOT EXISTS memo_related (
+  memo_id VARCHAR(36) NOT NULL,
+  related_id VARCHAR(36) NOT NULL,
+  score DOUBLE NOT NULL,
+  PRIMARY KEY (memo_id, related_id),
+  KEY idx_memo_related_related_id (related_id),
+  FOREIGN KEY (memo_id) REFERENCES memos(id) ON DELETE CASCADE,
+  FOREIGN KEY (related_id) REFERENCES memos(id) ON DELETE CASCADE
+) CHARACTER SET utf8mb4
+  COLLATE utf8mb4_unicode_ci;
+
+-- memo_related を計算済みのメモ（類似メモが0件でも行を持つ）
+CREATE TABLE IF NOT EXISTS memo_related_state (
+  memo_id VARCHAR(36) PRIMARY KEY,
+  computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (memo_id) REFERENCES memos(id) ON DELETE CASCADE
+) CHARACTER SET utf8mb4
+  COLLATE utf8mb4_unicode_ci;
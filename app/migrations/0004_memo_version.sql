@@ -0,0 +1,2 @@
+-- メモ・タグを書き換えるたびに上げる（メモ一覧のキャッシュのキー）
+ALTER TABLE users ADD COLUMN memo_version INT NOT NULL DEFAULT 0;
@@ -0,0 +1,25 @@
+-- タグ検索をこの表の索引だけで並べ替え・絞り込みできるよう、メモの作成日時と公開範囲を写しておく
+-- （既存の行を埋めてから NOT NULL にする）
+ALTER TABLE memo_tags
+  ADD COLUMN memo_created_at TIMESTAMP NULL,
+  ADD COLUMN memo_visibility ENUM('public','private','secret') NULL;
+
+UPDATE memo_tags mt JOIN memos m ON m.id = mt.memo_id
+SET mt.memo_created_at = m.created_at, mt.memo_visibility = m.visibility;
+
+ALTER TABLE memo_tags
+  MODIFY memo_created_at TIMESTAMP NOT NULL,
+  MODIFY memo_visibility ENUM('public','private','secret') NOT NULL,
+  ADD KEY idx_memo_tags_tag_created (tag_id, memo_created_at, memo_id, memo_visibility);
+
+-- タグごとの（秘密メモを除く）メモ数。attach_tags_bulk と delete_memo が更新する
+CREATE TABLE IF NOT EXISTS tag_counts (
+  tag_id INT PRIMARY KEY,
+  memo_count INT NOT NULL DEFAULT 0,
+  KEY idx_tag_counts_count (memo_count DESC, tag_id),
+  FOREIGN KEY (tag_id) REFERENCES tags(id) ON DELETE CASCADE
+) CHARACTER SET utf8mb4
+  COLLATE utf8mb4_unicode_ci;
+
+INSERT IGNORE INTO tag_counts (tag_id, memo_count)
+SELECT tag_id, COUNT(*) FROM memo_tags WHERE memo_visibility <> 'secret' GROUP BY tag_id;
@@ -0,0 +1,10 @@
+-- memos の主な読み方に合わせた索引（bench/query_plans.py で全表走査がないことを確かめる）
+
+-- ユーザーのメモ一覧（load_user_page・count_user_memos）: user_id で絞り、作成日時・id の順にそのまま読む
+ALTER TABLE memos ADD KEY idx_memos_user_created (user_id, created_at);
+
+-- 公開範囲付きの検索（search_memos・search_memos_local の確認）: user_id と visibility で絞る
+ALTER TABLE memos ADD KEY idx_memos_user_visibility (user_id, visibility, created_at);
+
+-- 本文の部分一致で最初の投稿者を探す（get_author_by_body）: 古い順に読み、最初に一致した行で止める
+ALTER TABLE memos ADD KEY idx_memos_created (created_at);
@@ -0,0 +1,2 @@
+-- 追加順の連番。各ワーカーのローカル検索索引が、前回読んだ seq より後のメモだけを取り込む（helpers._sync_memo_index）
+ALTER TABLE memos ADD COLUMN seq BIGINT UNSIGNED NOT NULL AUTO_INCREMENT, ADD UNIQUE KEY idx_memos_seq (seq);
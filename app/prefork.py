@@ -0,0 +1,45 @@
+# prefork.py
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# uWSGI のマスターで重いモジュールを読み込んでから fork する（ワーカーはメモリを共有して速く起動する）
+PRELOAD_MODULES = os.getenv("PRELOAD_MODULES", "0") == "1"
+
+_hooks = []
+_hooks_pid = os.getpid()
+
+
+# fork 後に子プロセスで実行する処理を登録する
+def post_fork(fn):
+    """デコレータ。fork した子プロセス（uWSGI のワーカー）の起動時に fn() を1回実行する。
+
+    親の接続やスレッドを引き継がないよう、クライアントを捨てる処理を登録する。
+    """
+    _hooks.append(fn)
+    return fn
+
+
+def _run_post_fork_hooks():
+    global _hooks_pid
+    # os.fork と uWSGI の両方から呼ばれうるので、プロセスごとに1回だけ実行する
+    if _hooks_pid == os.getpid():
+        return
+    _hooks_pid = os.getpid()
+    for fn in _hooks:
+        try:
+            fn()
+        except Exception as e:
+            logger.warning(f"post-fork hook {fn.__qualname__} failed: {e}")
+
+
+os.register_at_fork(after_in_child=_run_post_fork_hooks)
+
+try:
+    # uWSGI は C の fork() でワーカーを作るので、uWSGI のフックにも登録する
+    from uwsgidecorators import postfork as _uwsgi_postfork
+except ImportError:
+    _uwsgi_postfork = None
+if _uwsgi_postfork is not None:
+    _uwsgi_postfork(_run_post_fork_hooks)
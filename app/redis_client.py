@@ -0,0 +1,24 @@
+# redis_client.py
+import os
+import threading
+
+import redis
+
+# レートリミットやキャッシュで共有する Redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+# Redis クライアントを取得する
+def get_redis() -> redis.Redis:
+    """プロセスごとに1つの Redis クライアントを遅延生成して返す（fork 後は作り直す）。"""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = redis.Redis.from_url(REDIS_URL, socket_timeout=1.0, socket_connect_timeout=1.0)
+                _client_pid = os.getpid()
+    return _client
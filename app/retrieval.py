@@ -0,0 +1,126 @@
+# retrieval.py
+import math
+import re
+import threading
+import unicodedata
+import zlib
+from collections import Counter, defaultdict
+
+# NumPy があればハッシュベクトルのコサイン類似度もスコアに加える
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy は任意
+    np = None
+
+_WORD_RE = re.compile(r"\w+")
+
+
+# 文字 n-gram に分割する
+def tokenize(text: str, n: int = 2) -> list[str]:
+    """NFKC 正規化・小文字化した本文を単語ごとの文字 n-gram に分割する（日本語も分かち書き不要）。"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for seg in _WORD_RE.findall(text):
+        if len(seg) <= n:
+            tokens.append(seg)
+        else:
+            tokens.extend(seg[i:i + n] for i in range(len(seg) - n + 1))
+    return tokens
+
+
+class MemoIndex:
+    """メモ本文の文字 n-gram 転置インデックス。BM25 と任意のハッシュベクトル類似度で検索する。
+
+    add/remove で1件ずつ更新でき、複数スレッドから同時に使える。
+    """
+
+    def __init__(self, n: int = 2, k1: float = 1.2, b: float = 0.75,
+                 dim: int = 1024, vector_weight: float = 1.0):
+        self.n = n
+        self.k1 = k1
+        self.b = b
+        self.dim = dim
+        self.vector_weight = vector_weight if np is not None else 0.0
+        self._lock = threading.RLock()
+        self._docs = {}  # memo_id -> (user_id, visibility, 文書長)
+        self._postings = defaultdict(dict)  # token -> {memo_id: 出現回数}
+        self._terms = {}  # memo_id -> 含まれる token の集合
+        self._vectors = {}  # memo_id -> 正規化済みハッシュベクトル
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, memo_id):
+        return memo_id in self._docs
+
+    def _embed(self, tf: Counter):
+        """token の出現回数を符号付きハッシュで dim 次元に射影し、L2 正規化して返す。"""
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for tok, cnt in tf.items():
+            h = zlib.crc32(tok.encode("utf-8"))
+            vec[h % self.dim] += cnt if (h >> 31) & 1 else -cnt
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    def add(self, memo_id: str, user_id: str, visibility: str, body: str):
+        """メモを登録する（既にあれば置き換える）。"""
+        tf = Counter(tokenize(body, self.n))
+        with self._lock:
+            self.remove(memo_id)
+            length = sum(tf.values())
+            self._docs[memo_id] = (user_id, visibility, length)
+            self._terms[memo_id] = set(tf)
+            for tok, cnt in tf.items():
+                self._postings[tok][memo_id] = cnt
+            self._total_len += length
+            if self.vector_weight:
+                self._vectors[memo_id] = self._embed(tf)
+
+    def remove(self, memo_id: str):
+        """メモを取り除く。未登録なら何もしない。"""
+        with self._lock:
+            doc = self._docs.pop(memo_id, None)
+            if doc is None:
+                return
+            self._total_len -= doc[2]
+            for tok in self._terms.pop(memo_id, ()):
+                posting = self._postings.get(tok)
+                if posting is not None:
+                    posting.pop(memo_id, None)
+                    if not posting:
+                        del self._postings[tok]
+            self._vectors.pop(memo_id, None)
+
+    def search(self, query: str, user_ids, visibilities, k: int = 5) -> list[tuple[str, float]]:
+        """指定ユーザー・公開範囲のメモから、クエリに近い上位 k 件を (memo_id, score) で返す。
+
+        visibilities は SQL の IN 句と同じく要素ごとに一致判定する。
+        """
+        qtf = Counter(tokenize(query, self.n))
+        if not qtf:
+            return []
+        user_ids = set(user_ids)
+        visibilities = set(visibilities)
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs:
+                return []
+            avgdl = self._total_len / n_docs or 1.0
+            scores = defaultdict(float)
+            for tok, qcnt in qtf.items():
+                posting = self._postings.get(tok)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for mid, tf in posting.items():
+                    uid, vis, dl = self._docs[mid]
+                    if uid not in user_ids or vis not in visibilities:
+                        continue
+                    denom = tf + self.k1 * (1 - self.b + self.b * dl / avgdl)
+                    scores[mid] += qcnt * idf * tf * (self.k1 + 1) / denom
+            if self.vector_weight and scores:
+                qvec = self._embed(qtf)
+                for mid in scores:
+                    scores[mid] += self.vector_weight * float(self._vectors[mid] @ qvec)
+        return sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:k]
@@ -0,0 +1,213 @@
+# singleflight.py
+import os
+import time
+import uuid
+import asyncio
+import logging
+import threading
+
+import metrics
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# 呼び出し中の処理を待つ時間の上限（秒）。過ぎたら待つのをやめて自分で実行する
+SINGLEFLIGHT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_TIMEOUT", "60"))
+
+# 他のワーカーへ結果を渡すために Redis に置いておく時間（秒）
+SINGLEFLIGHT_RESULT_TTL = float(os.getenv("SINGLEFLIGHT_RESULT_TTL", "5"))
+
+# 他のワーカーの結果を待つときに Redis を確認する間隔（秒）
+SINGLEFLIGHT_POLL_INTERVAL = 0.05
+
+# 自分が取ったロックだけを消す
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class _Call:
+    """実行中の呼び出し。終わると done がセットされ、result か error が入る。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら新たに実行せず、その結果を待って受け取る。
+
+    プロセス内のスレッドとコルーチンの間でまとめ、redis_lock=True なら Redis のロックで
+    ワーカー間でもまとめる。結果は Redis で受け渡せるよう文字列に限る。
+    """
+
+    def __init__(self, enabled: bool = True, redis_lock: bool = False,
+                 timeout: float = SINGLEFLIGHT_TIMEOUT, prefix: str = "singleflight:"):
+        self.enabled = enabled
+        self.redis_lock = redis_lock
+        self.timeout = timeout
+        self.prefix = prefix
+        self._calls = {}  # key -> _Call
+        self._futures = {}  # key -> asyncio.Future
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn) -> str:
+        """fn() を実行して結果を返す。同じ key の fn() が実行中ならその結果を返す。"""
+        if not self.enabled:
+            return fn()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            metrics.registry.inc("singleflight_requests_total", result="coalesced")
+            if not call.done.wait(self.timeout):
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run_shared(key, fn)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    async def do_async(self, key: str, fn) -> str:
+        """do() の非同期版。fn() はコルーチンを返す関数。"""
+        if not self.enabled:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        fut = self._futures.get(key)
+        if fut is not None and fut.get_loop() is loop:
+            metrics.registry.inc("singleflight_requests_total", result="coalesced")
+            try:
+                return await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # 先に実行していたリクエストが切断されたときは自分で実行し直す
+                if not fut.cancelled():
+                    raise
+            return await fn()
+
+        fut = self._futures[key] = loop.create_future()
+        try:
+            result = await self._run_shared_async(key, fn)
+            fut.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 待っている人がいなくても警告を出さない
+            raise
+        finally:
+            if self._futures.get(key) is fut:
+                del self._futures[key]
+
+    # --- ワーカー間（Redis） ---
+
+    def _keys(self, key: str) -> tuple[str, str]:
+        return self.prefix + "lock:" + key, self.prefix + "result:" + key
+
+    def _acquire(self, key: str) -> str | None:
+        """ロックを取れたらトークンを、他のワーカーが実行中なら None を返す。Redis が使えなければ空文字。"""
+        lock_key, _ = self._keys(key)
+        token = uuid.uuid4().hex
+        try:
+            if get_redis().set(lock_key, token, nx=True, px=int(self.timeout * 1000)):
+                return token
+            return None
+        except Exception as e:
+            logger.warning(f"singleflight lock failed: {e}")
+            return ""
+
+    def _publish(self, key: str, token: str, result: str | None):
+        """結果を置いてロックを外す。"""
+        lock_key, result_key = self._keys(key)
+        try:
+            r = get_redis()
+            if result is not None:
+                r.set(result_key, result, px=int(SINGLEFLIGHT_RESULT_TTL * 1000))
+            r.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            logger.warning(f"singleflight publish failed: {e}")
+
+    def _poll(self, key: str) -> tuple[str | None, bool]:
+        """(結果, まだ実行中か) を返す。"""
+        lock_key, result_key = self._keys(key)
+        try:
+            r = get_redis()
+            value = r.get(result_key)
+            if value is not None:
+                return value.decode("utf-8"), False
+            return None, bool(r.exists(lock_key))
+        except Exception as e:
+            logger.warning(f"singleflight poll failed: {e}")
+            return None, False
+
+    def _run_shared(self, key: str, fn) -> str:
+        if not self.redis_lock:
+            metrics.registry.inc("singleflight_requests_total", result="leader")
+            return fn()
+        token = self._acquire(key)
+        if token is None:
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                value, running = self._poll(key)
+                if value is not None:
+                    metrics.registry.inc("singleflight_requests_total", result="remote")
+                    return value
+                if not running:
+                    break  # 実行していたワーカーが失敗した
+                time.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+        metrics.registry.inc("singleflight_requests_total", result="leader")
+        result = None
+        try:
+            result = fn()
+            return result
+        finally:
+            if token:
+                self._publish(key, token, result)
+
+    async def _run_shared_async(self, key: str, fn) -> str:
+        if not self.redis_lock:
+            metrics.registry.inc("singleflight_requests_total", result="leader")
+            return await fn()
+        token = await asyncio.to_thread(self._acquire, key)
+        if token is None:
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                value, running = await asyncio.to_thread(self._poll, key)
+                if value is not None:
+                    metrics.registry.inc("singleflight_requests_total", result="remote")
+                    return value
+                if not running:
+                    break
+                await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+        metrics.registry.inc("singleflight_requests_total", result="leader")
+        result = None
+        try:
+            result = await fn()
+            return result
+        finally:
+            if token:
+                await asyncio.to_thread(self._publish, key, token, result)
+
+
+# 環境変数から SingleFlight を作る
+def flight_from_env() -> SingleFlight:
+    """SINGLEFLIGHT（local / redis / off）に応じた SingleFlight を返す。"""
+    kind = os.getenv("SINGLEFLIGHT", "local")
+    return SingleFlight(enabled=kind != "off", redis_lock=kind == "redis")
@@ -0,0 +1,361 @@
+# tag_queue.py
+import os
+import json
+import time
+import queue
+import random
+import socket
+import logging
+import threading
+from collections import defaultdict
+
+from redis_client import get_redis
+from helpers import generate_tags_batch, attach_tags_bulk, rerender_memos
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# 1回の LLM リクエストでタグ付けするメモ数の上限
+TAG_BATCH_SIZE = int(os.getenv("TAG_BATCH_SIZE", "8"))
+
+# 失敗時の再試行回数と待ち時間（秒、指数的に伸ばす）
+TAG_MAX_ATTEMPTS = int(os.getenv("TAG_MAX_ATTEMPTS", "5"))
+TAG_RETRY_BASE_DELAY = float(os.getenv("TAG_RETRY_BASE_DELAY", "2"))
+
+# タグ生成ワーカーの識別子（処理中リストの名前に使う。コンテナを作り直しても同じなら、起動時に前回の残りを戻せる）
+TAG_WORKER_ID = os.getenv("TAG_WORKER_ID", "") or f"{socket.gethostname()}:{os.getpid()}"
+
+# 生存確認の有効期間（秒）。これを過ぎたワーカーの処理中のジョブは他のワーカーが実行待ちに戻す。
+# 生存確認はバックグラウンドのスレッドが TAG_WORKER_TTL / 3 ごとに更新するので、長いバッチの途中でも切れない
+TAG_WORKER_TTL = int(os.getenv("TAG_WORKER_TTL", "120"))
+
+# ワーカーのループで予期しない例外が起きたときに待つ秒数（続けて起きるたびに倍にする）
+TAG_WORKER_ERROR_DELAY = float(os.getenv("TAG_WORKER_ERROR_DELAY", "1"))
+TAG_WORKER_MAX_ERROR_DELAY = 30.0
+
+# 止まったワーカーの処理中のジョブと、ジョブのなくなった pending を片付ける間隔（秒）
+TAG_RECOVER_INTERVAL = float(os.getenv("TAG_RECOVER_INTERVAL", "60"))
+
+# 再試行時刻を過ぎたジョブを1つだけ実行待ちに移す（ZREM と RPUSH を1つの操作にして、途中で落ちても消えないようにする）
+_PROMOTE_SCRIPT = """
+local raw = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1], 'LIMIT', 0, 1)[1]
+if not raw then return 0 end
+redis.call('ZREM', KEYS[1], raw)
+redis.call('RPUSH', KEYS[2], raw)
+return 1
+"""
+
+
+class RedisTagQueue:
+    """Redis のリストを使ったタグ生成ジョブのキュー。全ワーカーとタグ生成ワーカーで共有する。
+
+    - tagqueue:jobs     実行待ちのジョブ（JSON）
+    - tagqueue:delayed  再試行待ちのジョブ（実行可能になる時刻をスコアにした sorted set）
+    - tagqueue:pending  タグ付けが終わっていないメモIDの集合
+    - tagqueue:processing:<ワーカーID>  ワーカーが取り出して処理中のジョブ
+    - tagqueue:workers  処理中リストを持つワーカーIDの集合
+    - tagqueue:alive:<ワーカーID>  ワーカーの生存確認（TAG_WORKER_TTL 秒で消える）
+
+    取り出したジョブは処理中リストに移し、done() か retry() まで消さない。ワーカーが落ちても、
+    起動時と TAG_RECOVER_INTERVAL ごとの recover() で実行待ちに戻る。
+    """
+
+    def __init__(self, prefix: str = "tagqueue:", worker_id: str = TAG_WORKER_ID):
+        self.prefix = prefix
+        self.jobs_key = prefix + "jobs"
+        self.delayed_key = prefix + "delayed"
+        self.pending_key = prefix + "pending"
+        self.workers_key = prefix + "workers"
+        self.worker_id = worker_id
+        self.processing_key = self._processing_key(worker_id)
+        self._recovered_at = None
+        self._promote = None
+        self._heartbeat_pid = None
+
+    def enqueue(self, memo_id: str, user_id: str, body: str):
+        job = json.dumps({"memo_id": memo_id, "user_id": user_id, "body": body, "attempts": 0})
+        r = get_redis()
+        with r.pipeline() as p:
+            p.sadd(self.pending_key, memo_id)
+            p.rpush(self.jobs_key, job)
+            p.execute()
+
+    def is_pending(self, memo_id: str) -> bool:
+        try:
+            return bool(get_redis().sismember(self.pending_key, memo_id))
+        except Exception:
+            return False
+
+    def pop_batch(self, max_items: int, timeout: float = 5.0) -> list[dict]:
+        """ジョブを最大 max_items 件、このワーカーの処理中リストに移して返す。1件もなければ少し待つ。
+
+        Redis クライアントの socket_timeout（1秒）より長くはブロックしない。
+        """
+        r = get_redis()
+        self._start_heartbeat(r)
+        if self._recovered_at is None or time.monotonic() - self._recovered_at >= TAG_RECOVER_INTERVAL:
+            self.recover()
+        self._promote_delayed(r)
+        first = r.blmove(self.jobs_key, self.processing_key, min(timeout, 0.5), "LEFT", "RIGHT")
+        if first is None:
+            return []
+        raws = [first]
+        if max_items > 1:
+            with r.pipeline(transaction=False) as p:
+                for _ in range(max_items - 1):
+                    p.lmove(self.jobs_key, self.processing_key, "LEFT", "RIGHT")
+                raws += [raw for raw in p.execute() if raw is not None]
+        jobs = []
+        for raw in raws:
+            job = json.loads(raw)
+            job["_raw"] = raw
+            jobs.append(job)
+        return jobs
+
+    def retry(self, job: dict, delay: float):
+        data = {k: v for k, v in job.items() if k != "_raw"}
+        with get_redis().pipeline() as p:
+            p.lrem(self.processing_key, 1, job["_raw"])
+            p.zadd(self.delayed_key, {json.dumps(data): time.time() + delay})
+            p.execute()
+
+    def done(self, job: dict):
+        with get_redis().pipeline() as p:
+            p.lrem(self.processing_key, 1, job["_raw"])
+            p.srem(self.pending_key, job["memo_id"])
+            p.execute()
+
+    def requeue_unfinished(self):
+        """処理中に失敗したバッチの残りを、次の pop_batch() で実行待ちに戻す（Redis が落ちていても呼べる）。"""
+        self._recovered_at = None
+
+    def recover(self):
+        """止まったワーカー（と前回の自分）の処理中のジョブを実行待ちに戻し、ジョブのない pending を消す。"""
+        r = get_redis()
+        first_run = self._recovered_at is None
+        self._recovered_at = time.monotonic()
+        for raw_id in r.smembers(self.workers_key):
+            worker_id = raw_id.decode()
+            if worker_id == self.worker_id:
+                # 起動直後と requeue_unfinished() の後だけ戻す（それ以外は処理中のジョブそのもの）
+                if not first_run:
+                    continue
+            elif r.exists(self.prefix + "alive:" + worker_id):
+                continue
+            moved = 0
+            while r.lmove(self._processing_key(worker_id), self.jobs_key, "RIGHT", "LEFT") is not None:
+                moved += 1
+            if moved:
+                logger.warning(f"requeued {moved} tag job(s) left by worker {worker_id}")
+            if worker_id != self.worker_id:
+                r.srem(self.workers_key, worker_id)
+        self._prune_pending(r)
+
+    def _heartbeat(self, r):
+        with r.pipeline() as p:
+            p.sadd(self.workers_key, self.worker_id)
+            p.set(self.prefix + "alive:" + self.worker_id, "1", ex=TAG_WORKER_TTL)
+            p.execute()
+
+    def _start_heartbeat(self, r):
+        """生存確認を書き、以降はプロセスが生きている間スレッドで更新し続ける（プロセスごとに1回）。"""
+        if self._heartbeat_pid == os.getpid():
+            return
+        self._heartbeat(r)
+        self._heartbeat_pid = os.getpid()
+        threading.Thread(target=self._heartbeat_loop, args=(os.getpid(),), name="tag-heartbeat", daemon=True).start()
+
+    def _heartbeat_loop(self, pid: int):
+        while self._heartbeat_pid == pid:
+            time.sleep(TAG_WORKER_TTL / 3)
+            try:
+                self._heartbeat(get_redis())
+            except Exception as e:
+                logger.warning(f"tag worker heartbeat failed: {e}")
+
+    def _processing_key(self, worker_id: str) -> str:
+        return self.prefix + "processing:" + worker_id
+
+    def _prune_pending(self, r):
+        """どのリストにもジョブがないメモIDを pending から消す（取りこぼしたジョブで「生成中」のままにしない）。"""
+        workers = [w.decode() for w in r.smembers(self.workers_key)]
+        # ジョブの数より pending が多いときだけ、ジョブの中身を読んで突き合わせる
+        with r.pipeline() as p:
+            p.scard(self.pending_key)
+            p.llen(self.jobs_key)
+            p.zcard(self.delayed_key)
+            for worker_id in workers:
+                p.llen(self._processing_key(worker_id))
+            pending_count, *job_counts = p.execute()
+        if pending_count <= sum(job_counts):
+            return
+        with r.pipeline() as p:
+            p.smembers(self.workers_key)
+            p.smembers(self.pending_key)
+            p.lrange(self.jobs_key, 0, -1)
+            p.zrange(self.delayed_key, 0, -1)
+            for worker_id in workers:
+                p.lrange(self._processing_key(worker_id), 0, -1)
+            current, pending, *lists = p.execute()
+        if {w.decode() for w in current} != set(workers):
+            return  # 読んでいる間にワーカーが増えた。次の機会にやり直す
+        queued = {json.loads(raw)["memo_id"] for raws in lists for raw in raws}
+        stale = {m for m in pending if m.decode() not in queued}
+        if stale:
+            logger.warning(f"dropping {len(stale)} pending memo id(s) with no tag job")
+            r.srem(self.pending_key, *stale)
+
+    def _promote_delayed(self, r):
+        """再試行時刻を過ぎたジョブを実行待ちに戻す。"""
+        if self._promote is None:
+            self._promote = r.register_script(_PROMOTE_SCRIPT)
+        while self._promote(keys=[self.delayed_key, self.jobs_key], args=[time.time()]):
+            pass
+
+
+class LocalTagQueue:
+    """プロセス内で完結するキュー。開発やテスト用で、バックグラウンドスレッドが処理する。"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def enqueue(self, memo_id: str, user_id: str, body: str):
+        with self._lock:
+            self._pending.add(memo_id)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=run_worker, args=(self,), daemon=True)
+                self._worker.start()
+        self._queue.put({"memo_id": memo_id, "user_id": user_id, "body": body, "attempts": 0})
+
+    def is_pending(self, memo_id: str) -> bool:
+        with self._lock:
+            return memo_id in self._pending
+
+    def pop_batch(self, max_items: int, timeout: float = 5.0) -> list[dict]:
+        try:
+            jobs = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(jobs) < max_items:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def retry(self, job: dict, delay: float):
+        threading.Timer(delay, self._queue.put, args=(job,)).start()
+
+    def done(self, job: dict):
+        with self._lock:
+            self._pending.discard(job["memo_id"])
+
+    def requeue_unfinished(self):
+        """done()/retry() が失敗しないので、残りのジョブはない。"""
+
+
+# メモ作成時にタグ生成ジョブを投入する
+def enqueue_tag_job(tag_queue, memo_id: str, user_id: str, body: str) -> bool:
+    """ジョブを投入する。キュー（Redis）が使えなければログに残して False を返す。
+
+    メモは保存済みなので、キューの障害でメモ作成を失敗（500）にはしない。タグなしのメモになる。
+    """
+    try:
+        tag_queue.enqueue(memo_id, user_id, body)
+        return True
+    except Exception as e:
+        logger.warning(f"could not enqueue tag job for memo {memo_id}; saved without tags: {e}")
+        return False
+
+
+# 取り出したジョブをまとめて処理する
+def process_batch(tag_queue, jobs: list[dict]):
+    """ジョブをユーザーごとにまとめてタグを生成し、メモに紐付ける。
+    生成か紐付けに失敗したらバックオフして再投入する。
+
+    他ユーザーのメモ本文が同じプロンプトに入らないよう、バッチはユーザー単位に分ける。
+    """
+    by_user = defaultdict(list)
+    for job in jobs:
+        by_user[job["user_id"]].append(job)
+    for user_jobs in by_user.values():
+        try:
+            tags = generate_tags_batch({j["memo_id"]: j["body"] for j in user_jobs})
+        except Exception as e:
+            logger.warning(f"tag batch failed: {e}")
+            _retry_later(tag_queue, user_jobs)
+            continue
+        try:
+            attach_tags_bulk(tags)
+        except Exception as e:
+            logger.warning(f"attaching tags failed: {e}")
+            _retry_later(tag_queue, user_jobs)
+            continue
+        for job in user_jobs:
+            tag_queue.done(job)
+
+
+def _retry_later(tag_queue, jobs: list[dict]):
+    """試行回数を増やして再試行を予約する。TAG_MAX_ATTEMPTS に達したものは諦める。"""
+    for job in jobs:
+        job["attempts"] += 1
+        if job["attempts"] >= TAG_MAX_ATTEMPTS:
+            logger.error(f"giving up tagging memo {job['memo_id']}")
+            tag_queue.done(job)
+            continue
+        delay = TAG_RETRY_BASE_DELAY * 2 ** (job["attempts"] - 1)
+        tag_queue.retry(job, delay * random.uniform(0.5, 1.5))
+
+
+# タグ生成ワーカー
+def run_worker(tag_queue, batch_size: int = TAG_BATCH_SIZE):
+    """キューからジョブを取り出して処理し続ける。
+
+    1回分の処理（done()/retry() の Redis 呼び出しを含む）で例外が起きても、ログに残して
+    待ってから続ける。処理しきれなかったジョブは requeue_unfinished() で実行待ちに戻す。
+    """
+    delay = TAG_WORKER_ERROR_DELAY
+    while True:
+        try:
+            jobs = tag_queue.pop_batch(batch_size)
+            if jobs:
+                process_batch(tag_queue, jobs)
+        except Exception:
+            logger.exception(f"tag worker iteration failed; retrying in {delay:.0f}s")
+            tag_queue.requeue_unfinished()
+            time.sleep(delay)
+            delay = min(delay * 2, TAG_WORKER_MAX_ERROR_DELAY)
+            continue
+        delay = TAG_WORKER_ERROR_DELAY
+
+
+# 古い保存済み HTML を描画し直す
+def backfill_memo_html():
+    """描画設定が変わって古くなった body_html を保存し直す。表示では書き込まないので、ワーカーの起動時に行う。"""
+    try:
+        updated = sum(n for _, n in rerender_memos())
+    except Exception:
+        logger.exception("memo html backfill failed")
+        return
+    if updated:
+        logger.info(f"re-rendered {updated} memo(s)")
+
+
+# 環境変数からキューを作る
+def queue_from_env():
+    """TAG_QUEUE（redis / local / sync）に応じたキューを返す。sync なら None（同期でタグ付けする）。"""
+    kind = os.getenv("TAG_QUEUE", "redis")
+    if kind == "redis":
+        return RedisTagQueue()
+    if kind == "local":
+        return LocalTagQueue()
+    return None
+
+
+if __name__ == "__main__":
+    setup_logging()
+    threading.Thread(target=backfill_memo_html, name="memo-html-backfill", daemon=True).start()
+    run_worker(RedisTagQueue())
@@ -0,0 +1,153 @@
+# fake_openai.py
+"""OpenAI 互換の chat.completions を返すローカルのスタブサーバー。
+
+ベンチマークで API を消費せずにアプリの LLM 呼び出しを再現する。
+応答までの待ち時間は対数正規分布（中央値 --latency-ms、ばらつき --sigma）で決める。
+
+    python bench/fake_openai.py --port 8081 --latency-ms 600
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 OPENAI_API_KEY=dummy ...
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class FakeOpenAI:
+    """スタブの応答内容と待ち時間の設定。"""
+
+    def __init__(self, latency_ms: float = 500.0, sigma: float = 0.3,
+                 answer: str = "メモによると、**予約済み**です。", seed: int | None = None):
+        self.latency_ms = latency_ms
+        self.sigma = sigma
+        self.answer = answer
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        """1回の応答にかける秒数を返す。"""
+        with self._lock:
+            self.requests += 1
+            if self.latency_ms <= 0:
+                return 0.0
+            return self._random.lognormvariate(0, self.sigma) * self.latency_ms / 1000
+
+    def completion(self, req: dict) -> dict:
+        """リクエストの内容に応じた chat.completion を返す。"""
+        user_text = next((m.get("content") or "" for m in reversed(req.get("messages", []))
+                          if m.get("role") == "user"), "")
+        message = {"role": "assistant", "content": self.answer}
+        finish = "stop"
+        if req.get("tools"):
+            # rag() のツール選択: 質問の最初の語をキーワードにして search_memos を呼ばせる
+            words = _WORD_RE.findall(user_text)
+            args = {"keyword": words[0] if words else "", "include_secret": False}
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": "call_1", "type": "function",
+                "function": {"name": "search_memos", "arguments": json.dumps(args, ensure_ascii=False)},
+            }]}
+            finish = "tool_calls"
+        elif "You are a tagger" in user_text:
+            if "JSON object" in user_text:
+                n = len(re.findall(r"^\[\d+\]$", user_text, flags=re.MULTILINE))
+                message["content"] = json.dumps({str(i): ["bench", "memo"] for i in range(1, n + 1)})
+            else:
+                message["content"] = '["bench","memo"]'
+        prompt_tokens = sum(len(m.get("content") or "") for m in req.get("messages", [])) // 4
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+            "model": req.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "finish_reason": finish, "message": message}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20,
+                      "total_tokens": prompt_tokens + 20},
+        }
+
+
+def make_handler(fake: FakeOpenAI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            if not self.path.endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            body = fake.completion(req)
+            total = fake.delay()
+            if not req.get("stream"):
+                time.sleep(total)
+                self._send(200, "application/json", json.dumps(body, ensure_ascii=False).encode("utf-8"))
+                return
+            # ストリーミング: 最初のトークンまでに半分、残りを均等に待つ
+            content = body["choices"][0]["message"]["content"] or ""
+            pieces = [content[i:i + 4] for i in range(0, len(content), 4)] or [""]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(total / 2)
+            for piece in pieces:
+                self._chunk(body, {"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                time.sleep(total / 2 / len(pieces))
+            self._chunk(body, {"choices": [], "usage": body["usage"]})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+        def _chunk(self, body, fields):
+            event = {"id": body["id"], "object": "chat.completion.chunk", "created": body["created"],
+                     "model": body["model"], **fields}
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _send(self, status, ctype, data):
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    # 非同期版のアプリから数百件を同時に受けても接続を取りこぼさないようにする
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # ヘッジで負けたリクエストはクライアントが切断するので、その失敗は表示しない
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def serve(fake: FakeOpenAI, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """スタブサーバーをバックグラウンドスレッドで起動し、サーバーを返す（port=0 なら空きポート）。"""
+    server = _Server((host, port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="応答時間の中央値（ミリ秒）")
+    parser.add_argument("--sigma", type=float, default=0.3, help="応答時間の対数正規分布のばらつき")
+    args = parser.parse_args()
+    server = _Server((args.host, args.port), make_handler(FakeOpenAI(args.latency_ms, args.sigma)))
+    print(f"fake OpenAI listening on http://{args.host}:{server.server_port}/v1")
+    server.serve_forever()
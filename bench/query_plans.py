@@ -0,0 +1,264 @@
+# query_plans.py
+"""helpers.py・app.py が発行する SQL の実行計画を調べ、想定外の全表走査があれば終了コード 1 で終わる。
+
+作業用のデータベース（--database、終了時に削除する）に app/migrations を適用して試験データを入れ、
+ANALYZE TABLE で統計を取ってから、主な処理（ルートと管理用コマンド）を実行する。その間に発行された
+SQL をすべて記録し、フィンガープリントごとに EXPLAIN して type=ALL の表があるものと、EXPLAIN が
+エラーになったもの（壊れたクエリ）を報告する。
+全件を読むのが目的の処理は ALLOWED_FULL_SCANS に理由を書いて除外する。
+MySQL の接続先は MYSQL_HOST などの環境変数で渡す（作業用のデータベースを作れる権限が必要）。
+
+    python bench/query_plans.py
+    python bench/query_plans.py --users 50 --memos 40 --keep --verbose
+"""
+import io
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+import pymysql
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+
+WORDS = ["沖縄", "ホテル", "会議", "予約", "買い物", "旅行", "資料", "締め切り", "meeting", "todo", "budget", "flag"]
+TAGS = ["travel", "work", "todo", "private", "idea", "shopping", "urgent", "book"]
+
+# 全件を読むのが目的なので全表走査を許す処理（SQL を発行した関数 -> 理由）
+ALLOWED_FULL_SCANS = {
+    "helpers.get_memo_index": "全メモからプロセス内の検索索引を作る",
+    "helpers.export_memos": "全メモを書き出す（--user を付けたときは索引を使う）",
+    "helpers.rebuild_tag_counts": "tag_counts を空にして数え直す",
+}
+
+# 発行元として記録しない関数（この外側の関数を発行元とする）
+_WRAPPERS = {"query_db", "execute_db", "iter_query_db", "_select"}
+
+
+def _prepare_env(database: str):
+    os.environ["MYSQL_DATABASE"] = database
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("SESSION_SECRET", "bench")
+    os.environ["RATELIMIT_ENABLED"] = "0"
+    os.environ["TAG_QUEUE"] = "sync"
+    os.environ["MYSQL_REPLICA_HOSTS"] = ""
+    # キャッシュに当たって SQL が発行されないことがないようにする
+    os.environ["MEMO_SNAPSHOT_CACHE"] = "off"
+    os.environ["LLM_CACHE"] = "off"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, APP_DIR)
+
+
+def _server_connection():
+    return pymysql.connect(
+        host=os.getenv("MYSQL_HOST"), port=int(os.getenv("MYSQL_PORT", "3306")),
+        user=os.getenv("MYSQL_USER"), password=os.getenv("MYSQL_PASSWORD"),
+        charset="utf8mb4", autocommit=True,
+    )
+
+
+def seed(users: int, memos: int) -> list[dict]:
+    """users 人 × memos 件のメモ（公開範囲・作成日時・タグはばらばら）を入れ、[{id, memo_ids}] を返す。"""
+    import helpers
+    rng = random.Random(0)
+    seeded = []
+    helpers.execute_db(
+        "INSERT INTO users (id, username, password) VALUES "
+        + ",".join(["(%s, %s, %s)"] * users),
+        [v for u in range(users) for v in (f"plan-user-{u}", f"plan-user-{u}", "plan-pass")],
+    )
+    started = datetime(2024, 1, 1)
+    lines = []
+    for u in range(users):
+        uid = f"plan-user-{u}"
+        memo_ids = []
+        for n in range(memos):
+            mid = f"plan-memo-{u}-{n}"
+            visibility = rng.choice(["public", "public", "private", "secret"])
+            lines.append(json.dumps({
+                "id": mid, "user_id": uid, "body": " ".join(rng.choices(WORDS, k=12)),
+                "visibility": visibility, "password": "pass" if visibility == "secret" else None,
+                "created_at": (started + timedelta(minutes=rng.randrange(500_000))).isoformat(),
+                "tags": rng.sample(TAGS, 2),
+            }, ensure_ascii=False))
+            memo_ids.append(mid)
+        seeded.append({"id": uid, "memo_ids": memo_ids})
+    for _ in helpers.import_memos(lines):
+        pass
+    for table in ("users", "memos", "tags", "memo_tags", "tag_counts", "memo_related", "memo_related_state"):
+        helpers.query_db(f"ANALYZE TABLE {table}")
+    return seeded
+
+
+class Recorder:
+    """pymysql の Cursor.execute を包み、発行された SQL を発行元の関数とともに記録する。"""
+
+    def __init__(self):
+        self.statements = {}  # フィンガープリント -> {"sql", "callers"}
+        self._original = None
+
+    def __enter__(self):
+        import metrics
+        recorder = self
+        original = self._original = pymysql.cursors.Cursor.execute
+
+        def execute(cursor, query, args=None):
+            sql = cursor.mogrify(query, args)
+            entry = recorder.statements.setdefault(metrics.fingerprint(query), {"sql": sql, "callers": set()})
+            entry["callers"].add(_caller())
+            return original(cursor, query, args)
+
+        pymysql.cursors.Cursor.execute = execute
+        return self
+
+    def __exit__(self, *exc):
+        pymysql.cursors.Cursor.execute = self._original
+
+
+def _caller() -> str:
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.basename(frame.f_code.co_filename)
+        if filename in ("helpers.py", "app.py") and frame.f_code.co_name not in _WRAPPERS:
+            return f"{filename[:-3]}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "?"
+
+
+def exercise(seeded: list[dict]):
+    """ルートと管理用コマンドを一通り実行する（LLM を呼ぶ処理は除く）。"""
+    import helpers
+    from app import app
+
+    owner, other = seeded[0], seeded[1]
+    mid = owner["memo_ids"][0]
+
+    client = app.test_client()
+    client.post("/register", data={"username": "plan-new-user", "password": "plan-pass"})
+    client.get("/logout")
+    client.post("/login", data={"username": "plan-user-0", "password": "plan-pass"})
+    client.get("/")
+    client.get(f"/users/{owner['id']}")
+    client.get(f"/users/{other['id']}")
+    client.get(f"/memo/{mid}")
+    client.get("/tag/search?name=travel")
+    client.get("/tag/search")
+    client.get("/tags")
+    created = client.post("/memo/create", data={"body": "会議 の 資料 と 予約", "visibility": "public"})
+    new_mid = created.headers.get("Location", "").rsplit("/", 1)[-1]
+    client.post(f"/memo/{new_mid}/delete")
+
+    page = helpers.search_memos_by_tag("work")
+    helpers.search_memos_by_tag("work", cursor=page["next_cursor"])
+    helpers.load_user_page(owner["id"], other["id"])
+    for keyword in ("会議", "a", ""):
+        helpers.search_memos(keyword, True, owner["id"], current_uid=owner["id"])
+        list(helpers.search_memos(keyword, False, owner["id"], stream=True))
+    helpers.search_memos_local("旅行 ホテル", False, owner["id"])
+    helpers._sync_memo_index()
+    helpers.get_author_by_body("flag")
+    helpers.get_related_memos(mid, limit=3)
+    helpers.load_memo_detail(mid)
+    helpers.attach_tags(owner["memo_ids"][1], ["idea", "plan-new-tag"])
+    helpers.popular_tags()
+    helpers.delete_memo(owner["memo_ids"][2])
+    helpers.rebuild_tag_counts()
+    for _ in helpers.rerender_memos(batch_size=200):
+        pass
+    for _ in helpers.export_memos(io.StringIO(), user_id=owner["id"]):
+        pass
+    for _ in helpers.export_memos(io.StringIO()):
+        pass
+
+
+def explain(statements: dict) -> list[dict]:
+    """記録した SQL を EXPLAIN し、[{sql, callers, scans, error}] を返す（scans は全表走査した表）。"""
+    import helpers
+    con = helpers.get_db()
+    results = []
+    try:
+        for entry in statements.values():
+            sql = entry["sql"]
+            if sql.lstrip().split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+                continue
+            result = {"sql": sql, "callers": sorted(entry["callers"]), "scans": [], "error": None}
+            try:
+                with con.cursor() as cur:
+                    cur.execute("EXPLAIN " + sql)
+                    plan = cur.fetchall()
+            except pymysql.MySQLError as e:
+                result["error"] = str(e)
+                results.append(result)
+                continue
+            for row in plan:
+                table = row.get("table") or ""
+                # 派生表（<derived2> など）は索引で絞った後の中間結果なので数えない
+                if row.get("type") == "ALL" and not table.startswith("<"):
+                    result["scans"].append(table)
+            results.append(result)
+    finally:
+        con.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="memodb_query_plans", help="作業用のデータベース名（実行前後に削除する）")
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--memos", type=int, default=50, help="1ユーザーあたりのメモ数")
+    parser.add_argument("--keep", action="store_true", help="終了後も作業用のデータベースを残す")
+    parser.add_argument("--verbose", action="store_true", help="問題のない SQL も表示する")
+    args = parser.parse_args()
+
+    if args.database == os.getenv("MYSQL_DATABASE"):
+        raise SystemExit(f"refusing to use {args.database}: it is MYSQL_DATABASE and would be dropped")
+    _prepare_env(args.database)
+
+    server = _server_connection()
+    with server.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS `{args.database}`")
+        cur.execute(f"CREATE DATABASE `{args.database}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+    try:
+        import helpers
+        import migrate
+        con = helpers.get_db()
+        try:
+            migrate.migrate(con)
+        finally:
+            con.close()
+        seeded = seed(args.users, args.memos)
+        with Recorder() as recorder:
+            exercise(seeded)
+        results = explain(recorder.statements)
+    finally:
+        if not args.keep:
+            with server.cursor() as cur:
+                cur.execute(f"DROP DATABASE IF EXISTS `{args.database}`")
+        server.close()
+
+    failures = 0
+    for r in results:
+        allowed = [c for c in r["callers"] if c in ALLOWED_FULL_SCANS]
+        if r["error"]:
+            status = "ERROR"
+            failures += 1
+        elif r["scans"] and len(allowed) < len(r["callers"]):
+            status = "SCAN"
+            failures += 1
+        elif r["scans"]:
+            status = "allowed"
+        else:
+            status = "ok"
+        if status != "ok" or args.verbose:
+            detail = r["error"] or (f"full scan of {', '.join(r['scans'])}" if r["scans"] else "")
+            print(f"[{status}] {', '.join(r['callers'])}: {detail}")
+            print(f"    {' '.join(r['sql'].split())[:300]}")
+    print(f"{len(results)} statements explained, {failures} failure(s) (unexpected full table scans or EXPLAIN errors)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# run.py
+"""アプリのスループットを測るベンチマーク。
+
+MySQL に N ユーザー × M メモ（タグ付き）を投入し、スタブの OpenAI サーバーを相手に
+主要エンドポイントへ一定の並列度でリクエストを送り、p50/p95/p99 と RPS を JSON で保存する。
+MYSQL_* は通常どおり環境変数で渡す（OpenAI の接続先とレートリミットはこのスクリプトが設定する）。
+
+    python bench/run.py --users 20 --memos 5 --concurrency 8 --requests 200
+    python bench/run.py --compare bench/results/<前回>.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import subprocess
+import threading
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+
+from fake_openai import FakeOpenAI, serve  # noqa: E402
+
+ENDPOINTS = ("search", "memo_detail", "user_page", "tag_search", "memo_create")
+WORDS = ["沖縄", "ホテル", "会議", "予約", "買い物", "旅行", "資料", "締め切り", "meeting", "todo", "budget"]
+TAGS = ["travel", "work", "todo", "private", "idea", "shopping"]
+PASSWORD = "bench-pass"
+
+
+class Client:
+    """ログイン状態（セッション Cookie）を保持する HTTP クライアント。"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, method: str, path: str, form: dict | None = None) -> int:
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as res:
+                res.read()
+                return res.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def seed(users: int, memos: int) -> list[dict]:
+    """ベンチ用のユーザーとメモを投入し、[{username, id, memo_ids}] を返す。"""
+    import helpers
+    run_id = uuid.uuid4().hex[:8]
+    rng = random.Random(0)
+    seeded = []
+    for u in range(users):
+        uid = str(uuid.uuid4())
+        username = f"bench-{run_id}-{u}"
+        helpers.execute_db("INSERT INTO users (id, username, password) VALUES (%s, %s, %s)",
+                           (uid, username, PASSWORD))
+        memo_ids = []
+        for _ in range(memos):
+            mid = str(uuid.uuid4())
+            body = " ".join(rng.choices(WORDS, k=12))
+            helpers.save_memo(mid, uid, body, rng.choice(["public", "private"]), None)
+            memo_ids.append(mid)
+        helpers.attach_tags_bulk({mid: rng.sample(TAGS, 2) for mid in memo_ids})
+        seeded.append({"username": username, "id": uid, "memo_ids": memo_ids})
+    return seeded
+
+
+def register_fresh(base_url: str, count: int) -> list[Client]:
+    """メモ作成用に、メモを持たない新規ユーザーでログインしたクライアントを作る。"""
+    clients = []
+    for _ in range(count):
+        c = Client(base_url)
+        c.request("POST", "/register", {"username": f"bench-new-{uuid.uuid4().hex}", "password": PASSWORD})
+        clients.append(c)
+    return clients
+
+
+def drive(name: str, requests: int, concurrency: int, make_request) -> dict:
+    """make_request(i) を requests 回、concurrency 並列で実行して統計を返す。"""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        started = time.perf_counter()
+        status = make_request(i)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000 if latencies else 0.0
+
+    result = {"requests": requests, "errors": errors, "rps": requests / wall if wall else 0.0,
+              "p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99)}
+    print(f"{name:12s} rps={result['rps']:8.1f} p50={result['p50_ms']:8.1f}ms "
+          f"p95={result['p95_ms']:8.1f}ms p99={result['p99_ms']:8.1f}ms errors={errors}")
+    return result
+
+
+def run(args) -> dict:
+    fake = FakeOpenAI(args.llm_latency_ms, args.llm_sigma, seed=0)
+    llm = serve(fake)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{llm.server_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("SESSION_SECRET", "bench")
+    os.environ["RATELIMIT_ENABLED"] = "0"
+    os.environ.setdefault("TAG_QUEUE", "local")
+    # 既定では LLM キャッシュを切り、毎回スタブに問い合わせる
+    os.environ.setdefault("LLM_CACHE", "off")
+
+    server, port = _start_server(args.asgi)
+    base_url = f"http://127.0.0.1:{port}"
+
+    seeded = seed(args.users, args.memos)
+    clients = []
+    for user in seeded:
+        c = Client(base_url)
+        c.request("POST", "/login", {"username": user["username"], "password": PASSWORD})
+        clients.append((c, user))
+    creators = register_fresh(base_url, (args.requests + 3) // 4)
+
+    def pick(i):
+        return clients[i % len(clients)]
+
+    scenarios = {
+        "search": lambda i: pick(i)[0].request(
+            "POST", "/memo/search", {"query": f"{random.choice(WORDS)} について教えて"}),
+        "memo_detail": lambda i: pick(i)[0].request(
+            "GET", f"/memo/{random.choice(pick(i)[1]['memo_ids'])}"),
+        "user_page": lambda i: pick(i)[0].request("GET", f"/users/{pick(i)[1]['id']}"),
+        "tag_search": lambda i: pick(i)[0].request(
+            "GET", f"/tag/search?name={random.choice(TAGS)}"),
+        # 1ユーザー5件までの制限があるので、新規ユーザーごとに4件ずつ作る
+        "memo_create": lambda i: creators[i // 4].request(
+            "POST", "/memo/create", {"body": " ".join(random.choices(WORDS, k=8)),
+                                     "visibility": "public", "enable_tags": "on"}),
+    }
+    results = {}
+    for name in args.endpoints:
+        results[name] = drive(name, args.requests, args.concurrency, scenarios[name])
+    server.shutdown()
+    llm.shutdown()
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: getattr(args, k) for k in
+                   ("users", "memos", "concurrency", "requests", "llm_latency_ms", "llm_sigma", "asgi")},
+        "llm_requests": fake.requests,
+        "endpoints": results,
+    }
+
+
+def _start_server(asgi: bool):
+    """アプリをバックグラウンドで起動し、(shutdown() を持つサーバー, ポート) を返す。"""
+    if not asgi:
+        from werkzeug.serving import make_server
+        from app import app
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, server.server_port
+
+    import socket
+    import uvicorn
+    from asgi import app
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="on"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    server.shutdown = lambda: setattr(server, "should_exit", True)
+    return server, sock.getsockname()[1]
+
+
+def compare(current: dict, baseline: dict):
+    """前回の結果と比べて p95 と RPS の変化率を表示する。"""
+    print(f"\ncompared with {baseline.get('commit', '?')} ({baseline.get('timestamp', '?')})")
+    for name, cur in current["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            continue
+        def delta(key):
+            return (cur[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+        print(f"{name:12s} p95 {delta('p95_ms'):+6.1f}%  rps {delta('rps'):+6.1f}%")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--memos", type=int, default=5, help="ユーザーあたりのメモ数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="エンドポイントあたりのリクエスト数")
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=ENDPOINTS)
+    parser.add_argument("--llm-latency-ms", type=float, default=500.0)
+    parser.add_argument("--llm-sigma", type=float, default=0.3)
+    parser.add_argument("--asgi", action="store_true", help="asgi.py（uvicorn）で起動して計測する")
+    parser.add_argument("--output", help="結果の JSON の保存先（既定: bench/results/<commit>-<時刻>.json）")
+    parser.add_argument("--compare", help="比較する過去の結果 JSON")
+    args = parser.parse_args()
+
+    result = run(args)
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"{result['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
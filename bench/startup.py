@@ -0,0 +1,94 @@
+# startup.py
+"""ワーカーの起動時間を測るベンチマーク。
+
+`python -X importtime -c "import app"` を別プロセスで N 回実行し、起動全体の時間と
+モジュールごとの読み込み時間（自身 / 依存を含む累計、N 回の中央値）を表示する。
+DB・Redis・OpenAI には接続しない。
+
+    python bench/startup.py --runs 5 --top 20
+    python bench/startup.py --preload    # PRELOAD_MODULES=1（uWSGI のマスター）で計測する
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+
+
+def measure_once(module: str, preload: bool) -> tuple[float, dict]:
+    """1回起動し、(全体の秒数, {モジュール: (自身のμs, 累計のμs, 深さ)}) を返す。"""
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "bench")
+    env.setdefault("SESSION_SECRET", "bench")
+    env["PRELOAD_MODULES"] = "1" if preload else "0"
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=APP_DIR, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # 行頭の空白1つの後、入れ子の深さごとに2つずつ字下げされる
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="app", help="読み込むモジュール（asgi なども可）")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20, help="累計の長い順に表示するモジュール数")
+    parser.add_argument("--preload", action="store_true", help="PRELOAD_MODULES=1 で計測する")
+    parser.add_argument("--output", help="結果の JSON の保存先")
+    args = parser.parse_args()
+
+    walls = []
+    samples = defaultdict(list)
+    depths = {}
+    for _ in range(args.runs):
+        elapsed, modules = measure_once(args.module, args.preload)
+        walls.append(elapsed)
+        for name, (self_us, cumulative_us, depth) in modules.items():
+            samples[name].append((self_us, cumulative_us))
+            depths[name] = depth
+
+    rows = []
+    for name, values in samples.items():
+        rows.append({
+            "module": name,
+            "depth": depths[name],
+            "self_ms": statistics.median(v[0] for v in values) / 1000,
+            "cumulative_ms": statistics.median(v[1] for v in values) / 1000,
+        })
+    rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+
+    print(f"import {args.module} (preload={args.preload}): "
+          f"wall p50={statistics.median(walls) * 1000:.1f}ms min={min(walls) * 1000:.1f}ms over {args.runs} runs")
+    print(f"{'cumulative':>12s} {'self':>10s}  module")
+    for r in rows[:args.top]:
+        print(f"{r['cumulative_ms']:10.1f}ms {r['self_ms']:8.1f}ms  {'  ' * r['depth']}{r['module']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "module": args.module, "preload": args.preload, "runs": args.runs,
+                "wall_ms": [w * 1000 for w in walls], "modules": rows,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
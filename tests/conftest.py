@@ -0,0 +1,15 @@
+# conftest.py
+"""app/ のモジュールを読み込めるようにし、外部サービスに接続しない設定にする。"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("SESSION_SECRET", "test")
+os.environ.setdefault("RATELIMIT_ENABLED", "0")
+os.environ.setdefault("TAG_QUEUE", "sync")
+os.environ.setdefault("LLM_CACHE", "memory")
+os.environ.setdefault("MEMO_SNAPSHOT_CACHE", "memory")
+os.environ.setdefault("LOG_FORMAT", "text")
+os.environ["MYSQL_REPLICA_HOSTS"] = ""
@@ -0,0 +1,73 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+def test_admits_up_to_max_concurrent_then_sheds():
+    ctl = AdmissionController(max_concurrent=1, max_queue=0, timeout=1)
+    ctl.acquire("alice")
+    with pytest.raises(Overloaded) as e:
+        ctl.acquire("bob")
+    assert e.value.retry_after >= 1
+
+
+def test_queued_request_runs_after_release():
+    ctl = AdmissionController(max_concurrent=1, max_queue=1, timeout=2)
+    ctl.acquire("alice")
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(ctl.acquire("bob")))
+    waiter.start()
+    deadline = time.monotonic() + 2
+    while not ctl.queued and time.monotonic() < deadline:
+        time.sleep(0.005)
+    ctl.release()
+    waiter.join(2)
+    assert waited and ctl.active == 1 and ctl.queued == 0
+
+
+def test_queue_timeout_raises_and_leaves_the_queue():
+    ctl = AdmissionController(max_concurrent=1, max_queue=1, timeout=0.05)
+    ctl._service_time = 0.01
+    ctl.acquire("alice")
+    with pytest.raises(Overloaded):
+        ctl.acquire("bob")
+    assert ctl.queued == 0
+
+
+def test_per_user_queue_limit():
+    ctl = AdmissionController(max_concurrent=1, max_queue=10, max_queue_per_user=1, timeout=5)
+    ctl._service_time = 0.01
+    ctl.acquire("alice")
+    ctl._try_enter("bob", lambda: None)
+    with pytest.raises(Overloaded):
+        ctl._try_enter("bob", lambda: None)
+
+
+def test_release_rotates_between_users():
+    ctl = AdmissionController(max_concurrent=1, max_queue=10, max_queue_per_user=5, timeout=5)
+    ctl._service_time = 0.01
+    ctl.acquire("alice")
+    order = []
+    for user in ("bob", "bob", "carol"):
+        ctl._try_enter(user, lambda user=user: order.append(user))
+    for _ in range(3):
+        ctl.release()
+    assert order == ["bob", "carol", "bob"]
+
+
+def test_async_run_releases_the_slot():
+    ctl = AdmissionController(max_concurrent=1, max_queue=1, timeout=2)
+
+    async def work():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def main():
+        return await asyncio.gather(ctl.run_async("alice", work()), ctl.run_async("bob", work()))
+
+    assert asyncio.run(main()) == ["done", "done"]
+    assert ctl.active == 0 and ctl.queued == 0
@@ -0,0 +1,64 @@
+import os
+import sys
+import asyncio
+import subprocess
+
+import flask
+import pytest
+from limits.storage import MemoryStorage
+from limits.strategies import FixedWindowRateLimiter
+
+import asgi
+from app import app, limiter
+
+CLIENT = "203.0.113.5"
+
+
+@pytest.fixture
+def limited(monkeypatch):
+    storage = MemoryStorage()
+    monkeypatch.setattr(limiter, "_storage", storage)
+    monkeypatch.setattr(limiter, "_limiter", FixedWindowRateLimiter(storage))
+    monkeypatch.setattr(limiter, "enabled", True)
+    # RATELIMIT_ENABLED=0 で init_app が省いた設定を、有効なときと同じにする
+    monkeypatch.setattr(limiter, "initialized", True)
+    monkeypatch.setattr(limiter, "_request_identifier", lambda: flask.request.endpoint or "")
+    monkeypatch.setitem(app.config, "RATELIMIT_ENABLED", True)
+    return storage
+
+
+def _asgi_request():
+    scope = {"method": "POST", "path": "/memo/search", "headers": [], "client": (CLIENT, 40000)}
+    return asgi.Request(scope, b"query=x")
+
+
+def _wsgi_search(client):
+    # 閉じないと limit_concurrency の枠が返らない
+    with client.post("/memo/search", data={"query": "x"}, environ_base={"REMOTE_ADDR": CLIENT}) as res:
+        return res.status_code
+
+
+def test_asgi_counts_in_the_flask_limiter_bucket(limited):
+    limit = asgi._search_limits[0].limit
+    client = app.test_client()
+    for _ in range(limit.amount - 1):
+        assert _wsgi_search(client) != 429
+    assert not asyncio.run(asgi._rate_limited(_asgi_request()))  # 最後の1回
+    assert _wsgi_search(client) == 429
+    assert asyncio.run(asgi._rate_limited(_asgi_request()))
+
+
+def test_wsgi_sees_requests_counted_by_asgi(limited):
+    limit = asgi._search_limits[0].limit
+    for _ in range(limit.amount):
+        assert not asyncio.run(asgi._rate_limited(_asgi_request()))
+    assert _wsgi_search(app.test_client()) == 429
+
+
+def test_async_helpers_import_without_an_api_key():
+    # OpenAI クライアントは最初の呼び出しで作るので、キーがなくても読み込める
+    env = {k: v for k, v in os.environ.items() if k != "OPENAI_API_KEY"}
+    code = "import async_helpers; print(async_helpers._openai_client)"
+    app_dir = os.path.join(os.path.dirname(__file__), "..", "app")
+    out = subprocess.run([sys.executable, "-c", code], cwd=app_dir, env=env, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "None"
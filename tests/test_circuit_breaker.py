@@ -0,0 +1,106 @@
+import time
+import asyncio
+
+import pytest
+
+from llm_guard import CircuitBreaker, LLMGuard, LLMUnavailable
+
+
+def test_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert breaker.state == "half-open"
+    assert not breaker.allow()  # 試行中は他を通さない
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_released_probe_can_be_retried():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def _open_guard() -> LLMGuard:
+    """half-open の試行を1件だけ通せる状態の LLMGuard を返す。"""
+    guard = LLMGuard()
+    guard.breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    guard.breaker.record_failure()
+    time.sleep(0.02)
+    return guard
+
+
+def test_cancelled_probe_is_released():
+    guard = _open_guard()
+
+    async def stream():
+        with guard.guarded():
+            await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.create_task(stream())
+        await asyncio.sleep(0.01)
+        assert guard.breaker.state == "half-open"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert guard.breaker.allow()  # 次の試行を通せる
+
+
+def test_abandoned_stream_is_released():
+    guard = _open_guard()
+
+    def stream():
+        with guard.guarded():
+            yield "a"
+            yield "b"
+
+    gen = stream()
+    next(gen)
+    gen.close()
+    assert guard.breaker.allow()
+
+
+def test_slow_stream_hits_the_overall_deadline():
+    guard = LLMGuard()
+    guard.breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+    with pytest.raises(LLMUnavailable):
+        with guard.guarded(timeout=0.05) as deadline:
+            for _ in range(10):
+                time.sleep(0.02)  # 1チャンクずつは速いが、合計では期限を超える
+                deadline.remaining()
+    assert guard.breaker.state == "open"
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+import pymysql
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout, ReplicaSet
+
+
+class FakeConnection:
+    def __init__(self):
+        self.open = True
+        self.committed = self.rolled_back = False
+
+    def ping(self, reconnect=False):
+        if not self.open:
+            raise pymysql.err.OperationalError(2006, "gone away")
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def made():
+    return []
+
+
+@pytest.fixture
+def pool(made):
+    def connect():
+        made.append(FakeConnection())
+        return made[-1]
+    return ConnectionPool(connect, max_size=2, acquire_timeout=0.05, ping_interval=0)
+
+
+def test_connections_are_reused(pool, made):
+    con = pool.acquire()
+    pool.release(con)
+    assert pool.acquire() is con
+    assert len(made) == 1
+
+
+def test_waits_then_times_out_at_max_size(pool):
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+
+def test_release_wakes_a_waiter(pool):
+    first = pool.acquire()
+    pool.acquire()
+    pool.acquire_timeout = 2
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    pool.release(first)
+    waiter.join(2)
+    assert got == [first]
+
+
+def test_dead_connection_is_replaced(pool, made):
+    con = pool.acquire()
+    pool.release(con)
+    con.open = False
+    assert pool.acquire() is not con
+    assert len(made) == 2
+
+
+def test_nested_connection_blocks_share_one_connection(pool, made):
+    with pool.connection() as outer:
+        assert pool.in_use()
+        with pool.connection() as inner:
+            assert inner is outer
+    assert not pool.in_use()
+    assert len(made) == 1
+
+
+def test_transaction_rolls_back_on_error(pool, made):
+    with pytest.raises(RuntimeError):
+        with pool.transaction():
+            with pool.transaction():  # 外側に合流する
+                raise RuntimeError
+    assert made[0].rolled_back and not made[0].committed
+
+
+def test_broken_connection_is_discarded(pool, made):
+    with pytest.raises(pymysql.err.OperationalError):
+        with pool.connection():
+            raise pymysql.err.OperationalError(2013, "lost connection")
+    assert not made[0].open
+    with pool.connection() as con:
+        assert con is made[1]
+
+
+def test_lease_takes_a_failed_replica_out():
+    replicas = ReplicaSet({"r1": None, "r2": None}, retry_interval=60)
+    with pytest.raises(pymysql.err.OperationalError):
+        with replicas.lease() as name:
+            raise pymysql.err.OperationalError(2003, "down")
+    assert replicas.healthy() == [n for n in ("r1", "r2") if n != name]
+
+
+@pytest.fixture
+def async_reads(monkeypatch):
+    import helpers
+    import async_helpers
+    used = []
+
+    async def get_pool(replica=None):
+        return replica or "primary"
+
+    async def select(pool, sql, args, fetchone):
+        used.append(pool)
+        if pool == "down":
+            raise pymysql.err.OperationalError(2003, "down")
+        return []
+    replicas = ReplicaSet({"r1": None}, retry_interval=60)
+    monkeypatch.setattr(helpers, "_replicas", replicas)
+    monkeypatch.setattr(async_helpers, "_replicas", replicas)
+    monkeypatch.setattr(async_helpers, "get_pool", get_pool)
+    monkeypatch.setattr(async_helpers, "_select_async", select)
+    return used
+
+
+def test_async_reads_use_the_replicas(async_reads):
+    import async_helpers
+    asyncio.run(async_helpers.query_db_async("SELECT 1"))
+    assert async_reads == ["r1"]
+
+
+def test_async_reads_follow_read_your_writes(async_reads):
+    import time
+    import helpers
+    import async_helpers
+
+    async def read():
+        helpers.read_from_primary_until(time.time() + 60)
+        await async_helpers.query_db_async("SELECT 1")
+    asyncio.run(read())
+    assert async_reads == ["primary"]
+
+
+def test_async_replica_errors_fall_back_to_the_primary(async_reads, monkeypatch):
+    import async_helpers
+    import helpers
+    replicas = ReplicaSet({"down": None}, retry_interval=60)
+    monkeypatch.setattr(helpers, "_replicas", replicas)
+    monkeypatch.setattr(async_helpers, "_replicas", replicas)
+    asyncio.run(async_helpers.query_db_async("SELECT 1"))
+    assert async_reads == ["down", "primary"]
+    assert replicas.healthy() == []
@@ -0,0 +1,53 @@
+import helpers
+
+
+def _row(mid, seq, body="旅行 ホテル", uid="u1", visibility="public"):
+    return {"id": mid, "user_id": uid, "body": body, "visibility": visibility, "seq": seq}
+
+
+def _reset(monkeypatch, rows):
+    monkeypatch.setattr(helpers, "_memo_index", None)
+    monkeypatch.setattr(helpers, "_memo_index_seq", 0)
+    monkeypatch.setattr(helpers, "_start_memo_index_sync", lambda: None)
+    built = []
+
+    def iter_rows(sql, args=()):
+        built.append(sql)
+        return iter(list(rows))
+    monkeypatch.setattr(helpers, "iter_query_db", iter_rows)
+    return built
+
+
+def test_index_is_built_only_on_cold_start(monkeypatch):
+    rows = [_row("m1", 1), _row("m2", 2)]
+    built = _reset(monkeypatch, rows)
+    index = helpers.get_memo_index()
+    assert len(index) == 2 and helpers._memo_index_seq == 2
+    assert helpers.get_memo_index() is index
+    assert len(built) == 1
+
+
+def test_sync_reads_from_the_watermark_and_adds_new_memos(monkeypatch):
+    _reset(monkeypatch, [_row("m1", 1)])
+    index = helpers.get_memo_index()
+    queries = []
+
+    def query(sql, args=(), fetchone=False):
+        queries.append(args)
+        return [_row("m1", 1), _row("m3", 3)]
+    monkeypatch.setattr(helpers, "query_db", query)
+    monkeypatch.setattr(helpers, "RETRIEVAL_SYNC_OVERLAP", 0)
+    helpers._sync_memo_index()
+    assert queries == [(1,)]
+    assert "m3" in index and len(index) == 2
+    assert helpers._memo_index_seq == 3
+
+
+def test_deleted_hits_are_removed_from_the_index(monkeypatch):
+    _reset(monkeypatch, [_row("m1", 1), _row("m2", 2)])
+    index = helpers.get_memo_index()
+    # m2 は他ワーカーで削除済み
+    monkeypatch.setattr(helpers, "query_db", lambda sql, args=(), fetchone=False: [{"id": "m1", "body": "旅行 ホテル"}])
+    results = helpers.search_memos_local("旅行", False, "u1", current_uid="u1")
+    assert [r["id"] for r in results] == ["m1"]
+    assert "m2" not in index and "m1" in index
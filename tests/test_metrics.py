@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import subprocess
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def metrics_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _dead_pid() -> int:
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    return proc.pid
+
+
+def _write(path, counters):
+    path.write_text(json.dumps({"counters": [[n, [], v] for n, v in counters], "histograms": []}))
+
+
+def test_dead_worker_files_are_folded_into_dead_json(metrics_dir):
+    pid = _dead_pid()
+    _write(metrics_dir / f"{pid}.json", [("jobs_total", 3.0)])
+    _write(metrics_dir / "dead.json", [("jobs_total", 2.0)])
+
+    out = metrics.render_prometheus()
+
+    assert "jobs_total 5.0" in out
+    assert not (metrics_dir / f"{pid}.json").exists()
+    # 2回目も合計は変わらない
+    assert "jobs_total 5.0" in metrics.render_prometheus()
+
+
+def test_live_worker_files_are_kept(metrics_dir):
+    _write(metrics_dir / "1.json", [("jobs_total", 4.0)])
+    assert "jobs_total 4.0" in metrics.render_prometheus()
+    assert (metrics_dir / "1.json").exists()
+
+
+def test_flusher_writes_without_requests(metrics_dir, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_FLUSH_INTERVAL", 0.05)
+    registry = metrics.Registry()
+    registry.inc("jobs_total")
+    registry.start_flusher()
+    try:
+        path = metrics_dir / f"{os.getpid()}.json"
+        deadline = time.monotonic() + 2
+        while not path.exists() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert json.loads(path.read_text())["counters"] == [["jobs_total", [], 1.0]]
+    finally:
+        registry._flusher_pid = None
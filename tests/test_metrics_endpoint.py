@@ -0,0 +1,33 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module.metrics, "METRICS_DIR", str(tmp_path))
+    return app_module.app.test_client()
+
+
+def test_metrics_rejects_outside_clients(client):
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 403
+
+
+def test_metrics_allows_compose_network(client):
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "172.18.0.3"}).status_code == 200
+
+
+def test_metrics_forwarded_address_is_checked(client):
+    # nginx（compose 内）経由でも、X-Forwarded-For の利用者のアドレスで判定する
+    res = client.get("/metrics", environ_base={"REMOTE_ADDR": "172.18.0.2"},
+                     headers={"X-Forwarded-For": "203.0.113.5"})
+    assert res.status_code == 403
+
+
+def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "s3cret")
+    outside = {"REMOTE_ADDR": "203.0.113.5"}
+    assert client.get("/metrics", environ_base=outside,
+                      headers={"Authorization": "Bearer s3cret"}).status_code == 200
+    assert client.get("/metrics", environ_base=outside,
+                      headers={"Authorization": "Bearer wrong"}).status_code == 403
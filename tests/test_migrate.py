@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+
+from migrate import load_migrations, split_statements
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "app")
+
+
+def test_splits_on_semicolons():
+    assert split_statements("CREATE TABLE a (id INT);\nCREATE TABLE b (id INT);\n") == [
+        "CREATE TABLE a (id INT)", "CREATE TABLE b (id INT)",
+    ]
+
+
+def test_semicolons_in_literals_are_kept():
+    sql = "INSERT INTO t VALUES ('a;b', \"c;d\", 'it''s;', 'x\\';y'); SELECT `odd;name` FROM t"
+    assert split_statements(sql) == [
+        "INSERT INTO t VALUES ('a;b', \"c;d\", 'it''s;', 'x\\';y')", "SELECT `odd;name` FROM t",
+    ]
+
+
+def test_comments_are_dropped():
+    sql = "-- header; not a statement\nSELECT 1; # trailing; comment\n--\nSELECT 2;"
+    assert split_statements(sql) == ["SELECT 1", "SELECT 2"]
+
+
+def test_double_dash_without_space_is_not_a_comment():
+    # MySQL では 1--1 は 1 - (-1)
+    assert split_statements("SELECT 1--1; SELECT 2") == ["SELECT 1--1", "SELECT 2"]
+
+
+def test_shipped_migrations_split_cleanly():
+    for m in load_migrations():
+        for statement in split_statements(m.sql):
+            assert statement.split(None, 1)[0].upper() in ("CREATE", "ALTER", "INSERT", "UPDATE", "DROP"), statement
+
+
+def test_migrate_does_not_load_the_app():
+    code = "import sys, migrate; print('helpers' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "False"
+
+
+def test_comment_edits_keep_the_recorded_checksum(tmp_path):
+    (tmp_path / "0001_init.sql").write_text("-- 最初のコメント\nCREATE TABLE a (id INT);\n")
+    before = load_migrations(str(tmp_path))[0]
+    (tmp_path / "0001_init.sql").write_text("-- 直したコメント\nCREATE TABLE a (id INT);\n")
+    after = load_migrations(str(tmp_path))[0]
+    assert after.matches(before.checksum)
+    (tmp_path / "0001_init.sql").write_text("CREATE TABLE a (id BIGINT);\n")
+    assert not load_migrations(str(tmp_path))[0].matches(before.checksum)
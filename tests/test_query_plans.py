@@ -0,0 +1,30 @@
+import os
+import sys
+import subprocess
+
+import pymysql
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+@pytest.fixture
+def mysql_server():
+    if not os.getenv("MYSQL_HOST"):
+        pytest.skip("MYSQL_HOST is not set")
+    try:
+        pymysql.connect(
+            host=os.getenv("MYSQL_HOST"), port=int(os.getenv("MYSQL_PORT", "3306")),
+            user=os.getenv("MYSQL_USER"), password=os.getenv("MYSQL_PASSWORD"), connect_timeout=2,
+        ).close()
+    except pymysql.MySQLError as e:
+        pytest.skip(f"MySQL is not reachable: {e}")
+
+
+def test_no_unexpected_full_scans_or_broken_queries(mysql_server):
+    # bench/query_plans.py は環境変数を書き換えて helpers を読み込むので、別のプロセスで動かす
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "bench", "query_plans.py"), "--users", "10", "--memos", "20"],
+        cwd=ROOT, capture_output=True, text=True, timeout=600,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
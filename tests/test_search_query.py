@@ -0,0 +1,26 @@
+from helpers import _keyword_clause, _search_memos_query, _escape_like
+
+
+def test_escape_like():
+    assert _escape_like("100%_a\\b") == "100\\%\\_a\\\\b"
+
+
+def test_short_keyword_uses_like_only():
+    where, where_args, score, _ = _keyword_clause("a")
+    assert "MATCH" not in where
+    assert where_args == ("%a%",)
+    assert "CHAR_LENGTH" in score
+
+
+def test_long_keyword_uses_fulltext_and_like():
+    where, where_args, score, score_args = _keyword_clause("会議")
+    assert "MATCH(body) AGAINST(%s IN BOOLEAN MODE)" in where
+    assert where_args == ('"会議"', "%会議%")
+    assert score_args == ('"会議"',)
+
+
+def test_search_query_filters_in_sql_with_limit():
+    sql, args = _search_memos_query("会議", False, "u1", 10, "u1")
+    assert "WHERE user_id=%s AND visibility IN (%s,%s)" in sql
+    assert sql.endswith("ORDER BY score DESC, created_at ASC LIMIT %s")
+    assert args == ('"会議"', "u1", "public", "private", '"会議"', "%会議%", 10)
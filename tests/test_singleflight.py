@@ -0,0 +1,76 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+import metrics
+from singleflight import SingleFlight
+
+
+def _coalesced() -> float:
+    return metrics.registry._counters.get(("singleflight_requests_total", (("result", "coalesced"),)), 0.0)
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return "answer"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    leader.start()
+    started.wait(2)
+    before = _coalesced()
+    follower = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    follower.start()
+    deadline = time.monotonic() + 2
+    while _coalesced() == before and time.monotonic() < deadline:
+        time.sleep(0.005)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+
+    assert results == ["answer", "answer"]
+    assert len(calls) == 1
+
+
+def test_error_is_shared_and_key_is_released():
+    flight = SingleFlight()
+
+    def boom():
+        raise ValueError("nope")
+
+    with pytest.raises(ValueError):
+        flight.do("k", boom)
+    assert flight.do("k", lambda: "again") == "again"
+
+
+def test_disabled_runs_every_call():
+    flight = SingleFlight(enabled=False)
+    calls = []
+    flight.do("k", lambda: calls.append(1) or "x")
+    flight.do("k", lambda: calls.append(1) or "x")
+    assert len(calls) == 2
+
+
+def test_async_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("k", slow) for _ in range(3)))
+
+    assert asyncio.run(main()) == ["answer"] * 3
+    assert len(calls) == 1
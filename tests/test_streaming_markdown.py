@@ -0,0 +1,38 @@
+from helpers import StreamingMarkdown, redact_flags
+
+
+def test_redact_flags():
+    assert redact_flags("secret: flag{abc}") == "secret: flag{****}"
+
+
+def test_blocks_are_flushed_as_they_complete():
+    sm = StreamingMarkdown()
+    assert sm.feed("first paragraph") == ""
+    html = sm.feed("\n\nsecond")
+    assert "first paragraph" in html
+    assert "second" in sm.finish()
+
+
+def test_open_flag_is_held_until_closed():
+    sm = StreamingMarkdown()
+    assert "intro" in sm.feed("intro\n\nflag{abc")
+    assert sm.feed("\n\nstill open") == ""
+    out = sm.feed("def}\n\nnext\n\n")
+    assert "abcdef" not in out
+    assert "flag{****}" in out
+
+
+def test_keeps_streaming_after_a_closed_flag():
+    sm = StreamingMarkdown()
+    sm.feed("the flag is flag{abc}")
+    assert "flag{****}" in sm.feed("\n\nmore text")
+    # 伏字にした flag より後ろのブロックも、finish を待たずに確定する
+    assert "more text" in sm.feed("\n\nand then")
+    assert "and then" in sm.finish()
+
+
+def test_flag_split_across_chunks_never_leaks():
+    sm = StreamingMarkdown()
+    out = sm.feed("a\n\nfl") + sm.feed("ag{se") + sm.feed("cret}\n\nb\n\n") + sm.finish()
+    assert "secret" not in out
+    assert "flag{****}" in out
@@ -0,0 +1,132 @@
+import uuid
+
+import pytest
+import redis
+
+import tag_queue
+from redis_client import get_redis
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.retried, self.done_ids = [], []
+
+    def retry(self, job, delay):
+        self.retried.append((job["memo_id"], job["attempts"]))
+
+    def done(self, job):
+        self.done_ids.append(job["memo_id"])
+
+
+def _job(memo_id, attempts=0):
+    return {"memo_id": memo_id, "user_id": "u1", "body": "body", "attempts": attempts}
+
+
+def test_attach_failure_is_retried(monkeypatch):
+    monkeypatch.setattr(tag_queue, "generate_tags_batch", lambda bodies: {m: ["tag"] for m in bodies})
+
+    def fail(tags):
+        raise RuntimeError("db down")
+    monkeypatch.setattr(tag_queue, "attach_tags_bulk", fail)
+
+    q = RecordingQueue()
+    tag_queue.process_batch(q, [_job("m1"), _job("m2", attempts=tag_queue.TAG_MAX_ATTEMPTS - 1)])
+
+    assert q.retried == [("m1", 1)]
+    assert q.done_ids == ["m2"]  # 上限に達したものは諦める
+
+
+def test_success_marks_jobs_done(monkeypatch):
+    attached = []
+    monkeypatch.setattr(tag_queue, "generate_tags_batch", lambda bodies: {m: ["tag"] for m in bodies})
+    monkeypatch.setattr(tag_queue, "attach_tags_bulk", attached.append)
+
+    q = RecordingQueue()
+    tag_queue.process_batch(q, [_job("m1")])
+
+    assert attached == [{"m1": ["tag"]}]
+    assert q.done_ids == ["m1"] and q.retried == []
+
+
+@pytest.fixture
+def redis_queue():
+    try:
+        get_redis().ping()
+    except redis.RedisError:
+        pytest.skip("Redis is not available")
+    prefix = f"test-tagqueue-{uuid.uuid4().hex}:"
+    yield prefix
+    r = get_redis()
+    for key in r.scan_iter(prefix + "*"):
+        r.delete(key)
+
+
+def test_jobs_of_a_dead_worker_are_requeued(redis_queue):
+    crashed = tag_queue.RedisTagQueue(redis_queue, worker_id="crashed")
+    crashed.enqueue("m1", "u1", "body")
+    assert [j["memo_id"] for j in crashed.pop_batch(8)] == ["m1"]
+    crashed._heartbeat_pid = None  # 生存確認の更新を止めて、切れたことにする
+    get_redis().delete(redis_queue + "alive:crashed")
+
+    other = tag_queue.RedisTagQueue(redis_queue, worker_id="other")
+    jobs = other.pop_batch(8)
+    assert [j["memo_id"] for j in jobs] == ["m1"]
+    assert other.is_pending("m1")
+    other.done(jobs[0])
+    assert not other.is_pending("m1")
+    assert get_redis().llen(other.processing_key) == 0
+
+
+def test_pending_without_a_job_is_dropped(redis_queue):
+    get_redis().sadd(redis_queue + "pending", "lost")
+    q = tag_queue.RedisTagQueue(redis_queue, worker_id="w")
+    q.recover()
+    assert not q.is_pending("lost")
+
+
+class BrokenQueue:
+    def enqueue(self, memo_id, user_id, body):
+        raise redis.ConnectionError("redis is down")
+
+
+def test_memo_is_created_when_the_queue_is_down(monkeypatch):
+    import app as app_module
+    import helpers
+    saved = []
+    monkeypatch.setattr(app_module, "tag_queue", BrokenQueue())
+    monkeypatch.setattr(app_module, "count_user_memos", lambda uid: 0)
+    monkeypatch.setattr(helpers, "save_memo", lambda *args: saved.append(args))
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = "u1"
+    res = client.post("/memo/create", data={"body": "hello", "visibility": "public", "enable_tags": "on"})
+    assert res.status_code == 302 and res.headers["Location"].startswith("/memo/")
+    assert len(saved) == 1
+
+
+def test_worker_survives_a_failing_iteration(monkeypatch):
+    class FlakyQueue(RecordingQueue):
+        def __init__(self):
+            super().__init__()
+            self.pops = 0
+            self.requeued = 0
+
+        def pop_batch(self, max_items):
+            self.pops += 1
+            if self.pops == 3:
+                raise SystemExit  # テストのためにループを抜ける
+            return [_job(f"m{self.pops}")]
+
+        def done(self, job):
+            raise redis.ConnectionError("redis is down")
+
+        def requeue_unfinished(self):
+            self.requeued += 1
+
+    monkeypatch.setattr(tag_queue, "generate_tags_batch", lambda bodies: {m: ["tag"] for m in bodies})
+    monkeypatch.setattr(tag_queue, "attach_tags_bulk", lambda tags: None)
+    monkeypatch.setattr(tag_queue.time, "sleep", lambda s: None)
+    q = FlakyQueue()
+    with pytest.raises(SystemExit):
+        tag_queue.run_worker(q)
+    assert q.pops == 3 and q.requeued == 2
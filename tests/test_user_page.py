@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pytest
+
+import helpers
+from llm_cache import LRUCache
+from memo_snapshot import MemoSnapshotCache
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """query_db を差し替え、発行された SQL を記録する。"""
+    calls = []
+    state = {"version": 1}
+    page_rows = [
+        {"username": "alice", "memo_version": 1, "id": f"m{i}", "visibility": "public",
+         "created_at": datetime(2024, 1, 1, 0, i), "body": f"body {i}"}
+        for i in range(3)
+    ]
+
+    def query_db(sql, args=(), fetchone=False):
+        calls.append(sql)
+        if "SELECT memo_version FROM users" in sql:
+            return {"memo_version": state["version"]}
+        if "COUNT(m.id)" in sql:
+            return {"memo_version": state["version"], "count": 3}
+        return [dict(r, memo_version=state["version"]) for r in page_rows]
+
+    monkeypatch.setattr(helpers, "query_db", query_db)
+    monkeypatch.setattr(helpers, "memo_snapshots", MemoSnapshotCache(LRUCache(max_entries=100, max_bytes=1 << 20)))
+    return calls, state
+
+
+def test_cursor_round_trip():
+    at = datetime(2024, 5, 6, 7, 8, 9)
+    assert helpers._decode_cursor(helpers._encode_cursor(at, "a_b")) == (at, "a_b")
+    assert helpers._decode_cursor("garbage") is None
+    assert helpers._decode_cursor(None) is None
+
+
+def test_page_is_limited_in_sql(db):
+    calls, _ = db
+    page = helpers.load_user_page("u1", "u2", page_size=2)
+    assert [m["id"] for m in page["memos"]] == ["m0", "m1"]
+    assert page["next_cursor"] == helpers._encode_cursor(datetime(2024, 1, 1, 0, 1), "m1")
+    assert "LIMIT %s" in calls[-1]
+
+
+def test_page_is_cached_until_version_changes(db):
+    calls, state = db
+    first = helpers.load_user_page("u1", "u2", page_size=2)
+    n = len(calls)
+    assert helpers.load_user_page("u1", "u2", page_size=2) == first
+    assert len(calls) == n + 1  # memo_version だけを読む
+    state["version"] = 2
+    helpers.load_user_page("u1", "u2", page_size=2)
+    assert len(calls) == n + 3
+
+
+def test_owner_and_visitor_pages_are_cached_separately(db):
+    calls, _ = db
+    helpers.load_user_page("u1", "u2")
+    helpers.load_user_page("u1", "u1")
+    assert "IN (%s,%s,%s)" in calls[-1]
+
+
+def test_count_user_memos_is_cached(db):
+    calls, _ = db
+    assert helpers.count_user_memos("u1") == 3
+    n = len(calls)
+    assert helpers.count_user_memos("u1") == 3
+    assert len(calls) == n + 1
+
+
+def test_stale_memo_html_is_rendered_without_writing(monkeypatch):
+    writes = []
+    monkeypatch.setattr(helpers, "execute_db", lambda sql, args=(): writes.append(sql))
+    memo = {"id": "m1", "body": "**hi**", "body_html": "<p>old</p>", "body_hash": "stale", "render_version": "old"}
+    assert "<strong>hi</strong>" in helpers.memo_html(memo)
+    assert writes == []